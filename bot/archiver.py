@@ -0,0 +1,301 @@
+import asyncio
+import fcntl
+import gzip
+import json
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from mysql import MySQL
+from sqlalchemy import insert, or_, select
+from tables import Dialog, DialogArchive, User
+
+import config
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {"gzip": "jsonl.gz", "zstd": "jsonl.zst"}
+_SEGMENT = re.compile(r"^dialogs-(\d+)\.jsonl\.(gz|zst)$")
+
+
+def compress(data: bytes, compression: str) -> bytes:
+    if compression == "zstd":
+        import zstandard  # optional, only needed for zstd segments
+
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def decompress(data: bytes, segment: str) -> bytes:
+    if segment.endswith(".zst"):
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def dialog_record(row) -> dict:
+    return {
+        "uid": row.uid,
+        "user_id": row.user_id,
+        "chat_mode": row.chat_mode,
+        "model": row.model,
+        "start_time": row.start_time.isoformat() if row.start_time else None,
+        "messages": row.messages,
+        "summary": row.summary,
+    }
+
+
+class DialogArchiver:
+    """
+    Moves dialogs started more than `max_age_days` ago out of the dialog table, into
+    append-only segment files under `directory`. Each batch of dialogs is one
+    compressed frame appended to the current segment, dialog_archive keeps the
+    segment, offset and length of the frame of every dialog for `load`. The current
+    dialogs of users are never archived.
+
+    Batches are read by id without locks. In a short transaction, the dialogs still
+    unchanged are row locked, appended to the segment and deleted. The frame is
+    truncated away again if the transaction fails, so segments hold no orphan frames.
+    """
+
+    def __init__(
+        self,
+        mysql_db: MySQL,
+        enabled: bool = False,
+        directory: str = "archive",
+        max_age_days: float = 30,
+        compression: str = "gzip",
+        batch_size: int = 200,
+        segment_bytes: int = 256 * 1024 * 1024,
+        interval_seconds: float = 3600,
+        pause_seconds: float = 0.5,
+    ):
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Unknown compression {compression!r}")
+        self.mysql_db = mysql_db
+        self.enabled = enabled
+        self.directory = Path(directory)
+        self.max_age_days = max_age_days
+        self.compression = compression
+        self.batch_size = batch_size
+        self.segment_bytes = segment_bytes
+        self.interval_seconds = interval_seconds
+        self.pause_seconds = pause_seconds
+        self._task = None
+        self._stopping = False
+
+    def run_once(self) -> int:
+        """
+        Archives every dialog due, in batches
+        :return: number of dialogs archived
+        """
+        cutoff = datetime.utcnow() - timedelta(days=self.max_age_days)
+        last_id = 0
+        n_archived = 0
+        while not self._stopping:
+            rows = self._select_batch(last_id, cutoff)
+            if not rows:
+                break
+            last_id = rows[-1].id
+            n_archived += self._archive_batch(rows)
+            # leave room for the bot's own queries
+            time.sleep(self.pause_seconds)
+        return n_archived
+
+    def load(self, uid: str):
+        """
+        :return: the archived dialog as a dict, None if it's not archived
+        """
+        entry = self.mysql_db.get_instances(
+            None, DialogArchive, extra_filters={"uid": uid}, find_last=True
+        )
+        if entry is None:
+            return None
+        with open(self.directory / entry.segment, "rb") as f:
+            f.seek(entry.offset)
+            frame = f.read(entry.length)
+        for line in decompress(frame, entry.segment).splitlines():
+            record = json.loads(line)
+            if record["uid"] == uid:
+                return record
+        return None
+
+    def start(self):
+        if self.enabled:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            # a batch in progress finishes, its thread can't be cancelled
+            self._stopping = True
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                n_archived = await asyncio.to_thread(self.run_once)
+                if n_archived:
+                    logger.info(f"Archived {n_archived} dialogs")
+            except Exception as e:
+                logger.warning(f"Dialog archival failed: {e!r}")
+            await asyncio.sleep(self.interval_seconds)
+
+    def _select_batch(self, last_id: int, cutoff: datetime) -> list:
+        query = (
+            select(
+                Dialog.id,
+                Dialog.uid,
+                Dialog.user_id,
+                Dialog.chat_mode,
+                Dialog.model,
+                Dialog.start_time,
+                Dialog.messages,
+                Dialog.summary,
+            )
+            .outerjoin(User, User.user_id == Dialog.user_id)
+            .where(
+                Dialog.id > last_id,
+                Dialog.start_time < cutoff,
+                or_(
+                    User.current_dialog_id.is_(None),
+                    User.current_dialog_id != Dialog.uid,
+                ),
+            )
+            .order_by(Dialog.id)
+            .limit(self.batch_size)
+        )
+        with self.mysql_db.engine.connect() as connection:
+            return connection.execute(query).all()
+
+    def _archive_batch(self, rows: list) -> int:
+        session = self.mysql_db.Session()
+        try:
+            dialogs = {
+                dialog.id: dialog
+                for dialog in session.query(Dialog)
+                .filter(Dialog.id.in_([row.id for row in rows]))
+                .with_for_update()
+            }
+            current_dialog_ids = {
+                current_dialog_id
+                for (current_dialog_id,) in session.query(
+                    User.current_dialog_id
+                ).filter(User.user_id.in_({row.user_id for row in rows}))
+            }
+            archived, records = [], []
+            for row in rows:
+                dialog = dialogs.get(row.id)
+                if (
+                    dialog is None
+                    or dialog.uid in current_dialog_ids
+                    or dialog.messages != row.messages
+                    or dialog.summary != row.summary
+                ):
+                    # written to since it was read, archived again by a later run
+                    continue
+                archived.append(dialog)
+                records.append(dialog_record(row))
+            if not archived:
+                session.commit()
+                return 0
+            payload = "".join(
+                json.dumps(record, ensure_ascii=False) + "\n" for record in records
+            ).encode("utf-8")
+            with self._locked():
+                segment, offset, length = self._append(
+                    compress(payload, self.compression)
+                )
+                try:
+                    self._delete(session, archived, segment, offset, length)
+                except BaseException:
+                    # the frame is dropped with the transaction, no orphan is left
+                    self._truncate(segment, offset)
+                    raise
+            return len(archived)
+        finally:
+            session.close()
+
+    def _delete(self, session, archived: list, segment: str, offset: int, length: int):
+        """
+        Indexes the archived dialogs and deletes them, in the batch's transaction
+        """
+        session.execute(
+            insert(DialogArchive),
+            [
+                {
+                    "uid": dialog.uid,
+                    "user_id": dialog.user_id,
+                    "start_time": dialog.start_time,
+                    "segment": segment,
+                    "offset": offset,
+                    "length": length,
+                }
+                for dialog in archived
+            ],
+        )
+        for dialog in archived:
+            session.delete(dialog)
+        session.commit()
+
+    @contextmanager
+    def _locked(self):
+        """
+        Segments are appended to by one archiver at a time, across processes
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _segment_path(self) -> Path:
+        numbers = [
+            int(match.group(1))
+            for match in map(_SEGMENT.match, os.listdir(self.directory))
+            if match
+        ]
+        number = max(numbers, default=0)
+        path = self.directory / f"dialogs-{number:05d}.{EXTENSIONS[self.compression]}"
+        if path.exists() and path.stat().st_size >= self.segment_bytes:
+            number += 1
+        elif not path.exists() and any(
+            (self.directory / f"dialogs-{number:05d}.{extension}").exists()
+            for extension in EXTENSIONS.values()
+        ):
+            # the compression was changed, start a segment of the new kind
+            number += 1
+        return self.directory / f"dialogs-{number:05d}.{EXTENSIONS[self.compression]}"
+
+    def _append(self, frame: bytes) -> tuple:
+        """
+        Called holding `_locked`
+        :return: segment name, offset and length of the frame
+        """
+        path = self._segment_path()
+        with open(path, "ab") as f:
+            offset = f.tell()
+            f.write(frame)
+            f.flush()
+            # on disk before the dialogs are deleted
+            os.fsync(f.fileno())
+        return path.name, offset, len(frame)
+
+    def _truncate(self, segment: str, offset: int):
+        """
+        Called holding `_locked`, drops the frame appended at `offset`
+        """
+        with open(self.directory / segment, "r+b") as f:
+            f.truncate(offset)
+            os.fsync(f.fileno())
+
+
+dialog_archiver = DialogArchiver(MySQL(), **config.dialog_archive)
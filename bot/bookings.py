@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+from mysql import MySQL
+from tables import Booking, BookingEvent
+
+import config
+
+logger = logging.getLogger(__name__)
+
+CREATED = "created"
+CANCELLED = "cancelled"
+
+
+class BookingState:
+    """
+    Users with a booking, kept in memory so /call doesn't query the database.
+    Loaded from the booking table at startup, then kept current by polling the
+    booking_event log past the last id seen. Events may commit out of id order when
+    webhooks run concurrently, so the state is also reloaded every `resync_seconds`.
+    """
+
+    def __init__(
+        self,
+        mysql_db: MySQL,
+        poll_interval_seconds: float = 5,
+        resync_seconds: float = 600,
+    ):
+        self.mysql_db = mysql_db
+        self.poll_interval_seconds = poll_interval_seconds
+        self.resync_seconds = resync_seconds
+        # user_id -> event ids of their bookings, replaying an event changes nothing
+        self._bookings = defaultdict(set)
+        self._last_event_id = 0
+        self._loaded_at = None
+        self._task = None
+
+    @property
+    def ready(self) -> bool:
+        return self._loaded_at is not None
+
+    def is_booked(self, user_id: int) -> bool:
+        return bool(self._bookings.get(str(user_id)))
+
+    def load(self) -> bool:
+        """
+        :return: whether the state was (re)loaded
+        """
+        # the log position first, events after it are applied again on top
+        last_event = self.mysql_db.get_instances(None, BookingEvent, find_last=True)
+        bookings = self.mysql_db.get_instances(None, Booking)
+        if bookings is None:
+            return False
+        state = defaultdict(set)
+        for booking in bookings:
+            state[booking.user_id].add(booking.event_id)
+        self._bookings = state
+        self._last_event_id = last_event.id if last_event is not None else 0
+        self._loaded_at = time.monotonic()
+        self.poll()
+        logger.info(f"Loaded {len(bookings)} bookings of {len(state)} users")
+        return True
+
+    def poll(self) -> int:
+        """
+        :return: number of events applied
+        """
+        events = self.mysql_db.get_instances(
+            None, BookingEvent, id_greater_than=self._last_event_id
+        )
+        for booking_event in events or []:
+            self.apply(
+                booking_event.user_id, booking_event.event_id, booking_event.action
+            )
+            self._last_event_id = booking_event.id
+        return len(events or [])
+
+    def apply(self, user_id, event_id: str, action: str):
+        user_id = str(user_id)
+        if action == CREATED:
+            self._bookings[user_id].add(event_id)
+        elif action == CANCELLED:
+            self._bookings[user_id].discard(event_id)
+            if not self._bookings[user_id]:
+                del self._bookings[user_id]
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                if (
+                    not self.ready
+                    or time.monotonic() - self._loaded_at >= self.resync_seconds
+                ):
+                    await asyncio.to_thread(self.load)
+                else:
+                    await asyncio.to_thread(self.poll)
+            except Exception as e:
+                logger.warning(f"Booking state update failed: {e!r}")
+            await asyncio.sleep(self.poll_interval_seconds)
+
+
+booking_state = BookingState(MySQL(), **config.bookings)
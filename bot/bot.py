@@ -1,13 +1,19 @@
 import handlers
+import metrics
+import startup
+import tracing
+from archiver import dialog_archiver
+from bookings import booking_state
+from dialog_writer import dialog_writer
+from error_reporter import error_reporter
 from filters import (
     get_messages_that_indicate_a_certian_medical_condition,
     get_user_filter,
 )
 from mysql import MySQL
-from tables import Disease
+from summarizer import dialog_summarizer
 from telegram import BotCommand
 from telegram.ext import (
-    AIORateLimiter,
     Application,
     ApplicationBuilder,
     CallbackQueryHandler,
@@ -24,6 +30,11 @@ mysql_db = MySQL()
 
 
 async def post_init(application: Application):
+    startup.startup_timer.report()
+    error_reporter.start(application.bot)
+    booking_state.start()
+    dialog_writer.start()
+    dialog_archiver.start()
     await application.bot.set_my_commands(
         [
             BotCommand(command="/new", description="Start new conversation"),
@@ -46,37 +57,86 @@ async def post_init(application: Application):
     )
 
 
-def run_bot() -> None:
-    application = (
-        ApplicationBuilder()
+async def post_stop(application: Application):
+    await booking_state.stop()
+    await dialog_archiver.stop()
+    # before the summarizer, the last writes may start compactions
+    await dialog_writer.stop()
+    await dialog_summarizer.stop()
+    await error_reporter.stop()
+
+
+def build_application(builder: ApplicationBuilder = None) -> Application:
+    builder = (
+        (builder or ApplicationBuilder().application_class(tracing.TracingApplication))
         .token(config.telegram_token)
         .concurrent_updates(True)
-        .rate_limiter(AIORateLimiter(max_retries=5))
+        .rate_limiter(metrics.InstrumentedRateLimiter(max_retries=5))
         .post_init(post_init)
-        .build()
+        .post_stop(post_stop)
     )
+    if tracing.tracer.enabled:
+        builder = builder.request(tracing.TracingRequest(connection_pool_size=256))
+    if config.telegram_api_base_url:
+        builder = builder.base_url(config.telegram_api_base_url)
+    application = builder.build()
     user_filter = get_user_filter()
     command_handler = handlers.CommandHandler
     application.add_handler(
-        CommandHandler("start", command_handler.start_handle, filters=user_filter)
+        CommandHandler(
+            "start",
+            metrics.timed_handler("start", command_handler.start_handle),
+            filters=user_filter,
+        )
+    )
+    application.add_handler(
+        CommandHandler(
+            "help",
+            metrics.timed_handler("help", command_handler.help_handle),
+            filters=user_filter,
+        )
     )
     application.add_handler(
-        CommandHandler("help", command_handler.help_handle, filters=user_filter)
+        CommandHandler(
+            "call",
+            metrics.timed_handler("call", command_handler.call_handle),
+            filters=user_filter,
+        )
     )
     application.add_handler(
-        CommandHandler("call", command_handler.call_handle, filters=user_filter)
+        CommandHandler(
+            "retry",
+            metrics.timed_handler("retry", command_handler.retry_handle),
+            filters=user_filter,
+        )
     )
     application.add_handler(
-        CommandHandler("retry", command_handler.retry_handle, filters=user_filter)
+        CommandHandler(
+            "new",
+            metrics.timed_handler("new", command_handler.new_dialog_handle),
+            filters=user_filter,
+        )
     )
     application.add_handler(
-        CommandHandler("new", command_handler.new_dialog_handle, filters=user_filter)
+        CommandHandler(
+            "cancel",
+            metrics.timed_handler("cancel", command_handler.cancel_handle),
+            filters=user_filter,
+        )
     )
     application.add_handler(
-        CommandHandler("cancel", command_handler.cancel_handle, filters=user_filter)
+        CommandHandler(
+            "choose",
+            metrics.timed_handler("choose", command_handler.choose_concern),
+            filters=user_filter,
+        )
     )
     application.add_handler(
-        CommandHandler("choose", command_handler.choose_concern, filters=user_filter)
+        CommandHandler(
+            "profile",
+            metrics.timed_handler("profile", command_handler.profile_handle),
+            filters=user_filter,
+        )
     )
     application.add_handler(
         CallbackQueryHandler(command_handler.choose_concern_callback)
@@ -84,24 +144,35 @@ def run_bot() -> None:
     application.add_handler(handlers.registeration_handler(user_filter))
     application.add_handler(handlers.disease(user_filter))
     #  add conversation handlers
-    diseases = mysql_db.get_instances(None, Disease, False)
-    for disease in diseases:
+    for disease in mysql_db.get_disease_catalog():
         application.add_handler(
             MessageHandler(
                 get_messages_that_indicate_a_certian_medical_condition(
                     disease.detail, disease.id
                 )
                 & user_filter,
-                handlers.disease_start_handler,
+                metrics.timed_handler("disease_start", handlers.disease_start_handler),
             )
         )
     application.add_handler(
         MessageHandler(
-            filters.TEXT & ~filters.COMMAND & user_filter, handlers.message_handler
+            filters.TEXT & ~filters.COMMAND & user_filter,
+            metrics.timed_handler("message", handlers.message_handler),
         )
     )
     # add error handler
     application.add_error_handler(handlers.error_handler)
+    return application
+
+
+def run_bot() -> None:
+    with startup.startup_timer.phase("tables"):
+        mysql_db.create_tables_if_not_exists()
+        mysql_db.add_missing_columns()
+    startup.warm_up(mysql_db)
+    with startup.startup_timer.phase("application"):
+        application = build_application()
+    metrics.start_server()
     # start the bot
     application.run_polling()
 
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Bounded in-memory LRU of finished answers, keyed on a hash of the exact
+    prompt messages and completion options.
+    Entries evicted from memory are spilled to `disk_dir` when it is set. The
+    answers are patient data, so spilled files are deleted once they're older than
+    `disk_ttl_seconds` or there are more than `disk_max_entries` of them, oldest
+    first, and as soon as they're loaded back into memory.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 512,
+        disk_dir: Optional[str] = None,
+        chat_modes: Optional[list] = None,
+        disk_max_entries: int = 4096,
+        disk_ttl_seconds: float = 86400,
+    ):
+        self.max_entries = max(1, int(max_entries))
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.chat_modes = set(chat_modes or [])
+        self.disk_max_entries = max(0, int(disk_max_entries))
+        self.disk_ttl_seconds = disk_ttl_seconds
+        self._entries = OrderedDict()
+        # key -> time it was spilled, oldest first
+        self._spilled = OrderedDict()
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._scan_disk()
+
+    @staticmethod
+    def make_key(model: str, messages: list, options: dict) -> str:
+        payload = json.dumps(
+            {"model": model, "messages": messages, "options": options},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def is_allowed(self, chat_mode: str) -> bool:
+        """
+        Admin policy: only chat modes listed in config may be served from cache
+        """
+        return chat_mode in self.chat_modes
+
+    def get(self, key: str) -> Optional[str]:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        answer = self._load(key)
+        if answer is not None:
+            self.set(key, answer)
+        return answer
+
+    def set(self, key: str, answer: str):
+        self._entries[key] = answer
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            evicted_key, evicted_answer = self._entries.popitem(last=False)
+            self._spill(evicted_key, evicted_answer)
+
+    def _path(self, key: str) -> Path:
+        return self.disk_dir / f"{key}.json"
+
+    def _spill(self, key: str, answer: str):
+        if self.disk_dir is None:
+            return
+        try:
+            with open(self._path(key), "w") as f:
+                json.dump({"answer": answer}, f, ensure_ascii=False)
+        except OSError as e:
+            logger.warning(f"Could not spill cached response to disk: {e}")
+            return
+        self._spilled[key] = time.time()
+        self._spilled.move_to_end(key)
+        self._prune_disk()
+
+    def _load(self, key: str) -> Optional[str]:
+        if self.disk_dir is None or key not in self._spilled:
+            return None
+        self._prune_disk()
+        if key not in self._spilled:
+            return None
+        try:
+            with open(self._path(key), "r") as f:
+                return json.load(f)["answer"]
+        except (OSError, ValueError, KeyError):
+            return None
+        finally:
+            # back in memory, spilled again if it's evicted again
+            self._unspill(key)
+
+    def _scan_disk(self):
+        """
+        Files spilled by earlier runs are pruned like the ones spilled by this one
+        """
+        spilled = []
+        for path in self.disk_dir.glob("*.json"):
+            try:
+                spilled.append((path.stat().st_mtime, path.stem))
+            except OSError:
+                continue
+        for spilled_at, key in sorted(spilled):
+            self._spilled[key] = spilled_at
+        self._prune_disk()
+
+    def _prune_disk(self):
+        expired = time.time() - self.disk_ttl_seconds
+        while self._spilled:
+            key, spilled_at = next(iter(self._spilled.items()))
+            if len(self._spilled) <= self.disk_max_entries and spilled_at >= expired:
+                break
+            self._unspill(key)
+
+    def _unspill(self, key: str):
+        self._spilled.pop(key, None)
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not delete spilled cached response: {e}")
@@ -1,13 +1,21 @@
+import os
 from pathlib import Path
 
 import dotenv
 import yaml
 
-config_dir = Path(__file__).parent.parent.resolve() / "config"
+config_dir = Path(
+    os.environ.get(
+        "MEDICALGPT_CONFIG_DIR", Path(__file__).parent.parent.resolve() / "config"
+    )
+)
+
+# the libyaml parser is much faster, when pyyaml was built with it
+yaml_loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 # load yaml config
 with open(config_dir / "config.yml", "r") as f:
-    config_yaml = yaml.safe_load(f)
+    config_yaml = yaml.load(f, Loader=yaml_loader)
 
 # load .env config
 config_env = dotenv.dotenv_values(config_dir / "config.env")
@@ -20,8 +28,31 @@ allowed_telegram_usernames = config_yaml["allowed_telegram_usernames"]
 developer_telegram_chatid = config_yaml["developer_telegram_chatid"]
 admin_telegram_username = config_yaml["admin_telegram_username"]
 new_dialog_timeout = config_yaml["new_dialog_timeout"]
-mysql_uri = f"mysql+pymysql://{config_env['MYSQL_USER']}:{config_env['MYSQL_PASSWORD']}@{config_env['MYSQL_HOST']}:{config_env['MYSQL_PORT']}/{config_env['MYSQL_DATABASE']}"
+message_debounce_seconds = config_yaml.get("message_debounce_seconds", 0.25)
+# point the bot at other api servers, e.g. the stand-ins of scripts/loadtest
+telegram_api_base_url = config_yaml.get("telegram_api_base_url", None)
+openai_api_base = config_yaml.get("openai_api_base", None)
+response_cache = config_yaml.get("response_cache", None) or {}
+llm_admission = config_yaml.get("llm_admission", None) or {}
+openai_resilience = config_yaml.get("openai_resilience", None) or {}
+models = config_yaml.get("models", None)
+model_routes = config_yaml.get("model_routes", None) or {}
+metrics = config_yaml.get("metrics", None) or {}
+tracing = config_yaml.get("tracing", None) or {}
+query_log = config_yaml.get("query_log", None) or {}
+profiler = config_yaml.get("profiler", None) or {}
+startup = config_yaml.get("startup", None) or {}
+error_reports = config_yaml.get("error_reports", None) or {}
+bookings = config_yaml.get("bookings", None) or {}
+dialog_summary = config_yaml.get("dialog_summary", None) or {}
+dialog_retrieval = config_yaml.get("dialog_retrieval", None) or {}
+dialog_writer = config_yaml.get("dialog_writer", None) or {}
+dialog_archive = config_yaml.get("dialog_archive", None) or {}
+mysql_uri = (
+    config_env.get("DATABASE_URI")
+    or f"mysql+pymysql://{config_env['MYSQL_USER']}:{config_env['MYSQL_PASSWORD']}@{config_env['MYSQL_HOST']}:{config_env['MYSQL_PORT']}/{config_env['MYSQL_DATABASE']}"
+)
 
 # chat_modes
 with open(config_dir / "chat_modes.yml", "r") as f:
-    chat_modes = yaml.safe_load(f)
+    chat_modes = yaml.load(f, Loader=yaml_loader)
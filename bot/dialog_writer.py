@@ -0,0 +1,132 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+from error_reporter import error_reporter
+from mysql import MySQL
+from summarizer import dialog_summarizer
+
+import config
+
+mysql_db = MySQL()
+logger = logging.getLogger(__name__)
+
+
+class DialogWriter:
+    """
+    Stores replies (the dialog turn and the tokens used) from a background task, so
+    the handler returns as soon as the answer is sent. Replies are written in the
+    order they were submitted, up to `batch_size` of them in one transaction. When
+    `max_queued` replies are waiting, submitting waits for room.
+    """
+
+    def __init__(self, max_queued: int = 1000, batch_size: int = 50):
+        self.max_queued = max_queued
+        self.batch_size = batch_size
+        self._queue = None
+        self._worker = None
+        # user_id -> replies submitted and not written yet
+        self._pending = defaultdict(int)
+        self._written = defaultdict(asyncio.Event)
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Writes whatever is queued
+        """
+        if self._worker is None:
+            return
+        # queued behind the pending replies, the worker writes those and returns
+        await self._queue.put(None)
+        await self._worker
+        self._worker = None
+
+    async def submit(
+        self,
+        user_id: int,
+        dialog_id: str,
+        turn: dict,
+        model: str,
+        n_input_tokens: int,
+        n_output_tokens: int,
+    ):
+        """
+        :param turn: the turn appended to the dialog, None to only count the tokens
+        """
+        reply = {
+            "user_id": user_id,
+            "dialog_id": dialog_id,
+            "turn": turn,
+            "model": model,
+            "n_input_tokens": n_input_tokens,
+            "n_output_tokens": n_output_tokens,
+        }
+        if self._worker is None:
+            # not started or already stopped, written right away
+            await self._write([reply])
+            return
+        self._pending[user_id] += 1
+        await self._queue.put(reply)
+
+    async def wait_for_user(self, user_id: int):
+        """
+        Returns once the user's submitted replies are written, call before reading
+        their dialog
+        """
+        if self._pending.get(user_id):
+            await self._written[user_id].wait()
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            stopping = None in batch
+            replies = [reply for reply in batch if reply is not None]
+            try:
+                await self._write(replies)
+            except Exception as e:
+                # the worker keeps running, or the users waiting on it would hang
+                logger.error(f"Dialog writer failed: {e!r}")
+                error_reporter.report(e)
+            finally:
+                for reply in replies:
+                    self._done(reply["user_id"])
+            if stopping:
+                return
+
+    async def _write(self, replies: list):
+        if not replies:
+            return
+        try:
+            written = await asyncio.to_thread(mysql_db.write_replies, replies)
+        except Exception as e:
+            if len(replies) == 1:
+                logger.error(f"Writing a reply failed: {e!r}")
+                error_reporter.report(e)
+                return
+            # one bad reply shouldn't lose the rest of the batch
+            logger.warning(f"Writing {len(replies)} replies failed, one by one: {e!r}")
+            for reply in replies:
+                await self._write([reply])
+            return
+        user_ids = {reply["dialog_id"]: reply["user_id"] for reply in replies}
+        for dialog_id, dialog_messages in written.items():
+            dialog_summarizer.maybe_compact(
+                user_ids[dialog_id], dialog_id, dialog_messages
+            )
+
+    def _done(self, user_id: int):
+        self._pending[user_id] -= 1
+        if self._pending[user_id] <= 0:
+            del self._pending[user_id]
+            # only created by wait_for_user
+            written = self._written.pop(user_id, None)
+            if written is not None:
+                written.set()
+
+
+dialog_writer = DialogWriter(**config.dialog_writer)
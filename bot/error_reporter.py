@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+import html
+import json
+import logging
+import time
+import traceback
+from pathlib import Path
+
+import telegram
+from telegram import Update
+from telegram.constants import ParseMode
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# telegram's message length limit
+MAX_MESSAGE_LENGTH = 4096
+
+
+def split_text_into_chunks(text, chunk_size):
+    for i in range(0, len(text), chunk_size):
+        yield text[i : i + chunk_size]
+
+
+def fingerprint(error: BaseException) -> str:
+    """
+    Same exception type raised along the same code path, regardless of its message
+    (which usually contains ids)
+    """
+    frames = [
+        f"{Path(frame.filename).name}:{frame.name}:{frame.lineno}"
+        for frame in traceback.extract_tb(error.__traceback__)
+    ]
+    key = "|".join([type(error).__qualname__] + frames)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+
+class ErrorReporter:
+    """
+    Reports exceptions to the developer chat from a background task, never from the
+    handler that failed. The first occurrence of an error (by fingerprint) within
+    `window_seconds` is sent in full, its repeats are counted and sent as one digest
+    when the window ends.
+    """
+
+    def __init__(self, window_seconds: float = 300, max_queued: int = 1000):
+        self.window_seconds = window_seconds
+        self.max_queued = max_queued
+        self.n_dropped = 0
+        self._queue = None
+        self._worker = None
+        self._bot = None
+        # fingerprint -> {"error": ..., "count": ...} of the current window
+        self._window = {}
+        self._window_started = time.monotonic()
+
+    def start(self, bot: telegram.Bot):
+        self._bot = bot
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Sends whatever is left, while the bot can still send messages
+        """
+        if self._worker is None:
+            return
+        # queued behind the pending reports, the worker sends those and returns
+        await self._queue.put(None)
+        await self._worker
+        self._worker = None
+        await self._send_digest()
+
+    def report(self, error: BaseException, update: object = None):
+        """
+        Non-blocking, drops the report when the queue is full
+        """
+        if self._queue is None:
+            logger.error("Error reporter is not started", exc_info=error)
+            return
+        try:
+            self._queue.put_nowait((error, update))
+        except asyncio.QueueFull:
+            self.n_dropped += 1
+
+    async def _run(self):
+        while True:
+            timeout = self._window_started + self.window_seconds - time.monotonic()
+            try:
+                item = await asyncio.wait_for(self._queue.get(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                await self._send_digest()
+                continue
+            if item is None:
+                return
+            error, update = item
+            if self._record(error, update):
+                await self._send_report(error, update)
+
+    def _record(self, error: BaseException, update: object) -> bool:
+        """
+        :return: whether this is the first occurrence within the window
+        """
+        key = fingerprint(error)
+        if key in self._window:
+            self._window[key]["count"] += 1
+            return False
+        self._window[key] = {"error": error, "count": 1}
+        return True
+
+    async def _send(self, text: str):
+        for chunk in split_text_into_chunks(text, MAX_MESSAGE_LENGTH):
+            try:
+                await self._bot.send_message(
+                    config.developer_telegram_chatid, chunk, parse_mode=ParseMode.HTML
+                )
+            except telegram.error.BadRequest:
+                # a chunk boundary may split an html tag, send it without parse_mode
+                try:
+                    await self._bot.send_message(
+                        config.developer_telegram_chatid, chunk
+                    )
+                except Exception as e:
+                    logger.error(f"Could not send error report: {e!r}")
+                    return
+            except Exception as e:
+                logger.error(f"Could not send error report: {e!r}")
+                return
+
+    async def _send_report(self, error: BaseException, update: object):
+        tb_string = "".join(
+            traceback.format_exception(None, error, error.__traceback__)
+        )
+        update_str = update.to_dict() if isinstance(update, Update) else str(update)
+        await self._send(
+            f"An exception was raised while handling an update "
+            f"(<code>{fingerprint(error)}</code>, repeats within "
+            f"{self.window_seconds:.0f}s are sent as a digest)\n"
+            f"<pre>update = {html.escape(json.dumps(update_str, indent=2, ensure_ascii=False))}"
+            "</pre>\n\n"
+            f"<pre>{html.escape(tb_string)}</pre>"
+        )
+
+    async def _send_digest(self):
+        repeats = {
+            key: entry for key, entry in self._window.items() if entry["count"] > 1
+        }
+        self._window = {}
+        self._window_started = time.monotonic()
+        if not repeats and not self.n_dropped:
+            return
+        lines = [
+            f"<code>{key}</code> {html.escape(type(entry['error']).__name__)}: "
+            f"{html.escape(str(entry['error'])[:200])} ×{entry['count']}"
+            for key, entry in sorted(
+                repeats.items(), key=lambda item: item[1]["count"], reverse=True
+            )
+        ]
+        if self.n_dropped:
+            lines.append(f"{self.n_dropped} reports dropped, the queue was full")
+            self.n_dropped = 0
+        await self._send(
+            f"Errors repeated in the last {self.window_seconds:.0f}s:\n"
+            + "\n".join(lines)
+        )
+
+
+error_reporter = ErrorReporter(**config.error_reports)
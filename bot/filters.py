@@ -1,11 +1,16 @@
 import medicalgpt
+import metrics
 from mysql import MySQL
 from telegram import Message
 from telegram.ext import filters
+from tracing import tracer
 
 import config
 
 mysql_db = MySQL()
+# user_id -> {"text": ..., "conditions": [(condition, disease id), ...]}, the
+# classifications of a message shed by admission control, retried once it's answered
+deferred_classifications = {}
 
 
 def get_user_filter():
@@ -29,6 +34,10 @@ def get_messages_that_indicate_a_certian_medical_condition(
 
     class CustomFilter(filters.MessageFilter):
         def filter(self, message: Message) -> bool:
+            with tracer.span("classifier", disease=condition) as span:
+                return self._filter(message, span)
+
+        def _filter(self, message: Message, span) -> bool:
             try:
                 diagnosed_with = mysql_db.get_attribute(
                     message.from_user.id, "diagnosed_with"
@@ -38,6 +47,14 @@ def get_messages_that_indicate_a_certian_medical_condition(
                 result = medicalgpt.Filter().medical_condition_message_filter(
                     message, condition
                 )
+                if span is not None:
+                    span.set(result=result)
+                if result is None:
+                    # not a negative, the message handler classifies it later
+                    metrics.CLASSIFIER_CALLS.labels(condition, "shed").inc()
+                    defer_classification(message, condition, id)
+                    return False
+                metrics.CLASSIFIER_CALLS.labels(condition, str(result).lower()).inc()
                 if result:
                     mysql_db.set_attribute(
                         message.from_user.id, "diagnosed_with", f"{condition},{id}"
@@ -49,6 +66,14 @@ def get_messages_that_indicate_a_certian_medical_condition(
     return CustomFilter()
 
 
+def defer_classification(message: Message, condition: str, id: int):
+    deferred = deferred_classifications.get(message.from_user.id)
+    if deferred is None or deferred["text"] != message.text:
+        deferred = {"text": message.text, "conditions": []}
+        deferred_classifications[message.from_user.id] = deferred
+    deferred["conditions"].append((condition, id))
+
+
 def get_messages_that_start_with(
     text: str,
 ) -> filters.MessageFilter:
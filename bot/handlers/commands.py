@@ -3,14 +3,19 @@ from datetime import datetime
 
 import handlers
 import medicalgpt
-from handlers.message import message_handler
+import profiler
+from bookings import booking_state
+from dialog_writer import dialog_writer
+from handlers.message import message_handler, pending_messages
 from mysql import MySQL
-from tables import Booking, Disease
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from tables import Booking
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputFile, Update
 from telegram.constants import ParseMode
 from telegram.ext import CallbackContext, ContextTypes
 from utils import is_previous_message_not_answered_yet, register_user_if_not_exists
 
+import config
+
 mysql_db = MySQL()
 
 # setup
@@ -42,17 +47,20 @@ class CommandHandler:
             return
         user_id = update.message.from_user.id
         mysql_db.set_attribute(user_id, "last_interaction", datetime.now())
-        dialog_messages = mysql_db.get_dialog_messages(user_id, dialog_id=None)
-        if len(dialog_messages) == 0:
+        # the last reply may still be queued
+        await dialog_writer.wait_for_user(user_id)
+        # under the dialog's row lock, a compaction running meanwhile isn't undone
+        last_dialog_message = mysql_db.pop_last_dialog_message(user_id)
+        if last_dialog_message is None:
             await update.message.reply_text("No message to retry 🤷‍♂️")
             return
-        last_dialog_message = dialog_messages.pop()
-        mysql_db.set_dialog_messages(user_id, dialog_messages, dialog_id=None)
         await message_handler(
             update,
             context,
             message=last_dialog_message["user"],
             use_new_dialog_timeout=False,
+            # a new answer, not the cached one
+            regenerate=True,
         )
 
     async def new_dialog_handle(update: Update, context: CallbackContext):
@@ -72,6 +80,8 @@ class CommandHandler:
             return
         user_id = update.message.from_user.id
         mysql_db.set_attribute(user_id, "last_interaction", datetime.now())
+        # messages waiting for the current reply are dropped too
+        pending_messages.pop(user_id, None)
         if user_id in user_tasks:
             task = user_tasks[user_id]
             task.cancel()
@@ -85,11 +95,12 @@ class CommandHandler:
             return
         user_id = update.message.from_user.id
         mysql_db.set_attribute(user_id, "last_interaction", datetime.now())
-        if mysql_db.check_if_object_exists(
-            user_id,
-            False,
-            Booking,
-        ):
+        if booking_state.ready:
+            already_booked = booking_state.is_booked(user_id)
+        else:
+            # the state failed to load, ask the database
+            already_booked = mysql_db.check_if_object_exists(user_id, False, Booking)
+        if already_booked:
             await update.message.reply_text(
                 "You've already booked an appointment 📅\n\nPlease pay your dues by clicking on /pay",
                 parse_mode=ParseMode.HTML,
@@ -104,11 +115,7 @@ class CommandHandler:
         if await register_user_if_not_exists(update, context, update.message.from_user):
             return
         available_diseases = {
-            disease.detail: disease.id
-            for disease in mysql_db.get_instances(
-                None,
-                Disease,
-            )
+            disease.detail: disease.id for disease in mysql_db.get_disease_catalog()
         }
         keyboard = []
         for disease in available_diseases.keys():
@@ -142,3 +149,41 @@ class CommandHandler:
             text=f"Confirmed choice: {query.data.split(',')[0].replace('_', ' ').title()}.\nPlease click on /diagnose to start the diagnosis conversation.",
             parse_mode=ParseMode.HTML,
         )
+
+    async def profile_handle(update: Update, context: CallbackContext):
+        """
+        /profile <seconds>, admins only. Sends a collapsed stack profile of the event
+        loop to the developer chat.
+        """
+        is_admin = (
+            config.admin_telegram_username
+            and update.message.from_user.username == config.admin_telegram_username
+        )
+        if (
+            not is_admin
+            and update.effective_chat.id != config.developer_telegram_chatid
+        ):
+            return
+        max_seconds = config.profiler.get("max_seconds", 300)
+        try:
+            seconds = float(context.args[0]) if context.args else 10
+        except ValueError:
+            await update.message.reply_text("Usage: /profile <seconds>")
+            return
+        seconds = min(max(seconds, 1), max_seconds)
+        await update.message.reply_text(f"Profiling for {seconds:.0f}s ⏱")
+        try:
+            result = await profiler.profile(
+                seconds, config.profiler.get("sample_interval_ms", 10) / 1000
+            )
+        except RuntimeError as e:
+            await update.message.reply_text(str(e))
+            return
+        await context.bot.send_document(
+            config.developer_telegram_chatid,
+            InputFile(
+                io.BytesIO(result.collapsed().encode("utf-8")),
+                filename=f"profile-{datetime.now():%Y%m%d-%H%M%S}.collapsed",
+            ),
+            caption=f"{result.n_samples} samples over {seconds:.0f}s, open with speedscope or flamegraph.pl",
+        )
@@ -1,5 +1,9 @@
+import asyncio
 import logging
 
+import medicalgpt
+import metrics
+from filters import deferred_classifications
 from mysql import MySQL
 from tables import DiseaseAnswer, DiseaseQuestion, Disposition
 from telegram import ReplyKeyboardRemove, Update
@@ -18,6 +22,13 @@ mysql_db = MySQL()
 logger = logging.getLogger(__name__)
 
 OTHER_QUESTIONS = range(1)
+# classifications retried in the background, referenced so they aren't collected
+_classification_tasks = set()
+
+
+def diagnosis_reply_text(diagnosed_with: str) -> str:
+    condition = " ".join(diagnosed_with.split(",")[0].split("_"))
+    return f"I see that you are suffering from <b>{condition}</b>\nPlease click on /diagnose to start the diagnosis process.\nOr if you believe you've some other disease click on /choose to start the diagnosis process for that disease."
 
 
 async def disease_start_handler(
@@ -29,14 +40,50 @@ async def disease_start_handler(
         diagnosed_with = mysql_db.get_attribute(
             update.message.from_user.id, "diagnosed_with"
         )
-        diagnosed_with = diagnosed_with.split(",")[0].split("_")
-        diagnosed_with = " ".join(diagnosed_with)
-        reply_text = f"I see that you are suffering from <b>{diagnosed_with}</b>\nPlease click on /diagnose to start the diagnosis process.\nOr if you believe you've some other disease click on /choose to start the diagnosis process for that disease."
+        reply_text = diagnosis_reply_text(diagnosed_with)
     except (IndexError, AttributeError):
         reply_text = "You've not been diagnosed with any disease yet. Please tell me your problem and then click on /diagnose to start the diagnosis process."
     await update.message.reply_text(reply_text, parse_mode=ParseMode.HTML)
 
 
+def classify_deferred(update: Update):
+    """
+    Retries the classifications of the user's message which were shed by admission
+    control, in the background, once the message was answered
+    """
+    deferred = deferred_classifications.pop(update.message.from_user.id, None)
+    if deferred:
+        task = asyncio.create_task(_classify_deferred(update, deferred))
+        _classification_tasks.add(task)
+        task.add_done_callback(_classification_tasks.discard)
+
+
+async def _classify_deferred(update: Update, deferred: dict):
+    user_id = update.message.from_user.id
+    for condition, disease_id in deferred["conditions"]:
+        if mysql_db.get_attribute(user_id, "diagnosed_with"):
+            return
+        try:
+            result = await medicalgpt.Filter().amedical_condition_message_filter(
+                deferred["text"], condition
+            )
+        except asyncio.TimeoutError:
+            metrics.CLASSIFIER_CALLS.labels(condition, "shed_timeout").inc()
+            logger.warning(f"Deferred classification for {condition} timed out")
+            continue
+        except Exception as e:
+            logger.warning(f"Deferred classification for {condition} failed: {e!r}")
+            continue
+        metrics.CLASSIFIER_CALLS.labels(condition, str(result).lower()).inc()
+        if result:
+            diagnosed_with = f"{condition},{disease_id}"
+            mysql_db.set_attribute(user_id, "diagnosed_with", diagnosed_with)
+            await update.message.reply_text(
+                diagnosis_reply_text(diagnosed_with), parse_mode=ParseMode.HTML
+            )
+            return
+
+
 async def start(update: Update, context: CallbackContext) -> int:
     try:
         if await is_previous_message_not_answered_yet(update, context):
@@ -144,7 +191,9 @@ async def end(update: Update, context: CallbackContext) -> int:
 
 def disease(user_filter) -> ConversationHandler:
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("diagnose", start)],
+        entry_points=[
+            CommandHandler("diagnose", metrics.timed_handler("diagnose", start))
+        ],
         states={
             OTHER_QUESTIONS: [
                 MessageHandler(
@@ -1,15 +1,26 @@
 import asyncio
 import logging
+import time
 import traceback
 from datetime import datetime
 
 import medicalgpt
+import metrics
 import telegram
+from dialog_writer import dialog_writer
+from error_reporter import error_reporter
+from handlers.disease import classify_deferred
 from mysql import MySQL
+from resilience import LLMUnavailableError
+from router import router
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import CallbackContext
-from utils import edited_message_handle, is_previous_message_not_answered_yet
+from utils import (
+    edited_message_handle,
+    is_previous_message_not_answered_yet,
+    register_user_if_not_exists,
+)
 
 import config
 from bot import user_semaphores, user_tasks
@@ -17,6 +28,8 @@ from bot import user_semaphores, user_tasks
 # setup
 mysql_db = MySQL()
 logger = logging.getLogger(__name__)
+# user_id -> {"texts": [...], "generation": n}, messages waiting to be answered together
+pending_messages = {}
 
 
 async def message_handle_fn(
@@ -27,7 +40,10 @@ async def message_handle_fn(
     pass_dialog_messages,
     user_id,
     disease_id: int = None,
+    regenerate: bool = False,
 ):
+    # the user's previous reply may still be queued
+    await dialog_writer.wait_for_user(user_id)
     # new dialog timeout
     if use_new_dialog_timeout:
         if (
@@ -41,9 +57,12 @@ async def message_handle_fn(
                 parse_mode=ParseMode.HTML,
             )
     mysql_db.set_attribute(user_id, "last_interaction", datetime.now())
+    # the dialog the reply is added to, even if a new one is started meanwhile
+    dialog_id = mysql_db.get_attribute(user_id, "current_dialog_id")
     # in case of CancelledError
     n_input_tokens, n_output_tokens = 0, 0
     current_model = mysql_db.get_attribute(user_id, "current_model")
+    current_chat_mode = mysql_db.get_attribute(user_id, "current_chat_mode")
     try:
         # send placeholder message to user
         placeholder_message = await update.message.reply_text(
@@ -53,19 +72,34 @@ async def message_handle_fn(
         await update.message.chat.send_action(action="typing")
         _message = message or update.message.text
         dialog_messages = (
-            mysql_db.get_dialog_messages(user_id, dialog_id=None)
+            mysql_db.get_dialog_messages(user_id, dialog_id=dialog_id)
             if pass_dialog_messages
             else []
         )
+        dialog_summary = (
+            mysql_db.get_dialog_summary(user_id, dialog_id)
+            if pass_dialog_messages
+            else ""
+        )
         parse_mode = {"html": ParseMode.HTML, "markdown": ParseMode.MARKDOWN}[
             medicalgpt.CHAT_MODES["default"]["parse_mode"]
         ]
+        current_model = router.chat_model(
+            current_model,
+            _message,
+            disease_id=disease_id,
+            n_dialog_messages=len(dialog_messages),
+        )
         gpt_instance = medicalgpt.MedicalGPT()
         gen = gpt_instance.send_message_stream(
             _message,
             dialog_messages=dialog_messages,
             user_id=user_id,
             disease_id=disease_id,
+            chat_mode=current_chat_mode or "default",
+            model=current_model,
+            dialog_summary=dialog_summary,
+            regenerate=regenerate,
         )
         prev_answer = ""
         async for gen_item in gen:
@@ -79,6 +113,7 @@ async def message_handle_fn(
             # update only when 100 new symbols are ready
             if abs(len(answer) - len(prev_answer)) < 100 and status != "finished":
                 continue
+            metrics.TELEGRAM_EDITS.inc()
             try:
                 await context.bot.edit_message_text(
                     answer,
@@ -97,29 +132,39 @@ async def message_handle_fn(
                     )
             await asyncio.sleep(0.01)  # wait a bit to avoid flooding
             prev_answer = answer
+        metrics.REPLY_TOKENS.labels(current_model, "input").observe(n_input_tokens)
+        metrics.REPLY_TOKENS.labels(current_model, "output").observe(n_output_tokens)
         # update user data
         new_dialog_message = {
             "user": _message,
             "bot": answer,
         }
-        mysql_db.set_dialog_messages(
+        await dialog_writer.submit(
             user_id,
-            mysql_db.get_dialog_messages(user_id, dialog_id=None)
-            + [new_dialog_message],
-            dialog_id=None,
-        )
-        mysql_db.update_n_used_tokens(
-            user_id, current_model, n_input_tokens, n_output_tokens
+            dialog_id,
+            new_dialog_message,
+            current_model,
+            n_input_tokens,
+            n_output_tokens,
         )
     except asyncio.CancelledError:
-        mysql_db.update_n_used_tokens(
-            user_id, current_model, n_input_tokens, n_output_tokens
+        await dialog_writer.submit(
+            user_id, dialog_id, None, current_model, n_input_tokens, n_output_tokens
         )
         raise
 
+    except LLMUnavailableError as e:
+        logger.error(f"OpenAI is unavailable: {e}")
+        await update.message.reply_text(
+            "😔 Our medical assistant is <b>overloaded</b> right now.\nPlease try again in a minute, or use /retry.",
+            parse_mode=ParseMode.HTML,
+        )
+        return
+
     except Exception as e:
         error_text = f"Something went wrong during completion. Reason: {e}\n\nTraceback: {traceback.format_exc()}"
         logger.error(error_text)
+        error_reporter.report(e, update)
         await update.message.reply_text(error_text)
         return
 
@@ -138,32 +183,109 @@ async def message_handler(
     message=None,
     use_new_dialog_timeout=True,
     pass_dialog_messages=True,
+    regenerate=False,
 ):
     # check if message is edited
     if update.edited_message is not None:
         await edited_message_handle(update, context)
         return
+    if message is None:
+        # typed by the user, may be merged with the messages right before and after it
+        await debounced_message_handler(
+            update, context, use_new_dialog_timeout, pass_dialog_messages
+        )
+        return
     if await is_previous_message_not_answered_yet(update, context):
         return
     user_id = update.message.from_user.id
     async with user_semaphores[user_id]:
-        task = asyncio.create_task(
-            message_handle_fn(
-                update=update,
-                context=context,
-                message=message,
-                use_new_dialog_timeout=use_new_dialog_timeout,
-                pass_dialog_messages=pass_dialog_messages,
-                user_id=user_id,
-            )
+        await answer_message(
+            update,
+            context,
+            message,
+            use_new_dialog_timeout,
+            pass_dialog_messages,
+            regenerate,
         )
-        user_tasks[user_id] = task
-        try:
-            await task
-        except asyncio.CancelledError:
-            await update.message.reply_text("✅ Canceled", parse_mode=ParseMode.HTML)
-        else:
-            pass
-        finally:
-            if user_id in user_tasks:
-                del user_tasks[user_id]
+
+
+async def debounced_message_handler(
+    update: Update,
+    context: CallbackContext,
+    use_new_dialog_timeout=True,
+    pass_dialog_messages=True,
+):
+    """
+    Messages sent within `message_debounce_seconds` of each other, or while the
+    previous reply is being written, are answered together by one completion. A
+    message sent while a reply is in flight isn't held back, it waits for the reply
+    anyway.
+    """
+    if await register_user_if_not_exists(update, context, update.message.from_user):
+        return
+    user_id = update.message.from_user.id
+    pending = pending_messages.setdefault(user_id, {"texts": [], "generation": 0})
+    pending["texts"].append(update.message.text)
+    pending["generation"] += 1
+    generation = pending["generation"]
+    if user_id not in user_tasks:
+        started = time.perf_counter()
+        await asyncio.sleep(config.message_debounce_seconds)
+        metrics.observe_debounce(time.perf_counter() - started)
+    # /cancel drops the pending messages, a newer message then starts new ones
+    if pending_messages.get(user_id) is not pending:
+        return
+    if pending["generation"] != generation:
+        # a later message arrived within the window, its handler answers this one too
+        return
+    # queued behind the reply being written, instead of being rejected
+    async with user_semaphores[user_id]:
+        # whichever handler gets here first answers everything pending, unless they
+        # were answered or cancelled meanwhile
+        if pending_messages.get(user_id) is not pending:
+            return
+        del pending_messages[user_id]
+        if not pending["texts"]:
+            return
+        await answer_message(
+            update,
+            context,
+            "\n".join(pending["texts"]),
+            use_new_dialog_timeout,
+            pass_dialog_messages,
+        )
+
+
+async def answer_message(
+    update: Update,
+    context: CallbackContext,
+    message: str,
+    use_new_dialog_timeout=True,
+    pass_dialog_messages=True,
+    regenerate=False,
+):
+    """
+    Must be called holding the user's semaphore
+    :param regenerate: a new answer, not a cached one (/retry)
+    """
+    user_id = update.message.from_user.id
+    task = asyncio.create_task(
+        message_handle_fn(
+            update=update,
+            context=context,
+            message=message,
+            use_new_dialog_timeout=use_new_dialog_timeout,
+            pass_dialog_messages=pass_dialog_messages,
+            user_id=user_id,
+            regenerate=regenerate,
+        )
+    )
+    user_tasks[user_id] = task
+    try:
+        await task
+        classify_deferred(update)
+    except asyncio.CancelledError:
+        await update.message.reply_text("✅ Canceled", parse_mode=ParseMode.HTML)
+    finally:
+        if user_id in user_tasks:
+            del user_tasks[user_id]
@@ -1,5 +1,6 @@
 import logging
 
+import metrics
 from mysql import MySQL
 from tables import Allergy, MedicalCondition, Medication, Surgery
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
@@ -222,7 +223,9 @@ async def end(update: Update, context: CallbackContext) -> int:
 
 def registeration_handler(user_filter) -> ConversationHandler:
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("register", start)],
+        entry_points=[
+            CommandHandler("register", metrics.timed_handler("register", start))
+        ],
         states={
             AGE: [
                 MessageHandler(filters.Regex("^[0-9]+(\.[0-9]+)?$") & user_filter, age)
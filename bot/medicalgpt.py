@@ -1,11 +1,21 @@
-import openai
-import tiktoken
+import asyncio
+import contextlib
+import functools
+import logging
+import time
+from collections import deque
+
+import metrics
+from cache import ResponseCache
 from mysql import MySQL
+from resilience import ResilientOpenAI, load_openai
+from retrieval import dialog_retriever
+from router import router
 
 import config
 
-openai.api_key = config.openai_api_key
 mysql_db = MySQL()
+logger = logging.getLogger(__name__)
 
 
 CHAT_MODES = config.chat_modes
@@ -17,6 +27,185 @@ OPENAI_COMPLETION_OPTIONS = {
     "frequency_penalty": 0,
     "presence_penalty": 0,
 }
+# a yes/no answer needs only a couple of tokens
+CLASSIFICATION_COMPLETION_OPTIONS = {**OPENAI_COMPLETION_OPTIONS, "max_tokens": 5}
+# a shed classification retried later waits at most this long for admission and openai
+CLASSIFICATION_TIMEOUT_SECONDS = config.llm_admission.get(
+    "classification_timeout_seconds", 30
+)
+
+# cached answers are replayed in chunks this big, so they go through the same edit path
+CACHE_REPLAY_CHUNK_SIZE = 200
+
+response_cache = (
+    ResponseCache(
+        max_entries=config.response_cache.get("max_entries", 512),
+        disk_dir=config.response_cache.get("disk_dir"),
+        disk_max_entries=config.response_cache.get("disk_max_entries", 4096),
+        disk_ttl_seconds=config.response_cache.get("disk_ttl_seconds", 86400),
+        chat_modes=config.response_cache.get("chat_modes", ["default"]),
+    )
+    if config.response_cache.get("enabled", False)
+    else None
+)
+
+# admission lanes, in priority order
+INTERACTIVE_LANE = "interactive"
+BACKGROUND_LANE = "background"
+
+
+class AdmissionController:
+    """
+    Global gate in front of every openai call: at most `max_concurrency` calls in
+    flight, and at most `tokens_per_minute` estimated tokens admitted over a sliding
+    minute. Waiters in the interactive lane are always admitted before background ones.
+    """
+
+    LANES = (INTERACTIVE_LANE, BACKGROUND_LANE)
+    WINDOW_SECONDS = 60.0
+    # waits longer than this are logged
+    SLOW_WAIT_SECONDS = 1.0
+
+    def __init__(self, max_concurrency: int = 8, tokens_per_minute: int = 40000):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.tokens_per_minute = max(1, int(tokens_per_minute))
+        self._in_flight = 0
+        self._window = deque()  # (admitted_at, n_tokens)
+        self._window_tokens = 0
+        self._waiters = {lane: deque() for lane in self.LANES}
+        self._lane_stats = {
+            lane: {"admitted": 0, "shed": 0, "total_wait": 0.0, "max_wait": 0.0}
+            for lane in self.LANES
+        }
+        self._wakeup_handle = None
+
+    def _prune_window(self, now: float):
+        while self._window and now - self._window[0][0] >= self.WINDOW_SECONDS:
+            _, n_tokens = self._window.popleft()
+            self._window_tokens -= n_tokens
+
+    def _has_capacity(self, n_tokens: int, now: float) -> bool:
+        if self._in_flight >= self.max_concurrency:
+            return False
+        self._prune_window(now)
+        # a single request bigger than the whole budget is let through on an empty window
+        return (
+            not self._window or self._window_tokens + n_tokens <= self.tokens_per_minute
+        )
+
+    def _admit(self, lane: str, n_tokens: int, waited: float, now: float):
+        self._in_flight += 1
+        self._window.append((now, n_tokens))
+        self._window_tokens += n_tokens
+        lane_stats = self._lane_stats[lane]
+        lane_stats["admitted"] += 1
+        lane_stats["total_wait"] += waited
+        lane_stats["max_wait"] = max(lane_stats["max_wait"], waited)
+        if waited >= self.SLOW_WAIT_SECONDS:
+            logger.info(
+                f"LLM admission: waited {waited:.2f}s in {lane} lane, "
+                f"queue depth {self.queue_depth()}"
+            )
+
+    def _dispatch(self):
+        now = time.monotonic()
+        for lane in self.LANES:
+            waiters = self._waiters[lane]
+            while waiters:
+                future, n_tokens, enqueued_at = waiters[0]
+                if future.done():  # cancelled while waiting
+                    waiters.popleft()
+                    continue
+                if not self._has_capacity(n_tokens, now):
+                    self._schedule_wakeup(future.get_loop(), now)
+                    return
+                waiters.popleft()
+                self._admit(lane, n_tokens, now - enqueued_at, now)
+                future.set_result(None)
+
+    def _schedule_wakeup(self, loop, now: float):
+        # nothing will release a slot if we are only waiting for the budget window to slide
+        if self._wakeup_handle is not None or not self._window:
+            return
+        delay = max(0.0, self.WINDOW_SECONDS - (now - self._window[0][0]))
+        self._wakeup_handle = loop.call_later(delay, self._on_wakeup)
+
+    def _on_wakeup(self):
+        self._wakeup_handle = None
+        self._dispatch()
+
+    def release(self):
+        self._in_flight -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def admit(self, n_tokens: int, lane: str = INTERACTIVE_LANE):
+        now = time.monotonic()
+        if not any(self._waiters.values()) and self._has_capacity(n_tokens, now):
+            self._admit(lane, n_tokens, 0.0, now)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._waiters[lane].append((future, n_tokens, now))
+            self._dispatch()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # admitted right before being cancelled, give the slot back
+                    self.release()
+                raise
+        try:
+            yield
+        finally:
+            self.release()
+
+    def try_admit(self, n_tokens: int, lane: str = BACKGROUND_LANE) -> bool:
+        """
+        Non-blocking admission for synchronous callers, which can't wait on the event loop.
+        The caller must call `release()` when admitted.
+        """
+        now = time.monotonic()
+        if any(self._waiters.values()) or not self._has_capacity(n_tokens, now):
+            self._lane_stats[lane]["shed"] += 1
+            return False
+        self._admit(lane, n_tokens, 0.0, now)
+        return True
+
+    def queue_depth(self, lane: str = None) -> int:
+        if lane is not None:
+            return len(self._waiters[lane])
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def stats(self) -> dict:
+        self._prune_window(time.monotonic())
+        lanes = {}
+        for lane, lane_stats in self._lane_stats.items():
+            lanes[lane] = {
+                "queue_depth": self.queue_depth(lane),
+                "admitted": lane_stats["admitted"],
+                "shed": lane_stats["shed"],
+                "avg_wait": lane_stats["total_wait"] / lane_stats["admitted"]
+                if lane_stats["admitted"]
+                else 0.0,
+                "max_wait": lane_stats["max_wait"],
+            }
+        return {
+            "in_flight": self._in_flight,
+            "tokens_in_window": self._window_tokens,
+            "lanes": lanes,
+        }
+
+
+admission_controller = AdmissionController(
+    max_concurrency=config.llm_admission.get("max_concurrency", 8),
+    tokens_per_minute=config.llm_admission.get("tokens_per_minute", 40000),
+)
+for lane in AdmissionController.LANES:
+    metrics.LLM_QUEUE_DEPTH.labels(lane).set_function(
+        functools.partial(admission_controller.queue_depth, lane)
+    )
+
+openai_client = ResilientOpenAI(**config.openai_resilience)
 
 
 class BaseMedicalGPT:
@@ -27,13 +216,24 @@ class BaseMedicalGPT:
         prompt=CHAT_MODES["default"]["prompt_start"],
         user_id: int = None,
         disease_id: int = None,
+        patient_details_messages: list = None,
+        dialog_summary: str = "",
     ):
         messages = [{"role": "system", "content": prompt}]
-        patient_details_messages = []
-        if user_id is not None:
-            patient_details_messages = list(
-                mysql_db.prepare_patient_history(user_id, disease_id=disease_id)
+        if dialog_summary:
+            # the older turns of the dialog, see summarizer.py
+            messages.append(
+                {
+                    "role": "system",
+                    "content": f"Summary of the earlier conversation:\n{dialog_summary}",
+                }
             )
+        if patient_details_messages is None:
+            patient_details_messages = []
+            if user_id is not None:
+                patient_details_messages = list(
+                    mysql_db.prepare_patient_history(user_id, disease_id=disease_id)
+                )
         for dialog_message in dialog_messages:
             messages.append({"role": "user", "content": dialog_message["user"]})
             messages.append({"role": "assistant", "content": dialog_message["bot"]})
@@ -41,13 +241,12 @@ class BaseMedicalGPT:
         messages.append({"role": "user", "content": message})
         return messages
 
-    def _count_tokens_from_messages(self, messages, answer):
-        encoding = tiktoken.encoding_for_model("gpt-4")
+    def _count_input_tokens(self, messages, model: str = "gpt-4") -> int:
+        encoding = router.encoding_for(model)
         # every message follows <im_start>{role/name}\n{content}<im_end>\n
         tokens_per_message = 4
         # if there's a name, the role is omitted
         tokens_per_name = -1
-        # input
         n_input_tokens = 0
         for message in messages:
             n_input_tokens += tokens_per_message
@@ -56,48 +255,120 @@ class BaseMedicalGPT:
                 if key == "name":
                     n_input_tokens += tokens_per_name
         n_input_tokens += 2
-        # output
-        n_output_tokens = 1 + len(encoding.encode(answer))
-        return n_input_tokens, n_output_tokens
+        return n_input_tokens
+
+    def _count_output_tokens(self, answer, model: str = "gpt-4") -> int:
+        return 1 + len(router.encoding_for(model).encode(answer))
+
+    def _count_tokens_from_messages(self, messages, answer, model: str = "gpt-4"):
+        return self._count_input_tokens(messages, model), self._count_output_tokens(
+            answer, model
+        )
+
+    def _estimate_request_tokens(
+        self, messages, model: str = "gpt-4", max_tokens: int = None
+    ) -> int:
+        # openai counts max_tokens against the rate limit, not only the prompt
+        if max_tokens is None:
+            max_tokens = OPENAI_COMPLETION_OPTIONS["max_tokens"]
+        return self._count_input_tokens(messages, model) + max_tokens
 
 
 class MedicalGPT(BaseMedicalGPT):
     async def send_message_stream(
-        self, message, dialog_messages=[], user_id: int = None, disease_id: int = None
+        self,
+        message,
+        dialog_messages=[],
+        user_id: int = None,
+        disease_id: int = None,
+        chat_mode: str = "default",
+        model: str = "gpt-4",
+        dialog_summary: str = "",
+        regenerate: bool = False,
     ):
+        """
+        :param regenerate: skip the cache lookup, the new answer replaces the cached one
+        """
+        # in long dialogs, only the recent turns and those relevant to the message
+        dialog_messages = dialog_retriever.select(
+            user_id, dialog_messages, message, model
+        )
         n_dialog_messages_before = len(dialog_messages)
+        prompt = CHAT_MODES.get(chat_mode, CHAT_MODES["default"])["prompt_start"]
+        use_cache = response_cache is not None and response_cache.is_allowed(chat_mode)
+        patient_details_messages = []
+        if user_id is not None:
+            patient_details_messages = list(
+                mysql_db.prepare_patient_history(user_id, disease_id=disease_id)
+            )
+        # drop the oldest turns up front, instead of waiting for openai to reject them
+        max_input_tokens = (
+            router.context_limit(model) - OPENAI_COMPLETION_OPTIONS["max_tokens"]
+        )
         answer = None
         while answer is None:
             try:
                 messages = self._generate_prompt_messages(
-                    message, dialog_messages, user_id=user_id, disease_id=disease_id
+                    message,
+                    dialog_messages,
+                    prompt=prompt,
+                    patient_details_messages=patient_details_messages,
+                    dialog_summary=dialog_summary,
                 )
-                r_gen = await openai.ChatCompletion.acreate(
-                    model="gpt-4",
-                    messages=messages,
-                    stream=True,
-                    **OPENAI_COMPLETION_OPTIONS,
+                n_input_tokens = self._count_input_tokens(messages, model)
+                if n_input_tokens > max_input_tokens and len(dialog_messages) > 0:
+                    dialog_messages = dialog_messages[1:]
+                    continue
+                n_first_dialog_messages_removed = n_dialog_messages_before - len(
+                    dialog_messages
                 )
-
-                answer = ""
-                async for r_item in r_gen:
-                    delta = r_item.choices[0].delta
-                    if "content" in delta:
-                        answer += delta.content
-                        (
-                            n_input_tokens,
-                            n_output_tokens,
-                        ) = self._count_tokens_from_messages(messages, answer)
-                        n_first_dialog_messages_removed = (
-                            n_dialog_messages_before - len(dialog_messages)
-                        )
-                        yield "not_finished", answer, (
-                            n_input_tokens,
-                            n_output_tokens,
+                if use_cache:
+                    cache_key = response_cache.make_key(
+                        model, messages, OPENAI_COMPLETION_OPTIONS
+                    )
+                    cached_answer = (
+                        None if regenerate else response_cache.get(cache_key)
+                    )
+                    if cached_answer is not None:
+                        # nothing was sent to openai, so no tokens are charged
+                        for end in range(
+                            CACHE_REPLAY_CHUNK_SIZE,
+                            len(cached_answer),
+                            CACHE_REPLAY_CHUNK_SIZE,
+                        ):
+                            yield "not_finished", cached_answer[:end], (
+                                0,
+                                0,
+                            ), n_first_dialog_messages_removed
+                        yield "finished", cached_answer, (
+                            0,
+                            0,
                         ), n_first_dialog_messages_removed
+                        return
+                async with admission_controller.admit(
+                    n_input_tokens + OPENAI_COMPLETION_OPTIONS["max_tokens"],
+                    lane=INTERACTIVE_LANE,
+                ):
+                    answer = ""
+                    async for r_item in openai_client.stream(
+                        call_type="chat",
+                        model=model,
+                        messages=messages,
+                        **OPENAI_COMPLETION_OPTIONS,
+                    ):
+                        delta = r_item.choices[0].delta
+                        if "content" in delta:
+                            answer += delta.content
+                            n_output_tokens = self._count_output_tokens(answer, model)
+                            yield "not_finished", answer, (
+                                n_input_tokens,
+                                n_output_tokens,
+                            ), n_first_dialog_messages_removed
                 answer = str(answer).strip()
+                if use_cache:
+                    response_cache.set(cache_key, answer)
 
-            except openai.error.InvalidRequestError as e:  # too many tokens
+            except load_openai().error.InvalidRequestError as e:  # too many tokens
                 if len(dialog_messages) == 0:
                     raise e
 
@@ -110,26 +381,70 @@ class MedicalGPT(BaseMedicalGPT):
         ), n_first_dialog_messages_removed  # sending final answer
 
 
-class Filter:
-    def medical_condition_message_filter(self, message, condition) -> bool:
+class Filter(BaseMedicalGPT):
+    def _classification_messages(self, message, condition) -> list:
+        condition = " ".join(condition.split("_"))
+        return [
+            {
+                "role": "system",
+                "content": f"Question: is following sentence indicating {condition}?\nSentence: {message}.\nIf you're uncertain, respond with 'no'.\nAnswer: yes/no",
+            },
+        ]
+
+    def medical_condition_message_filter(self, message, condition):
         """
         Given a message from the user, check if user has this medical condition
-        :return: True if user has this medical condition, False otherwise
+        :return: True if user has this medical condition, False otherwise, None when
+        the call was shed by admission control (not known, classify later)
         """
-        condition = condition.split("_")
-        condition = " ".join(condition)
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"Question: is following sentence indicating {condition}?\nSentence: {message}.\nIf you're uncertain, respond with 'no'.\nAnswer: yes/no",
-                },
-            ],
-            stream=False,
-            **OPENAI_COMPLETION_OPTIONS,
+        model = router.classification_model()
+        messages = self._classification_messages(message, condition)
+        if not admission_controller.try_admit(
+            self._estimate_request_tokens(
+                messages, model, CLASSIFICATION_COMPLETION_OPTIONS["max_tokens"]
+            ),
+            lane=BACKGROUND_LANE,
+        ):
+            logger.warning(f"LLM admission: shed classification for {condition}")
+            return None
+        try:
+            # no retries, backoff sleeps here would block the event loop for everyone
+            response = openai_client.create(
+                max_retries=0,
+                call_type="classification",
+                model=model,
+                messages=messages,
+                stream=False,
+                **CLASSIFICATION_COMPLETION_OPTIONS,
+            )
+        finally:
+            admission_controller.release()
+        response = str(response.choices[0].message.content.strip())
+        return "yes" in response.lower()
+
+    async def amedical_condition_message_filter(self, message, condition) -> bool:
+        """
+        For classifications that were shed: waits for admission in the background
+        lane, raises asyncio.TimeoutError after `classification_timeout_seconds`
+        """
+        return await asyncio.wait_for(
+            self._aclassify(message, condition), CLASSIFICATION_TIMEOUT_SECONDS
         )
+
+    async def _aclassify(self, message, condition) -> bool:
+        model = router.classification_model()
+        messages = self._classification_messages(message, condition)
+        async with admission_controller.admit(
+            self._estimate_request_tokens(
+                messages, model, CLASSIFICATION_COMPLETION_OPTIONS["max_tokens"]
+            ),
+            lane=BACKGROUND_LANE,
+        ):
+            response = await openai_client.acreate(
+                call_type="classification",
+                model=model,
+                messages=messages,
+                **CLASSIFICATION_COMPLETION_OPTIONS,
+            )
         response = str(response.choices[0].message.content.strip())
-        if "yes" in response.lower():
-            return True
-        return False
+        return "yes" in response.lower()
@@ -0,0 +1,171 @@
+import contextvars
+import functools
+import logging
+import time
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from telegram.error import RetryAfter
+from telegram.ext import AIORateLimiter
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# openai calls and handlers take seconds, db calls milliseconds
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 34, 60, 120)
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+
+HANDLER_LATENCY = Histogram(
+    "medicalgpt_handler_seconds",
+    "Time spent in a telegram handler",
+    ["handler"],
+    buckets=SLOW_BUCKETS,
+)
+OPENAI_FIRST_TOKEN = Histogram(
+    "medicalgpt_openai_first_token_seconds",
+    "Time until openai streamed the first token, including retries",
+    ["model", "call_type"],
+    buckets=SLOW_BUCKETS,
+)
+OPENAI_DURATION = Histogram(
+    "medicalgpt_openai_duration_seconds",
+    "Total duration of an openai call, including retries",
+    ["model", "call_type"],
+    buckets=SLOW_BUCKETS,
+)
+CLASSIFIER_CALLS = Counter(
+    "medicalgpt_classifier_calls_total",
+    "Medical condition classifier calls",
+    ["disease", "result"],
+)
+REPLY_TOKENS = Histogram(
+    "medicalgpt_reply_tokens",
+    "Tokens used per chat reply",
+    ["model", "direction"],
+    buckets=TOKEN_BUCKETS,
+)
+DB_QUERIES = Counter(
+    "medicalgpt_db_queries_total",
+    "SQL statements, by the outermost MySQL method issuing them",
+    ["method"],
+)
+DB_METHOD_LATENCY = Histogram(
+    "medicalgpt_db_method_seconds",
+    "Duration of MySQL methods",
+    ["method"],
+    buckets=FAST_BUCKETS,
+)
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    "medicalgpt_db_pool_checkout_wait_seconds",
+    "Time waited for a connection from the pool",
+    buckets=FAST_BUCKETS,
+)
+TELEGRAM_EDITS = Counter(
+    "medicalgpt_telegram_edits_total", "edit_message_text calls while streaming"
+)
+TELEGRAM_FLOOD_WAITS = Counter(
+    "medicalgpt_telegram_flood_wait_retries_total",
+    "Telegram requests retried after a RetryAfter (flood wait)",
+)
+MESSAGE_DEBOUNCE = Histogram(
+    "medicalgpt_message_debounce_seconds",
+    "Time a message was held back for the user's next messages, not in its handler's",
+    buckets=FAST_BUCKETS,
+)
+LLM_QUEUE_DEPTH = Gauge(
+    "medicalgpt_llm_admission_queue_depth",
+    "openai calls waiting for admission",
+    ["lane"],
+)
+
+current_db_method = contextvars.ContextVar("current_db_method", default=None)
+# seconds the current handler was deliberately held back, left out of its latency
+handler_held_back = contextvars.ContextVar("handler_held_back", default=None)
+
+
+def start_server():
+    if not config.metrics.get("enabled", False):
+        return
+    port = config.metrics.get("port", 9100)
+    start_http_server(port, addr=config.metrics.get("host", "0.0.0.0"))
+    logger.info(f"Serving metrics on port {port}")
+
+
+def timed_handler(name: str, callback):
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        held_back = [0.0]
+        token = handler_held_back.set(held_back)
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        finally:
+            HANDLER_LATENCY.labels(name).observe(
+                time.perf_counter() - started - held_back[0]
+            )
+            handler_held_back.reset(token)
+
+    return wrapper
+
+
+def observe_debounce(seconds: float):
+    MESSAGE_DEBOUNCE.observe(seconds)
+    held_back = handler_held_back.get()
+    if held_back is not None:
+        held_back[0] += seconds
+
+
+def _timed_db_method(name: str, method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        # statements are counted against the outermost method, e.g. get_instances
+        # calls made by prepare_patient_history count for prepare_patient_history
+        token = current_db_method.set(current_db_method.get() or name)
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            DB_METHOD_LATENCY.labels(name).observe(time.perf_counter() - started)
+            current_db_method.reset(token)
+
+    return wrapper
+
+
+def instrument_db_methods(cls):
+    """
+    Class decorator timing every public method
+    """
+    for name, method in list(vars(cls).items()):
+        if callable(method) and not name.startswith("_"):
+            setattr(cls, name, _timed_db_method(name, method))
+    return cls
+
+
+def count_db_query(conn, cursor, statement, parameters, context, executemany):
+    DB_QUERIES.labels(current_db_method.get() or "other").inc()
+
+
+def instrument_pool(pool):
+    """
+    sqlalchemy has no event for the start of a checkout, so time the pool's getter
+    """
+    do_get = pool._do_get
+
+    def timed_do_get():
+        started = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+    pool._do_get = timed_do_get
+
+
+class InstrumentedRateLimiter(AIORateLimiter):
+    async def _run_request(self, *args, **kwargs):
+        try:
+            return await super()._run_request(*args, **kwargs)
+        except RetryAfter:
+            TELEGRAM_FLOOD_WAITS.inc()
+            raise
@@ -2,12 +2,16 @@ import re
 import uuid
 from typing import Optional
 
-from sqlalchemy import create_engine
+import metrics
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 from tables import (
     Allergy,
     Base,
     Dialog,
+    Disease,
     DiseaseAnswer,
     DiseaseInstructions,
     DiseaseQuestion,
@@ -20,18 +24,121 @@ from tables import (
 
 import config
 
+SQLITE_PRAGMAS = {
+    # readers don't block the writer and vice versa
+    "journal_mode": "WAL",
+    # durable enough with WAL, and far fewer fsyncs
+    "synchronous": "NORMAL",
+    # wait for locks (ms) instead of failing with "database is locked"
+    "busy_timeout": 5000,
+    # 64MB page cache
+    "cache_size": -64000,
+    "temp_store": "MEMORY",
+}
 
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+
+def create_engine_from_uri(uri: str):
+    """
+    Any sqlalchemy url, sqlite gets its own pool settings and pragmas
+    """
+    url = make_url(uri)
+    if url.get_backend_name() != "sqlite":
+        return create_engine(url, pool_recycle=280, pool_pre_ping=True, pool_size=25)
+    engine_kwargs = {"connect_args": {"check_same_thread": False}}
+    if url.database in (None, "", ":memory:"):
+        # every connection to :memory: would be a different empty database
+        engine_kwargs["poolclass"] = StaticPool
+    engine = create_engine(url, **engine_kwargs)
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+
+# one engine (and pool) per url, shared by the MySQL instances of all modules
+_engines = {}
+_disease_catalogs = {}
+
+
+def get_engine(uri: str):
+    engine = _engines.get(uri)
+    if engine is None:
+        engine = create_engine_from_uri(uri)
+        event.listen(engine, "before_cursor_execute", metrics.count_db_query)
+        metrics.instrument_pool(engine.pool)
+        _engines[uri] = engine
+    return engine
+
+
+@metrics.instrument_db_methods
 class MySQL:
-    def __init__(self):
-        self.engine = create_engine(
-            config.mysql_uri, pool_recycle=280, pool_pre_ping=True, pool_size=25
-        )
+    def __init__(self, uri: Optional[str] = None):
+        """
+        Cheap, doesn't connect. Tables are created by `create_tables_if_not_exists`,
+        which the bot calls once at startup.
+        """
+        self.engine = get_engine(uri or config.mysql_uri)
         self.Session = sessionmaker(bind=self.engine)
-        self.create_tables_if_not_exists()
 
     def create_tables_if_not_exists(self):
         Base.metadata.create_all(self.engine)
 
+    def add_missing_columns(self):
+        """
+        create_all skips existing tables, this adds the columns declared since they
+        were created (nullable, the orm fills in their defaults)
+        """
+        inspector = inspect(self.engine)
+        quote = self.engine.dialect.identifier_preparer.quote
+        with self.engine.begin() as conn:
+            for table in Base.metadata.sorted_tables:
+                if not inspector.has_table(table.name):
+                    continue
+                existing = {
+                    column["name"] for column in inspector.get_columns(table.name)
+                }
+                for column in table.columns:
+                    if column.name in existing:
+                        continue
+                    column_type = column.type.compile(dialect=self.engine.dialect)
+                    conn.execute(
+                        text(
+                            f"ALTER TABLE {quote(table.name)} "
+                            f"ADD COLUMN {quote(column.name)} {column_type}"
+                        )
+                    )
+
+    def open_connections(self, n_connections: int):
+        """
+        Fills the pool with `n_connections` connections, so the first updates don't
+        pay for connecting
+        """
+        connections = []
+        try:
+            for _ in range(n_connections):
+                connections.append(self.engine.connect())
+        finally:
+            for connection in connections:
+                connection.close()
+
+    def get_disease_catalog(self, refresh: bool = False) -> list:
+        """
+        Diseases only change between deployments (their filters are registered at
+        startup), so they are read once
+        """
+        if refresh or self.engine not in _disease_catalogs:
+            diseases = self.get_instances(None, Disease, False)
+            if diseases is None:
+                # the query failed, try again next time
+                return []
+            _disease_catalogs[self.engine] = diseases
+        return _disease_catalogs[self.engine]
+
     def check_if_object_exists(
         self, user_id: int, raise_exception: bool = False, model: Base = User
     ) -> bool:
@@ -94,6 +201,134 @@ class MySQL:
             extra_filters={"uid": dialog_id},
         )
 
+    def pop_last_dialog_message(
+        self, user_id: int, dialog_id: Optional[str] = None
+    ) -> Optional[dict]:
+        """
+        Removes the dialog's last turn, in one transaction like `compact_dialog`
+        :return: the removed turn, None if the dialog has none
+        """
+        if dialog_id is None:
+            dialog_id = self.get_attribute(user_id, "current_dialog_id")
+        session = self.Session()
+        try:
+            dialog = (
+                session.query(Dialog)
+                .filter_by(user_id=str(user_id), uid=dialog_id)
+                .with_for_update()
+                .first()
+            )
+            if dialog is None or not dialog.messages:
+                return None
+            messages = list(dialog.messages)
+            last_dialog_message = messages.pop()
+            dialog.messages = messages
+            session.commit()
+            return last_dialog_message
+        finally:
+            session.close()
+
+    def write_replies(self, replies: list) -> dict:
+        """
+        Stores the turns and token usage of many replies in one transaction, in order
+        :param replies: dicts of user_id, dialog_id, turn (None for token usage only),
+        model, n_input_tokens and n_output_tokens
+        :return: dialog uid -> messages, of the dialogs written to
+        """
+        session = self.Session()
+        try:
+            user_ids = {str(reply["user_id"]) for reply in replies}
+            users = {
+                user.user_id: user
+                for user in session.query(User)
+                .filter(User.user_id.in_(user_ids))
+                .with_for_update()
+            }
+            dialog_ids = {
+                reply["dialog_id"] for reply in replies if reply["turn"] is not None
+            }
+            dialogs = {
+                dialog.uid: dialog
+                for dialog in session.query(Dialog)
+                .filter(Dialog.uid.in_(dialog_ids))
+                .with_for_update()
+            }
+            for reply in replies:
+                user_id = str(reply["user_id"])
+                dialog = dialogs.get(reply["dialog_id"])
+                if (
+                    reply["turn"] is not None
+                    and dialog is not None
+                    and dialog.user_id == user_id
+                ):
+                    dialog.messages = list(dialog.messages or []) + [reply["turn"]]
+                user = users.get(user_id)
+                if user is None:
+                    continue
+                # new objects, json columns don't track changes made in place
+                n_used_tokens = dict(user.n_used_tokens or {})
+                usage = dict(
+                    n_used_tokens.get(
+                        reply["model"], {"n_input_tokens": 0, "n_output_tokens": 0}
+                    )
+                )
+                usage["n_input_tokens"] += reply["n_input_tokens"]
+                usage["n_output_tokens"] += reply["n_output_tokens"]
+                n_used_tokens[reply["model"]] = usage
+                user.n_used_tokens = n_used_tokens
+            # read before the commit expires them
+            dialog_messages = {uid: dialog.messages for uid, dialog in dialogs.items()}
+            session.commit()
+            return dialog_messages
+        finally:
+            session.close()
+
+    def get_dialog_summary(self, user_id: int, dialog_id: Optional[str] = None) -> str:
+        if dialog_id is None:
+            dialog_id = self.get_attribute(user_id, "current_dialog_id")
+        return (
+            self.get_attribute(
+                user_id, "summary", model=Dialog, extra_filters={"uid": dialog_id}
+            )
+            or ""
+        )
+
+    def compact_dialog(
+        self,
+        user_id: int,
+        dialog_id: str,
+        turns: list,
+        previous_summary: str,
+        summary: str,
+    ) -> bool:
+        """
+        Replaces `turns`, the first turns of the dialog, with `summary`. Nothing changes
+        if the dialog no longer starts with them or its summary isn't `previous_summary`.
+        :return: whether the dialog was compacted
+        """
+        session = self.Session()
+        try:
+            dialog = (
+                session.query(Dialog)
+                .filter_by(user_id=str(user_id), uid=dialog_id)
+                .with_for_update()
+                .first()
+            )
+            if dialog is None:
+                return False
+            messages = list(dialog.messages or [])
+            if (
+                messages[: len(turns)] != turns
+                or (dialog.summary or "") != previous_summary
+            ):
+                return False
+            dialog.messages = messages[len(turns) :]
+            dialog.summary = summary
+            session.commit()
+            return True
+        finally:
+            session.close()
+
     def get_attribute(
         self, user_id: int, attribute: str, model: Base = User, extra_filters: dict = {}
     ):
@@ -149,6 +384,7 @@ class MySQL:
                 instances = instances.filter_by(**extra_filters)
             if id_greater_than is not None:
                 instances = instances.filter(model.id > id_greater_than)
+                instances = instances.order_by(model.id)
             if find_first:
                 instances = instances.order_by(model.id).first()
             elif find_last:
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({Path(code.co_filename).name}:{frame.f_lineno})"
+
+
+def _task_label(task: asyncio.Task) -> str:
+    coro = task.get_coro()
+    label = getattr(coro, "__qualname__", None) or repr(coro)
+    name = task.get_name()
+    # the default Task-<n> names would split every update into its own stack
+    if not name.startswith("Task-"):
+        label = f"{label} [{name}]"
+    return f"task:{label}"
+
+
+def _task_frames_start(stack: list) -> int:
+    """
+    Index of the first frame after the event loop's Handle._run, which steps the task
+    """
+    for i in range(len(stack) - 1, -1, -1):
+        code = stack[i].f_code
+        if code.co_name == "_run" and code.co_filename.endswith("events.py"):
+            return i + 1
+    return 0
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of the event loop thread from a background thread every
+    `interval` seconds. Samples are prefixed with the asyncio task that was running,
+    so awaits of different handlers are not merged. The result is in the collapsed
+    stack format of flamegraph.pl, speedscope and py-spy.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, interval: float = 0.01):
+        self.loop = loop
+        self.interval = interval
+        self.samples = Counter()
+        self.n_samples = 0
+        # started from a coroutine, so this is the loop's thread
+        self._loop_thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        stack = []
+        while frame is not None:
+            stack.append(frame)
+            frame = frame.f_back
+        stack.reverse()
+        task = asyncio.current_task(self.loop)
+        if task is not None:
+            # drop the event loop frames below the task, they are the same for all
+            stack = stack[_task_frames_start(stack) :]
+            root = _task_label(task)
+        else:
+            root = "event loop"
+        self.samples[";".join([root] + [_frame_label(f) for f in stack])] += 1
+        self.n_samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self._sample()
+            except Exception as e:
+                logger.warning(f"Profiler sample failed: {e!r}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def collapsed(self) -> str:
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.samples.most_common()
+        )
+
+
+_running = None
+
+
+async def profile(seconds: float, interval: float = 0.01) -> SamplingProfiler:
+    """
+    Profiles the running event loop for `seconds`, one profile at a time
+    """
+    global _running
+    if _running is not None:
+        raise RuntimeError("A profile is already running")
+    _running = SamplingProfiler(asyncio.get_running_loop(), interval)
+    started = time.monotonic()
+    _running.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler, _running = _running, None
+        profiler.stop()
+    logger.info(
+        f"Profiled {time.monotonic() - started:.1f}s, {profiler.n_samples} samples"
+    )
+    return profiler
@@ -0,0 +1,145 @@
+import contextlib
+import contextvars
+import logging
+import re
+import time
+import traceback
+from collections import Counter
+from pathlib import Path
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import config
+
+logger = logging.getLogger(__name__)
+
+BOT_DIR = str(Path(__file__).resolve().parent)
+# frames of these modules only wrap the data layer, the call site is further up
+INSTRUMENTATION_MODULES = ("querylog.py", "metrics.py", "tracing.py")
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*(?:\?|%s|:\w+)(?:\s*,\s*(?:\?|%s|:\w+))+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def statement_shape(statement: str) -> str:
+    """
+    The statement with literals and IN lists collapsed, so the same query for
+    different rows has the same shape
+    """
+    shape = _STRING_LITERAL.sub("?", statement)
+    shape = _NUMBER_LITERAL.sub("?", shape)
+    shape = _PLACEHOLDER_LIST.sub("(?)", shape)
+    return _WHITESPACE.sub(" ", shape).strip()
+
+
+def call_site(depth: int = 2) -> str:
+    """
+    The innermost `depth` frames of the bot's own code that lead to the statement
+    """
+    frames = [
+        frame
+        for frame in traceback.extract_stack()
+        if frame.filename.startswith(BOT_DIR)
+        and not frame.filename.endswith(INSTRUMENTATION_MODULES)
+    ]
+    return " <- ".join(
+        f"{Path(frame.filename).name}:{frame.lineno} in {frame.name}"
+        for frame in reversed(frames[-depth:])
+    )
+
+
+class Scope:
+    """
+    Statements of one logical operation, e.g. a telegram update
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.n_statements = 0
+        self.shapes = Counter()
+        self.call_sites = {}
+
+
+current_scope = contextvars.ContextVar("current_query_scope", default=None)
+
+
+class QueryLog:
+    """
+    Opt-in data layer instrumentation. Logs statements slower than `slow_query_ms`, and
+    warns once per operation about every statement shape executed more than
+    `repeated_statement_threshold` times within it, the usual sign of an N+1 loop.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        slow_query_ms: float = 100,
+        repeated_statement_threshold: int = 5,
+    ):
+        self.enabled = enabled
+        self.slow_query_seconds = slow_query_ms / 1000
+        self.repeated_statement_threshold = repeated_statement_threshold
+
+    def install(self):
+        # every engine, the bot modules create their own MySQL instances
+        event.listen(Engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(Engine, "handle_error", self._handle_error)
+
+    def _before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault("query_log_started", []).append(time.perf_counter())
+
+    def _after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        started = conn.info["query_log_started"].pop()
+        duration = time.perf_counter() - started
+        if duration >= self.slow_query_seconds:
+            logger.warning(
+                f"Slow query ({duration * 1000:.1f}ms) at {call_site()}: "
+                f"{statement_shape(statement)[:500]}"
+            )
+        scope = current_scope.get()
+        if scope is None:
+            return
+        scope.n_statements += 1
+        shape = statement_shape(statement)
+        scope.shapes[shape] += 1
+        if scope.shapes[shape] == self.repeated_statement_threshold + 1:
+            scope.call_sites[shape] = call_site()
+
+    def _handle_error(self, exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_log_started"):
+            conn.info["query_log_started"].pop()
+
+    @contextlib.contextmanager
+    def scope(self, name: str):
+        if not self.enabled:
+            yield None
+            return
+        scope = Scope(name)
+        token = current_scope.set(scope)
+        try:
+            yield scope
+        finally:
+            current_scope.reset(token)
+            self._report(scope)
+
+    def _report(self, scope: Scope):
+        for shape, site in scope.call_sites.items():
+            logger.warning(
+                f"Possible N+1 in {scope.name}: statement executed "
+                f"{scope.shapes[shape]} times ({scope.n_statements} statements in "
+                f"total) at {site}: {shape[:500]}"
+            )
+
+
+query_log = QueryLog(**config.query_log)
+if query_log.enabled:
+    query_log.install()
@@ -0,0 +1,322 @@
+import asyncio
+import functools
+import logging
+import random
+import time
+
+import metrics
+from tracing import tracer
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def load_openai():
+    """
+    openai is imported on first use (or by the startup warm-up), importing it takes
+    about a third of the bot's import time
+    """
+    import openai
+
+    openai.api_key = config.openai_api_key
+    if config.openai_api_base:
+        openai.api_base = config.openai_api_base
+    return openai
+
+
+@functools.lru_cache(maxsize=None)
+def retryable_errors() -> tuple:
+    """
+    Errors worth retrying: throttling, timeouts, 5xx and dropped connections
+    """
+    openai = load_openai()
+    return (
+        openai.error.RateLimitError,
+        openai.error.Timeout,
+        openai.error.TryAgain,
+        openai.error.APIError,
+        openai.error.ServiceUnavailableError,
+        openai.error.APIConnectionError,
+        asyncio.TimeoutError,
+    )
+
+
+class LLMUnavailableError(Exception):
+    """
+    Raised when openai could not be reached after all retries
+    """
+
+
+class CircuitOpenError(LLMUnavailableError):
+    """
+    Raised without calling openai while the circuit breaker is open
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures, so calls fail fast instead of
+    piling up. After `reset_timeout` seconds a single trial call is let through, and
+    its outcome closes or re-opens the circuit.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    def before_call(self) -> bool:
+        """
+        :return: whether this call is the trial call of the half-open circuit
+        """
+        if self.state == self.CLOSED:
+            return False
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError("OpenAI circuit is open, failing fast")
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+        if self._trial_in_flight:
+            raise CircuitOpenError("OpenAI circuit is half-open, trial call in flight")
+        self._trial_in_flight = True
+        return True
+
+    def abandon_trial(self):
+        """
+        The trial call ended without an outcome (cancelled, the stream was dropped or
+        an unexpected error), the next call becomes the trial
+        """
+        self._trial_in_flight = False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("OpenAI circuit closed")
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self._consecutive_failures += 1
+        self._trial_in_flight = False
+        if (
+            self.state == self.HALF_OPEN
+            or self._consecutive_failures >= self.failure_threshold
+        ):
+            if self.state != self.OPEN:
+                logger.warning(
+                    f"OpenAI circuit opened after {self._consecutive_failures} consecutive failures"
+                )
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+
+class ResilientOpenAI:
+    """
+    Wrapper around openai.ChatCompletion with jittered exponential backoff, per-attempt
+    timeouts, a time-to-first-token timeout for streams and a shared circuit breaker.
+    Non-retryable errors (e.g. InvalidRequestError) are raised unchanged.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 3,
+        backoff_base_seconds: float = 0.5,
+        backoff_max_seconds: float = 8.0,
+        request_timeout: float = 60.0,
+        first_token_timeout: float = 20.0,
+        stream_idle_timeout: float = 30.0,
+        circuit_failure_threshold: int = 5,
+        circuit_reset_timeout: float = 30.0,
+    ):
+        self.max_retries = max(0, int(max_retries))
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.request_timeout = request_timeout
+        self.first_token_timeout = first_token_timeout
+        self.stream_idle_timeout = stream_idle_timeout
+        self.breaker = CircuitBreaker(circuit_failure_threshold, circuit_reset_timeout)
+
+    def _backoff(self, attempt: int) -> float:
+        # "full jitter", spreads retries of many users hitting the same outage
+        return random.uniform(
+            0,
+            min(self.backoff_max_seconds, self.backoff_base_seconds * 2**attempt),
+        )
+
+    def _on_retryable_error(self, error: Exception, attempt: int, max_retries: int):
+        self.breaker.record_failure()
+        # no point in backing off once this failure opened the circuit
+        if attempt >= max_retries or self.breaker.state == CircuitBreaker.OPEN:
+            raise LLMUnavailableError(
+                f"OpenAI call failed after {attempt + 1} attempts: {error!r}"
+            ) from error
+        logger.warning(
+            f"OpenAI call failed (attempt {attempt + 1}), retrying: {error!r}"
+        )
+
+    async def acreate(self, max_retries: int = None, call_type: str = "chat", **kwargs):
+        with tracer.span(f"openai.{call_type}", model=kwargs.get("model")) as span:
+            return await self._acreate(max_retries, call_type, span, **kwargs)
+
+    async def _acreate(self, max_retries, call_type, span, **kwargs):
+        max_retries = self.max_retries if max_retries is None else max_retries
+        started = time.perf_counter()
+        for attempt in range(max_retries + 1):
+            is_trial = self.breaker.before_call()
+            if span is not None:
+                span.set(attempts=attempt + 1)
+            try:
+                response = await asyncio.wait_for(
+                    load_openai().ChatCompletion.acreate(
+                        request_timeout=self.request_timeout, **kwargs
+                    ),
+                    self.request_timeout,
+                )
+            except retryable_errors() as e:
+                self._on_retryable_error(e, attempt, max_retries)
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            except load_openai().error.OpenAIError:
+                # openai answered, it is healthy
+                self.breaker.record_success()
+                raise
+            except BaseException:
+                if is_trial:
+                    self.breaker.abandon_trial()
+                raise
+            self.breaker.record_success()
+            metrics.OPENAI_DURATION.labels(kwargs.get("model"), call_type).observe(
+                time.perf_counter() - started
+            )
+            return response
+
+    def create(self, max_retries: int = None, call_type: str = "chat", **kwargs):
+        """
+        Blocking variant, backoff sleeps block the calling thread
+        """
+        with tracer.span(f"openai.{call_type}", model=kwargs.get("model")) as span:
+            return self._create(max_retries, call_type, span, **kwargs)
+
+    def _create(self, max_retries, call_type, span, **kwargs):
+        max_retries = self.max_retries if max_retries is None else max_retries
+        started = time.perf_counter()
+        for attempt in range(max_retries + 1):
+            is_trial = self.breaker.before_call()
+            if span is not None:
+                span.set(attempts=attempt + 1)
+            try:
+                response = load_openai().ChatCompletion.create(
+                    request_timeout=self.request_timeout, **kwargs
+                )
+            except retryable_errors() as e:
+                self._on_retryable_error(e, attempt, max_retries)
+                time.sleep(self._backoff(attempt))
+                continue
+            except load_openai().error.OpenAIError:
+                self.breaker.record_success()
+                raise
+            except BaseException:
+                if is_trial:
+                    self.breaker.abandon_trial()
+                raise
+            self.breaker.record_success()
+            metrics.OPENAI_DURATION.labels(kwargs.get("model"), call_type).observe(
+                time.perf_counter() - started
+            )
+            return response
+
+    async def _open_stream(self, kwargs):
+        r_gen = await load_openai().ChatCompletion.acreate(
+            stream=True, request_timeout=self.request_timeout, **kwargs
+        )
+        try:
+            first_item = await r_gen.__anext__()
+        except StopAsyncIteration:
+            first_item = None
+        return r_gen, first_item
+
+    async def stream(self, max_retries: int = None, call_type: str = "chat", **kwargs):
+        """
+        Streams completion chunks. Attempts are only retried until the first token
+        arrived, a stream failing half way raises LLMUnavailableError.
+        """
+        # not made the current span, the consumer runs between the chunks
+        span = tracer.start_span(
+            f"openai.{call_type}", model=kwargs.get("model"), stream=True
+        )
+        error = None
+        r_gen = self._stream(max_retries, call_type, span, **kwargs)
+        try:
+            async for r_item in r_gen:
+                yield r_item
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # right away when the consumer stops reading, so a trial call is released
+            await r_gen.aclose()
+            if span is not None:
+                span.end(error)
+
+    async def _stream(self, max_retries, call_type, span, **kwargs):
+        max_retries = self.max_retries if max_retries is None else max_retries
+        model = kwargs.get("model")
+        started = time.perf_counter()
+        for attempt in range(max_retries + 1):
+            is_trial = self.breaker.before_call()
+            if span is not None:
+                span.set(attempts=attempt + 1)
+            try:
+                r_gen, first_item = await asyncio.wait_for(
+                    self._open_stream(kwargs), self.first_token_timeout
+                )
+            except retryable_errors() as e:
+                self._on_retryable_error(e, attempt, max_retries)
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            except load_openai().error.OpenAIError:
+                self.breaker.record_success()
+                raise
+            except BaseException:
+                if is_trial:
+                    self.breaker.abandon_trial()
+                raise
+            break
+        first_token_seconds = time.perf_counter() - started
+        metrics.OPENAI_FIRST_TOKEN.labels(model, call_type).observe(first_token_seconds)
+        if span is not None:
+            span.set(first_token_ms=round(first_token_seconds * 1000, 3))
+        if first_item is None:
+            self.breaker.record_success()
+            return
+        try:
+            yield first_item
+            while True:
+                try:
+                    r_item = await asyncio.wait_for(
+                        r_gen.__anext__(), self.stream_idle_timeout
+                    )
+                except StopAsyncIteration:
+                    break
+                yield r_item
+        except retryable_errors() as e:
+            self.breaker.record_failure()
+            raise LLMUnavailableError(f"OpenAI stream interrupted: {e!r}") from e
+        except BaseException:
+            # cancelled, or the consumer stopped reading
+            if is_trial:
+                self.breaker.abandon_trial()
+            raise
+        self.breaker.record_success()
+        metrics.OPENAI_DURATION.labels(model, call_type).observe(
+            time.perf_counter() - started
+        )
@@ -0,0 +1,153 @@
+import hashlib
+import math
+import re
+from collections import Counter, OrderedDict
+
+from router import router
+
+import config
+
+_TOKEN = re.compile(r"[a-z0-9']+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by do does for from had has have i i'm in is it its "
+    "me my of on or so that the this to was were what with you your".split()
+)
+
+
+def tokenize(text: str) -> list:
+    return [token for token in _TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def turn_text(turn: dict) -> str:
+    return f"{turn['user']}\n{turn['bot']}"
+
+
+def turn_hash(turn: dict) -> str:
+    return hashlib.sha1(turn_text(turn).encode("utf-8")).hexdigest()
+
+
+class BM25Index:
+    """
+    Okapi BM25 over the turns of one dialog, turns are added as they're appended
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_counts = []
+        self.lengths = []
+        self.document_frequency = Counter()
+        # to check that the indexed turns are still the dialog's first turns
+        self.turn_hashes = []
+
+    def __len__(self) -> int:
+        return len(self.term_counts)
+
+    def add(self, turn: dict):
+        term_counts = Counter(tokenize(turn_text(turn)))
+        self.term_counts.append(term_counts)
+        self.lengths.append(sum(term_counts.values()))
+        self.document_frequency.update(term_counts.keys())
+        self.turn_hashes.append(turn_hash(turn))
+
+    def scores(self, query: str) -> list:
+        n_documents = len(self)
+        average_length = sum(self.lengths) / n_documents if n_documents else 0
+        query_terms = set(tokenize(query))
+        scores = []
+        for term_counts, length in zip(self.term_counts, self.lengths):
+            score = 0.0
+            for term in query_terms:
+                frequency = term_counts.get(term, 0)
+                if not frequency:
+                    continue
+                n_containing = self.document_frequency[term]
+                idf = math.log(
+                    1 + (n_documents - n_containing + 0.5) / (n_containing + 0.5)
+                )
+                norm = self.k1 * (1 - self.b + self.b * length / (average_length or 1))
+                score += idf * frequency * (self.k1 + 1) / (frequency + norm)
+            scores.append(score)
+        return scores
+
+
+class DialogRetriever:
+    """
+    Picks the past turns sent with a message in long dialogs: the last `recent_turns`
+    turns, then the `top_k` older turns most relevant to the message by BM25, within
+    `max_tokens`. Dialogs shorter than `min_turns` are sent whole. One index per user,
+    kept for the `max_dialogs` most recently active users.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        min_turns: int = 8,
+        recent_turns: int = 4,
+        top_k: int = 3,
+        max_tokens: int = 1500,
+        max_dialogs: int = 1000,
+    ):
+        self.enabled = enabled
+        self.min_turns = min_turns
+        self.recent_turns = recent_turns
+        self.top_k = top_k
+        self.max_tokens = max_tokens
+        self.max_dialogs = max_dialogs
+        self._indexes = OrderedDict()
+
+    def _index_for(self, user_id: int, dialog_messages: list) -> BM25Index:
+        index = self._indexes.pop(user_id, None)
+        if (
+            index is None
+            or len(index) > len(dialog_messages)
+            or any(
+                indexed != turn_hash(turn)
+                for indexed, turn in zip(index.turn_hashes, dialog_messages)
+            )
+        ):
+            # another dialog, or its turns were compacted or retried
+            index = BM25Index()
+        for turn in dialog_messages[len(index) :]:
+            index.add(turn)
+        self._indexes[user_id] = index
+        while len(self._indexes) > self.max_dialogs:
+            self._indexes.popitem(last=False)
+        return index
+
+    def select(
+        self, user_id: int, dialog_messages: list, message: str, model: str
+    ) -> list:
+        """
+        :return: the selected turns, in dialog order
+        """
+        if not self.enabled or user_id is None or len(dialog_messages) < self.min_turns:
+            return dialog_messages
+        index = self._index_for(user_id, dialog_messages)
+        encoding = router.encoding_for(model)
+        # min_turns may be at most recent_turns, then there's no older turn
+        n_older = max(0, len(dialog_messages) - self.recent_turns)
+        scores = index.scores(message)
+        relevant = sorted(
+            (i for i in range(n_older) if scores[i] > 0),
+            key=lambda i: scores[i],
+            reverse=True,
+        )[: self.top_k]
+        # the recent turns newest first (the last one always), then the relevant ones
+        selected = set()
+        n_tokens = 0
+        for i in range(len(dialog_messages) - 1, n_older - 1, -1):
+            turn_tokens = len(encoding.encode(turn_text(dialog_messages[i])))
+            if selected and n_tokens + turn_tokens > self.max_tokens:
+                break
+            selected.add(i)
+            n_tokens += turn_tokens
+        for i in relevant:
+            turn_tokens = len(encoding.encode(turn_text(dialog_messages[i])))
+            if n_tokens + turn_tokens <= self.max_tokens:
+                selected.add(i)
+                n_tokens += turn_tokens
+        return [dialog_messages[i] for i in sorted(selected)]
+
+
+dialog_retriever = DialogRetriever(**config.dialog_retrieval)
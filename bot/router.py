@@ -0,0 +1,92 @@
+import config
+
+DEFAULT_MODELS = {
+    "gpt-4": {"context_limit": 8192, "encoding": "cl100k_base"},
+    "gpt-3.5-turbo": {"context_limit": 4096, "encoding": "cl100k_base"},
+}
+DEFAULT_ROUTES = {
+    "chat": "gpt-4",
+    "short_reply": None,
+    "classification": "gpt-4",
+    "summary": "gpt-3.5-turbo",
+}
+
+
+class ModelRouter:
+    """
+    Picks the model for every openai call, and knows each model's context limit and
+    token encoding.
+    - classification always uses the `classification` route
+    - dialog summaries always use the `summary` route
+    - chat uses the user's current_model (falling back to the `chat` route), except
+      short follow-up messages outside a diagnosis, which use the `short_reply` route
+      when it's set (off by default, it overrides the user's current_model)
+    Every route must name one of `models`, checked at startup.
+    """
+
+    def __init__(
+        self,
+        models: dict = None,
+        routes: dict = None,
+        short_reply_max_chars: int = 40,
+    ):
+        self.models = models or DEFAULT_MODELS
+        self.routes = {**DEFAULT_ROUTES, **(routes or {})}
+        self.short_reply_max_chars = short_reply_max_chars
+        self._encodings = {}
+        for route in DEFAULT_ROUTES:
+            model = self.routes[route]
+            if model and model not in self.models:
+                raise ValueError(
+                    f"model_routes.{route} is {model!r}, which is not one of the "
+                    f"models: {sorted(self.models)}"
+                )
+
+    def _known_model(self, model) -> str:
+        if model in self.models:
+            return model
+        return self.routes["chat"]
+
+    def context_limit(self, model: str) -> int:
+        return self.models[self._known_model(model)]["context_limit"]
+
+    def encoding_for(self, model: str):
+        model = self._known_model(model)
+        if model not in self._encodings:
+            # imported on first use, loading an encoding can download it
+            import tiktoken
+
+            self._encodings[model] = tiktoken.get_encoding(
+                self.models[model]["encoding"]
+            )
+        return self._encodings[model]
+
+    def classification_model(self) -> str:
+        return self._known_model(self.routes["classification"])
+
+    def summary_model(self) -> str:
+        return self._known_model(self.routes["summary"])
+
+    def chat_model(
+        self,
+        current_model: str = None,
+        message: str = "",
+        disease_id: int = None,
+        n_dialog_messages: int = 0,
+    ) -> str:
+        if (
+            self.routes["short_reply"]
+            and disease_id is None
+            # the first message of a dialog usually describes the complaint
+            and n_dialog_messages > 0
+            and len(message or "") <= self.short_reply_max_chars
+        ):
+            return self._known_model(self.routes["short_reply"])
+        return self._known_model(current_model)
+
+
+router = ModelRouter(
+    models=config.models,
+    routes=config.model_routes,
+    short_reply_max_chars=config.model_routes.get("short_reply_max_chars", 40),
+)
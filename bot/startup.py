@@ -0,0 +1,82 @@
+import contextlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """
+    Times the startup phases, logged once the bot is ready to serve updates
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - started
+
+    def run_concurrently(self, phases: dict):
+        """
+        Runs the functions of `phases` in threads at the same time. A failing phase is
+        only logged, whatever it prepares is loaded again on first use.
+        """
+
+        def run(name, fn):
+            with self.phase(name):
+                try:
+                    fn()
+                except Exception as e:
+                    logger.warning(f"Startup phase {name} failed: {e!r}")
+
+        with ThreadPoolExecutor(max_workers=len(phases)) as executor:
+            for future in [executor.submit(run, *phase) for phase in phases.items()]:
+                future.result()
+
+    def report(self, total_phase: str = "ready"):
+        self.phases[total_phase] = time.perf_counter() - self.started
+        logger.info(
+            "Startup: "
+            + ", ".join(
+                f"{name} {seconds * 1000:.0f}ms"
+                for name, seconds in self.phases.items()
+            )
+        )
+
+
+startup_timer = StartupTimer()
+
+
+def warm_up(mysql_db):
+    """
+    Everything the first updates would otherwise pay for, in parallel: the openai
+    import, the tiktoken encodings, pool connections, the disease catalog and bookings
+    """
+    from bookings import booking_state
+    from resilience import load_openai
+    from router import router
+
+    def load_encodings():
+        for model in router.models:
+            router.encoding_for(model)
+
+    startup_timer.run_concurrently(
+        {
+            "openai": load_openai,
+            "tiktoken": load_encodings,
+            "pool": lambda: mysql_db.open_connections(
+                config.startup.get("pool_connections", 4)
+            ),
+            "catalog": mysql_db.get_disease_catalog,
+            "bookings": booking_state.load,
+        }
+    )
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+
+import medicalgpt
+from mysql import MySQL
+from router import router
+
+import config
+
+mysql_db = MySQL()
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "You keep a running summary of a conversation between a patient and a medical "
+    "assistant. Keep every clinically relevant fact: symptoms with their onset, "
+    "duration and severity, conditions, medications, allergies, test results, the "
+    "advice given and open questions. Be concise, write in the third person and "
+    "answer with the summary only."
+)
+
+
+class DialogSummarizer:
+    """
+    Keeps prompts bounded in long dialogs: once the stored turns of a dialog pass
+    `max_dialog_tokens`, all but the last `keep_recent_turns` are folded into
+    Dialog.summary by the summary model. Runs in the background after a reply was
+    sent, in the background admission lane.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        max_dialog_tokens: int = 3000,
+        keep_recent_turns: int = 12,
+        max_summary_tokens: int = 400,
+    ):
+        self.enabled = enabled
+        self.max_dialog_tokens = max_dialog_tokens
+        self.keep_recent_turns = keep_recent_turns
+        self.max_summary_tokens = max_summary_tokens
+        self._in_progress = set()
+        self._tasks = set()
+
+    def dialog_tokens(self, dialog_messages: list, model: str) -> int:
+        encoding = router.encoding_for(model)
+        return sum(
+            len(encoding.encode(turn["user"])) + len(encoding.encode(turn["bot"]))
+            for turn in dialog_messages
+        )
+
+    def maybe_compact(self, user_id: int, dialog_id: str, dialog_messages: list):
+        """
+        Starts a compaction of the dialog if it's too long, doesn't wait for it
+        """
+        if (
+            not self.enabled
+            or dialog_id in self._in_progress
+            or len(dialog_messages) <= self.keep_recent_turns
+            or self.dialog_tokens(dialog_messages, router.summary_model())
+            <= self.max_dialog_tokens
+        ):
+            return
+        self._in_progress.add(dialog_id)
+        task = asyncio.create_task(self._compact(user_id, dialog_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self):
+        """
+        Waits for the compactions in flight
+        """
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _compact(self, user_id: int, dialog_id: str):
+        try:
+            dialog_messages = mysql_db.get_dialog_messages(user_id, dialog_id)
+            previous_summary = mysql_db.get_dialog_summary(user_id, dialog_id)
+            turns = dialog_messages[: -self.keep_recent_turns]
+            summary = previous_summary
+            for chunk in self._chunks(turns):
+                summary = await self._summarize(user_id, summary, chunk)
+            if mysql_db.compact_dialog(
+                user_id, dialog_id, turns, previous_summary, summary
+            ):
+                logger.info(f"Folded {len(turns)} turns of dialog {dialog_id}")
+        except Exception as e:
+            logger.warning(f"Dialog compaction failed: {e!r}")
+        finally:
+            self._in_progress.discard(dialog_id)
+
+    def _chunks(self, turns: list):
+        """
+        Turns in groups that fit the summary model's context with the summary, a
+        turn too long for the context on its own is truncated
+        """
+        model = router.summary_model()
+        budget = router.context_limit(model) - 3 * self.max_summary_tokens
+        chunk, n_tokens = [], 0
+        for turn in turns:
+            turn_tokens = self.dialog_tokens([turn], model)
+            if turn_tokens > budget:
+                turn = self._truncate(turn, budget, model)
+                turn_tokens = self.dialog_tokens([turn], model)
+            if chunk and n_tokens + turn_tokens > budget:
+                yield chunk
+                chunk, n_tokens = [], 0
+            chunk.append(turn)
+            n_tokens += turn_tokens
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def _truncate(turn: dict, budget: int, model: str) -> dict:
+        """
+        Cuts the turn down to `budget` tokens, the longer side loses the most
+        """
+        encoding = router.encoding_for(model)
+        user_tokens = encoding.encode(turn["user"])
+        bot_tokens = encoding.encode(turn["bot"])
+        n_user = min(len(user_tokens), max(budget // 2, budget - len(bot_tokens)))
+        n_bot = budget - n_user
+        return {
+            **turn,
+            "user": encoding.decode(user_tokens[:n_user]),
+            "bot": encoding.decode(bot_tokens[:n_bot]),
+        }
+
+    async def _summarize(self, user_id: int, summary: str, turns: list) -> str:
+        model = router.summary_model()
+        transcript = "\n".join(
+            f"Patient: {turn['user']}\nAssistant: {turn['bot']}" for turn in turns
+        )
+        messages = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {
+                "role": "user",
+                "content": f"Summary so far:\n{summary or 'none'}\n\n"
+                f"Next turns:\n{transcript}\n\nThe updated summary:",
+            },
+        ]
+        gpt = medicalgpt.BaseMedicalGPT()
+        n_input_tokens = gpt._count_input_tokens(messages, model)
+        async with medicalgpt.admission_controller.admit(
+            n_input_tokens + self.max_summary_tokens, lane=medicalgpt.BACKGROUND_LANE
+        ):
+            response = await medicalgpt.openai_client.acreate(
+                call_type="summary",
+                model=model,
+                messages=messages,
+                temperature=0,
+                max_tokens=self.max_summary_tokens,
+            )
+        summary = response.choices[0].message.content.strip()
+        mysql_db.update_n_used_tokens(
+            user_id,
+            model,
+            n_input_tokens,
+            gpt._count_output_tokens(summary, model),
+        )
+        return summary
+
+
+dialog_summarizer = DialogSummarizer(**config.dialog_summary)
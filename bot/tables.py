@@ -2,10 +2,13 @@ from datetime import datetime
 
 from sqlalchemy import (
     JSON,
+    BigInteger,
     Boolean,
     Column,
     DateTime,
+    Float,
     ForeignKey,
+    Index,
     Integer,
     String,
     Text,
@@ -17,6 +20,8 @@ Base = declarative_base()
 
 class User(Base):
     __tablename__ = "user"
+    # cal.com bookings are matched by username, mysql indexes TEXT by a prefix
+    __table_args__ = (Index("ix_user_username", "username", mysql_length=191),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(String(255), nullable=False, unique=True)
@@ -82,6 +87,30 @@ class Dialog(Base):
     start_time = Column(DateTime, default=datetime.utcnow)
     model = Column(Text, default="gpt-4")
     messages = Column(JSON, default=[])
+    # the turns folded out of `messages` by summarizer.py
+    summary = Column(Text, default="")
+
+
+class DialogArchive(Base):
+    """
+    Where an archived dialog is stored (archiver.py): a gzip/zstd frame at `offset`
+    of the segment file, holding the dialogs archived with it
+    """
+
+    __tablename__ = "dialog_archive"
+    __table_args__ = (
+        Index("ix_dialog_archive_uid", "uid", mysql_length=64),
+        Index("ix_dialog_archive_user_id", "user_id", mysql_length=32),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    uid = Column(Text, nullable=False)
+    user_id = Column(Text, nullable=False)
+    start_time = Column(DateTime)
+    segment = Column(String(64), nullable=False)
+    offset = Column(BigInteger, nullable=False)
+    length = Column(Integer, nullable=False)
+    timestamp = Column(DateTime, default=datetime.utcnow)
 
 
 class Disease(Base):
@@ -101,6 +130,8 @@ class DiseaseQuestion(Base):
     prescribe = Column(Text, default="")
     filter = Column(Text, default="")
     value = Column(Text, default="")
+    # added to the prescription when the question's filter matches
+    additional_instructions = Column(Text, default="")
     disease_id = Column(Integer, ForeignKey("disease.id"))
     timestamp = Column(DateTime, default=datetime.utcnow)
 
@@ -156,8 +187,58 @@ class Disposition(Base):
 
 class Booking(Base):
     __tablename__ = "booking"
+    __table_args__ = (
+        # a webhook retried concurrently books the event once
+        Index("ux_booking_event_id", "event_id", unique=True, mysql_length=64),
+        Index("ix_booking_user_id", "user_id", mysql_length=32),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Text, nullable=False)
     event_id = Column(Text, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
+
+
+class BookingEvent(Base):
+    """
+    Append-only log of booking changes, written by the cal.com webhook together with
+    the booking, and followed by the bot (bookings.py)
+    """
+
+    __tablename__ = "booking_event"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Text, nullable=False)
+    event_id = Column(Text, nullable=False)
+    action = Column(String(16), nullable=False)  # created or cancelled
+    timestamp = Column(DateTime, default=datetime.utcnow)
+
+
+class RedditAskDocs(Base):
+    __tablename__ = "reddit_ask_docs"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    post_id = Column(String(16), unique=True)
+    title = Column(Text, nullable=False)
+    # sha256 of the normalized title, reposts of a title are stored once
+    title_hash = Column(String(64), unique=True)
+    created_utc = Column(Float)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+
+
+class RedditIngestCursor(Base):
+    """
+    Progress of scripts/reddit.py per listing, committed with every batch
+    """
+
+    __tablename__ = "reddit_ingest_cursor"
+
+    listing = Column(String(32), primary_key=True)
+    # fullname of the last post stored by a run which didn't finish
+    after = Column(String(32))
+    # that run stops at posts created before this, and ends with this high-water mark
+    stop_at_utc = Column(Float)
+    run_newest_utc = Column(Float)
+    # newest post of the last finished run
+    newest_utc = Column(Float)
+    timestamp = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
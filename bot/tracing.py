@@ -0,0 +1,325 @@
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from typing import Optional
+
+import metrics
+from querylog import query_log
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+
+import config
+
+logger = logging.getLogger(__name__)
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Trace:
+    """
+    Spans of one telegram update, exported together once the root span ended
+    """
+
+    def __init__(self, sampled: bool):
+        self.trace_id = os.urandom(16).hex()
+        self.sampled = sampled
+        self.spans = []
+
+
+class Span:
+    def __init__(self, trace: Trace, name: str, parent: "Span" = None, **attributes):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.name = name
+        self.attributes = attributes
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, error: Exception = None):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.error = repr(error)
+        self.trace.spans.append(self)
+
+    @property
+    def duration(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start_ns / 1e9,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class FileExporter:
+    """
+    One json line per span
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: list):
+        with open(self.path, "a") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OTLPExporter:
+    """
+    OTLP/HTTP with the json encoding, accepted by the opentelemetry collector, jaeger,
+    tempo, ... at `<endpoint>/v1/traces`
+    """
+
+    def __init__(self, endpoint: str, service_name: str = "medicalgpt"):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.service_name = service_name
+
+    def _span(self, span: Span) -> dict:
+        otlp_span = {
+            "traceId": span.trace.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            # SPAN_KIND_INTERNAL
+            "kind": 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in span.attributes.items()
+                if value is not None
+            ],
+            # STATUS_CODE_ERROR / STATUS_CODE_UNSET
+            "status": {"code": 2, "message": span.error} if span.error else {},
+        }
+        if span.parent_id is not None:
+            otlp_span["parentSpanId"] = span.parent_id
+        return otlp_span
+
+    def export(self, spans: list):
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": self.service_name},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": __name__},
+                            "spans": [self._span(span) for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(payload, default=str).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+
+
+class Tracer:
+    """
+    Head sampling keeps `sample_ratio` of the traces. With `slow_trace_seconds` set
+    every trace is recorded, and the unsampled ones are still kept when they were slow.
+    Finished traces are exported from a background thread, never on the event loop.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        sample_ratio: float = 0.1,
+        slow_trace_seconds: Optional[float] = None,
+        exporter: str = "file",
+        file_path: str = "traces.jsonl",
+        otlp_endpoint: str = "http://localhost:4318",
+        service_name: str = "medicalgpt",
+        max_queued_traces: int = 1000,
+    ):
+        self.enabled = enabled
+        self.sample_ratio = sample_ratio
+        self.slow_trace_seconds = slow_trace_seconds
+        if exporter == "otlp":
+            self.exporter = OTLPExporter(otlp_endpoint, service_name)
+        else:
+            self.exporter = FileExporter(file_path)
+        self._queue = queue.Queue(maxsize=max_queued_traces)
+        self._thread = None
+
+    def _export_forever(self):
+        while True:
+            spans = self._queue.get()
+            try:
+                self.exporter.export(spans)
+            except Exception as e:
+                logger.warning(f"Could not export {len(spans)} spans: {e!r}")
+
+    def _submit(self, spans: list):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._export_forever, name="trace-exporter", daemon=True
+            )
+            self._thread.start()
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            logger.warning("Trace export queue is full, dropping a trace")
+
+    @contextlib.contextmanager
+    def trace(self, name: str, **attributes):
+        """
+        Root span, everything traced inside becomes its descendant
+        """
+        if not self.enabled:
+            yield None
+            return
+        sampled = random.random() < self.sample_ratio
+        if not sampled and self.slow_trace_seconds is None:
+            yield None
+            return
+        root = Span(Trace(sampled), name, **attributes)
+        token = current_span.set(root)
+        error = None
+        try:
+            yield root
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            current_span.reset(token)
+            root.end(error)
+            if sampled or root.duration >= self.slow_trace_seconds:
+                self._submit(root.trace.spans)
+
+    def start_span(self, name: str, **attributes) -> Optional[Span]:
+        """
+        Child of the current span, which must be ended by the caller.
+        None when nothing is being traced.
+        """
+        parent = current_span.get()
+        if parent is None:
+            return None
+        return Span(parent.trace, name, parent, **attributes)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        span = self.start_span(name, **attributes)
+        if span is None:
+            yield None
+            return
+        token = current_span.set(span)
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            current_span.reset(token)
+            span.end(error)
+
+
+tracer = Tracer(**config.tracing)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    span = tracer.start_span(
+        "db.query",
+        statement=statement[:500],
+        method=metrics.current_db_method.get(),
+        executemany=executemany,
+    )
+    if span is not None:
+        conn.info.setdefault("tracing_spans", []).append(span)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    spans = conn.info.get("tracing_spans")
+    if spans:
+        span = spans.pop()
+        span.set(rows=cursor.rowcount)
+        span.end()
+
+
+def _handle_error(exception_context):
+    conn = exception_context.connection
+    spans = conn.info.get("tracing_spans") if conn is not None else None
+    if spans:
+        spans.pop().end(exception_context.original_exception)
+
+
+if tracer.enabled:
+    # every engine, the bot modules create their own MySQL instances
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
+
+
+class TracingApplication(Application):
+    """
+    Opens one trace and one query log scope per telegram update
+    """
+
+    async def process_update(self, update: object) -> None:
+        attributes = {"update_id": getattr(update, "update_id", None)}
+        effective_user = getattr(update, "effective_user", None)
+        if effective_user is not None:
+            attributes["user_id"] = effective_user.id
+        with tracer.trace("telegram.update", **attributes), query_log.scope(
+            f"update {attributes['update_id']}"
+        ):
+            await super().process_update(update)
+
+
+class TracingRequest(HTTPXRequest):
+    """
+    A span per bot api call, e.g. every sendMessage or editMessageText
+    """
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        with tracer.span(f"telegram.{url.rsplit('/', 1)[-1]}") as span:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            if span is not None:
+                span.set(status_code=code)
+            return code, payload
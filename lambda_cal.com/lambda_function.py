@@ -1,7 +1,228 @@
+import argparse
 import json
 import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import sqlalchemy
+from sqlalchemy import Column, DateTime, Integer, String, Table, Text, func
+
+metadata = sqlalchemy.MetaData()
+# the columns used here of the bot's tables (bot/tables.py)
+user_table = Table(
+    "user",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("user_id", String(255)),
+    Column("username", Text),
+)
+booking_table = Table(
+    "booking",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("user_id", Text),
+    Column("event_id", Text),
+    Column("timestamp", DateTime),
+)
+# booking changes, followed by the bot to keep its in-memory booking state current
+booking_event_table = Table(
+    "booking_event",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("user_id", Text),
+    Column("event_id", Text),
+    Column("action", String(16)),
+    Column("timestamp", DateTime),
+)
+# name -> (table, column, mysql prefix length, unique), like bot/tables.py
+INDEXES = {
+    "ix_user_username": ("user", "username", 191, False),
+    # concurrent deliveries of the same booking insert it once
+    "ux_booking_event_id": ("booking", "event_id", 64, True),
+    "ix_booking_user_id": ("booking", "user_id", 32, False),
+}
+CREATED = "BOOKING_CREATED"
+CANCELLED = "BOOKING_CANCELLED"
+
+# reused by warm invocations of the same lambda container
+_engine = None
+# whether booking_event exists, checked again every CHANGE_LOG_RECHECK_SECONDS while
+# it doesn't
+_has_change_log = False
+_change_log_checked_at = 0.0
+CHANGE_LOG_RECHECK_SECONDS = 60
+
+
+def get_database_url():
+    """
+    DATABASE_URI takes any sqlalchemy url, otherwise mysql is built from MYSQL_*
+    """
+    if os.environ.get("DATABASE_URI"):
+        return os.environ["DATABASE_URI"]
+    return sqlalchemy.engine.url.URL(
+        drivername="mysql+pymysql",
+        username=os.environ["MYSQL_USER"],
+        password=os.environ["MYSQL_PASSWORD"],
+        host=os.environ["MYSQL_HOST"],
+        port=int(os.environ["MYSQL_PORT"]),
+        database=os.environ["MYSQL_DATABASE"],
+        query={"charset": "utf8mb4"},
+    )
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        _engine = sqlalchemy.create_engine(
+            get_database_url(),
+            # a container handles one invocation at a time
+            pool_size=1,
+            max_overflow=2,
+            # connections idle between invocations may have been closed by mysql
+            pool_pre_ping=True,
+            pool_recycle=280,
+        )
+        ensure_indexes(_engine)
+        try:
+            booking_event_table.create(_engine, checkfirst=True)
+        except Exception as err:
+            print(f"Could not create booking_event: {err!r}")
+    return _engine
+
+
+def ensure_indexes(engine):
+    """
+    Adds the lookup indexes to tables created before they were declared
+    """
+    inspector = sqlalchemy.inspect(engine)
+    for name, (table, column, prefix_length, unique) in INDEXES.items():
+        try:
+            if name in {index["name"] for index in inspector.get_indexes(table)}:
+                continue
+            if engine.dialect.name == "mysql":
+                column = f"{column}({prefix_length})"
+            kind = "UNIQUE INDEX" if unique else "INDEX"
+            with engine.begin() as conn:
+                conn.execute(
+                    sqlalchemy.text(f"CREATE {kind} {name} ON {table} ({column})")
+                )
+            print(f"Created index {name}")
+        except Exception as err:
+            # lookups still work without it, only slower (and, without the unique
+            # index, concurrent replays may book an event twice)
+            print(f"Could not create index {name}: {err!r}")
+
+
+def has_change_log(conn) -> bool:
+    global _has_change_log, _change_log_checked_at
+    if not _has_change_log and (
+        time.monotonic() - _change_log_checked_at >= CHANGE_LOG_RECHECK_SECONDS
+    ):
+        _has_change_log = sqlalchemy.inspect(conn).has_table("booking_event")
+        _change_log_checked_at = time.monotonic()
+    return _has_change_log
+
+
+def insert_ignore(conn, table):
+    """
+    INSERT which skips rows violating a unique constraint
+    """
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+        return sqlite_insert(table).on_conflict_do_nothing()
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+
+        return postgresql_insert(table).on_conflict_do_nothing()
+    return table.insert().prefix_with("IGNORE")
+
+
+def parse_events(body) -> list:
+    """
+    A cal.com webhook body, or a json list of them
+    :return: [(trigger_event, uid, username)]
+    """
+    payloads = json.loads(body) if isinstance(body, (str, bytes)) else body
+    if isinstance(payloads, dict):
+        payloads = [payloads]
+    events = []
+    for payload in payloads:
+        event = payload["payload"]
+        username = event.get("responses", {}).get("name", {}).get("value")
+        events.append((payload["triggerEvent"], str(event["uid"]), username))
+    return events
+
+
+def log_change(conn, user_id: str, event_id: str, action: str):
+    if has_change_log(conn):
+        conn.execute(
+            booking_event_table.insert().values(
+                user_id=user_id,
+                event_id=event_id,
+                action=action,
+                timestamp=func.current_timestamp(),
+            )
+        )
+
+
+def process_events(conn, events: list) -> list:
+    """
+    Applies the events in order. Replays are no-ops: a created uid is inserted once
+    (the unique index on booking.event_id also covers replays handled concurrently by
+    another container), and cancelling an unknown uid deletes nothing. Actual changes are also logged to
+    booking_event, in the same transaction.
+    :return: the outcome of every event
+    """
+    usernames = {str(username) for trigger, _, username in events if trigger == CREATED}
+    user_ids = {}
+    if usernames:
+        rows = conn.execute(
+            sqlalchemy.select(user_table.c.username, user_table.c.user_id)
+            .where(user_table.c.username.in_(sorted(usernames)))
+            .order_by(user_table.c.id)
+        )
+        for row in rows:
+            user_ids.setdefault(row.username, row.user_id)
+    results = []
+    for trigger, event_id, username in events:
+        if trigger == CREATED:
+            user_id = user_ids.get(str(username))
+            if user_id is None:
+                results.append("unknown user")
+                continue
+            already_booked = sqlalchemy.exists().where(
+                booking_table.c.event_id == event_id
+            )
+            inserted = conn.execute(
+                insert_ignore(conn, booking_table).from_select(
+                    ["user_id", "event_id", "timestamp"],
+                    sqlalchemy.select(
+                        sqlalchemy.literal(user_id),
+                        sqlalchemy.literal(event_id),
+                        func.current_timestamp(),
+                    ).where(~already_booked),
+                )
+            ).rowcount
+            if inserted:
+                log_change(conn, user_id, event_id, "created")
+            results.append("created" if inserted else "duplicate")
+        elif trigger == CANCELLED:
+            booked_user_ids = conn.execute(
+                sqlalchemy.select(booking_table.c.user_id).where(
+                    booking_table.c.event_id == event_id
+                )
+            ).fetchall()
+            conn.execute(
+                booking_table.delete().where(booking_table.c.event_id == event_id)
+            )
+            for row in booked_user_ids:
+                log_change(conn, row.user_id, event_id, "cancelled")
+            results.append("cancelled" if booked_user_ids else "not found")
+        else:
+            results.append("ignored")
+    return results
 
 
 def lambda_handler(event, context):
@@ -9,47 +230,46 @@ def lambda_handler(event, context):
     triggered by cal.com webhook
     """
     try:
-        MYSQL_USER = os.environ["MYSQL_USER"]
-        MYSQL_PASSWORD = os.environ["MYSQL_PASSWORD"]
-        MYSQL_PORT = os.environ["MYSQL_PORT"]
-        MYSQL_DATABASE = os.environ["MYSQL_DATABASE"]
-        MYSQL_HOST = os.environ["MYSQL_HOST"]
-        event_body = event["body"]
-        payload = json.loads(event_body)
-        engine = sqlalchemy.create_engine(
-            sqlalchemy.engine.url.URL(
-                drivername="mysql+pymysql",
-                username=MYSQL_USER,
-                password=MYSQL_PASSWORD,
-                host=MYSQL_HOST,
-                port=int(MYSQL_PORT),
-                database=MYSQL_DATABASE,
-                query={"charset": "utf8mb4"},
+        events = parse_events(event["body"])
+    except (KeyError, TypeError, ValueError, AttributeError) as err:
+        print(f"Malformed webhook: {err!r}")
+        return {"statusCode": 400, "body": json.dumps("Malformed webhook")}
+    try:
+        # one transaction, a failed batch is retried as a whole by cal.com
+        with get_engine().begin() as conn:
+            results = process_events(conn, events)
+        return {
+            "statusCode": 200,
+            "body": json.dumps(
+                {
+                    "results": [
+                        {"uid": event_id, "result": result}
+                        for (_, event_id, _), result in zip(events, results)
+                    ]
+                }
             ),
-        )
-        username = str(payload["payload"]["responses"]["name"]["value"])
-        event_id = str(payload["payload"]["uid"])
-        with engine.connect() as conn:
-            if payload["triggerEvent"] == "BOOKING_CREATED":
-                user_id = conn.execute(
-                    sqlalchemy.text(
-                        f"SELECT user_id FROM user WHERE username = '{username}'"
-                    )
-                ).fetchone()[0]
-                res = conn.execute(
-                    sqlalchemy.text(
-                        f"INSERT INTO booking (user_id, event_id, timestamp) VALUES ({user_id}, '{event_id}', NOW())"
-                    )
-                )
-                conn.commit()
-            elif payload["triggerEvent"] == "BOOKING_CANCELLED":
-                res = conn.execute(
-                    sqlalchemy.text(
-                        f"DELETE FROM booking WHERE event_id = '{event_id}'"
-                    )
-                )
-                conn.commit()
-        return {"statusCode": 200, "body": json.dumps("Completed successfully")}
+        }
     except Exception as err:
         print(err)
         return {"statusCode": 500, "body": json.dumps("Failed to complete")}
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        response = lambda_handler({"body": body.decode("utf-8")}, None)
+        self.send_response(response["statusCode"])
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(response["body"].encode("utf-8"))
+
+
+if __name__ == "__main__":
+    # runs the webhook locally, without aws: POST cal.com payloads to http://host:port/
+    parser = argparse.ArgumentParser(description="cal.com webhook processor")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), WebhookHandler)
+    print(f"Listening on http://{args.host}:{args.port}")
+    server.serve_forever()
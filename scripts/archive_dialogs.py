@@ -0,0 +1,55 @@
+"""
+Moves old dialogs to compressed segment files (bot/archiver.py), once, with the
+settings of config.yml's dialog_archive unless overridden. Works whether or not the
+bot archives in the background, segments are appended to under a file lock.
+
+    python scripts/archive_dialogs.py                       # archive the dialogs due
+    python scripts/archive_dialogs.py --max-age-days 90 --compression zstd
+    python scripts/archive_dialogs.py --load <dialog uid>   # print an archived dialog
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR / "bot"))
+from archiver import DialogArchiver  # noqa: E402
+from mysql import MySQL  # noqa: E402
+
+import config  # noqa: E402
+
+
+def main(args):
+    settings = dict(config.dialog_archive)
+    for name in ("directory", "max_age_days", "compression", "batch_size"):
+        if getattr(args, name) is not None:
+            settings[name] = getattr(args, name)
+    mysql_db = MySQL()
+    mysql_db.create_tables_if_not_exists()
+    archiver = DialogArchiver(mysql_db, **settings)
+    if args.load:
+        record = archiver.load(args.load)
+        if record is None:
+            sys.exit(f"Dialog {args.load} is not archived")
+        print(json.dumps(record, ensure_ascii=False, indent=2))
+        return
+    started = time.perf_counter()
+    n_archived = archiver.run_once()
+    print(
+        f"Archived {n_archived} dialogs to {archiver.directory} "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive old dialogs")
+    parser.add_argument("--load", metavar="UID", help="print an archived dialog")
+    parser.add_argument("--directory", default=None)
+    parser.add_argument("--max-age-days", type=float, default=None)
+    parser.add_argument("--compression", choices=["gzip", "zstd"], default=None)
+    parser.add_argument("--batch-size", type=int, default=None)
+    logging.basicConfig(level=logging.INFO)
+    main(parser.parse_args())
@@ -0,0 +1,364 @@
+"""
+Microbenchmarks for the per-message hot paths of the MySQL data-access layer.
+Seeds a synthetic catalog and patient population, times every path and counts the sql
+statements it issues, and writes machine-readable results.
+
+    python scripts/benchmark_mysql.py --users 500 --dialog-length 40 --output bench.json
+    python scripts/benchmark_mysql.py --baseline bench.json  # compare with an earlier run
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+import yaml
+from sqlalchemy import event, insert
+from sqlalchemy.engine import Engine
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+BOT_DIR = ROOT_DIR / "bot"
+FIRST_USER_ID = 10000
+QUESTION_FILTERS = [("<", "3"), (">", "7"), ("yes", "yes"), ("", None)]
+MEDICINE_TYPES = ["painkiller", "antihistamine", "ointment", "syrup", "antacid"]
+
+
+def write_config(config_dir: Path, database_uri: str):
+    with open(ROOT_DIR / "config" / "config.example.yml", "r") as f:
+        config_yaml = yaml.safe_load(f)
+    config_yaml.update(
+        {
+            "developer_telegram_chatid": 1,
+            "admin_telegram_username": "benchmark",
+        }
+    )
+    with open(config_dir / "config.yml", "w") as f:
+        yaml.safe_dump(config_yaml, f)
+    with open(config_dir / "config.env", "w") as f:
+        f.write(f"DATABASE_URI={database_uri}\n")
+    with open(ROOT_DIR / "config" / "chat_modes.yml", "r") as src, open(
+        config_dir / "chat_modes.yml", "w"
+    ) as dst:
+        dst.write(src.read())
+
+
+def seed(mysql_db, args, rng: random.Random) -> dict:
+    """
+    :return: disease id of every synthetic user, who answered all its questions
+    """
+    from tables import (
+        Allergy,
+        Dialog,
+        Disease,
+        DiseaseAnswer,
+        DiseaseInstructions,
+        DiseaseQuestion,
+        MedicalCondition,
+        Medication,
+        Medicine,
+        Surgery,
+        User,
+    )
+
+    catalog = {}
+    user_diseases = {}
+    with mysql_db.engine.begin() as conn:
+        for d in range(args.diseases):
+            disease_id = conn.execute(
+                insert(Disease).values(detail=f"disease_{d}")
+            ).inserted_primary_key[0]
+            question_ids = []
+            for q in range(args.questions):
+                question_filter, value = QUESTION_FILTERS[q % len(QUESTION_FILTERS)]
+                question_ids.append(
+                    conn.execute(
+                        insert(DiseaseQuestion).values(
+                            detail=f"Question {q} about disease_{d}?",
+                            filter=question_filter,
+                            value=value,
+                            blocked_type=MEDICINE_TYPES[q % len(MEDICINE_TYPES)],
+                            prescribe="",
+                            disease_id=disease_id,
+                        )
+                    ).inserted_primary_key[0]
+                )
+            conn.execute(
+                insert(DiseaseInstructions),
+                [
+                    {
+                        "detail": f"Instruction {i} for disease_{d}",
+                        "disease_id": disease_id,
+                    }
+                    for i in range(3)
+                ],
+            )
+            conn.execute(
+                insert(Medicine),
+                [
+                    {
+                        "detail": f"medicine_{m} for disease_{d}",
+                        "type": MEDICINE_TYPES[m % len(MEDICINE_TYPES)],
+                        "min_age": rng.randint(0, 18),
+                        "max_age": rng.randint(60, 100),
+                        "allowed_gender": "Male, Female",
+                        "not_for_allergies": f"allergy_{m % 7}",
+                        "not_for_conditions": f"condition_{m % 5}",
+                        "disease_id": disease_id,
+                    }
+                    for m in range(args.medicines)
+                ],
+            )
+            catalog[disease_id] = question_ids
+
+        disease_ids = list(catalog)
+        for u in range(args.users):
+            user_id = str(FIRST_USER_ID + u)
+            dialog_id = f"dialog-{user_id}"
+            conn.execute(
+                insert(User).values(
+                    user_id=user_id,
+                    username=f"user{u}",
+                    first_name="Synthetic",
+                    last_name=f"User{u}",
+                    current_dialog_id=dialog_id,
+                    n_used_tokens={},
+                    age=str(rng.randint(1, 90)),
+                    gender=rng.choice(["Male", "Female"]),
+                )
+            )
+            conn.execute(
+                insert(Dialog).values(
+                    uid=dialog_id,
+                    user_id=user_id,
+                    messages=[
+                        {
+                            "user": f"user message {i} " * 8,
+                            "bot": f"bot answer {i} " * 30,
+                        }
+                        for i in range(args.dialog_length)
+                    ],
+                )
+            )
+            for table, prefix in (
+                (Allergy, "allergy"),
+                (MedicalCondition, "condition"),
+                (Medication, "medication"),
+                (Surgery, "surgery"),
+            ):
+                conn.execute(
+                    insert(table),
+                    [
+                        {"user_id": user_id, "detail": f"{prefix}_{rng.randint(0, 20)}"}
+                        for _ in range(args.history_items)
+                    ],
+                )
+            disease_id = rng.choice(disease_ids)
+            user_diseases[FIRST_USER_ID + u] = disease_id
+            conn.execute(
+                insert(DiseaseAnswer),
+                [
+                    {
+                        "user_id": user_id,
+                        "detail": rng.choice(["yes", "no", str(rng.randint(0, 10))]),
+                        "question_id": question_id,
+                        "disease_id": disease_id,
+                    }
+                    for question_id in catalog[disease_id]
+                ],
+            )
+    return user_diseases
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+        # every engine, the bot modules create their own MySQL instances
+        event.listen(Engine, "before_cursor_execute", self)
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def time_path(counter: StatementCounter, fn, iterations: int, warmup: int) -> dict:
+    for i in range(warmup):
+        fn(i)
+    durations = []
+    statements = []
+    for i in range(iterations):
+        n_statements_before = counter.count
+        started = time.perf_counter()
+        fn(warmup + i)
+        durations.append((time.perf_counter() - started) * 1000)
+        statements.append(counter.count - n_statements_before)
+    return {
+        "iterations": iterations,
+        "mean_ms": statistics.mean(durations),
+        "p50_ms": percentile(durations, 50),
+        "p95_ms": percentile(durations, 95),
+        "p99_ms": percentile(durations, 99),
+        "statements_per_call": statistics.mean(statements),
+    }
+
+
+def run_benchmarks(mysql_db, user_diseases: dict, args, rng: random.Random) -> dict:
+    import handlers  # noqa: F401, must be imported before utils (circular import)
+    import utils
+
+    counter = StatementCounter()
+    user_ids = list(user_diseases)
+    loop = asyncio.new_event_loop()
+
+    async def reply_text(*_args, **_kwargs):
+        pass
+
+    def register_user(user_id: int):
+        update = SimpleNamespace(
+            message=SimpleNamespace(id=1, reply_text=reply_text),
+        )
+        user = SimpleNamespace(
+            id=user_id, username=f"user{user_id}", first_name="New", last_name="User"
+        )
+        loop.run_until_complete(utils.register_user_if_not_exists(update, None, user))
+
+    def set_dialog_messages(i: int):
+        user_id = rng.choice(user_ids)
+        mysql_db.set_dialog_messages(user_id, mysql_db.get_dialog_messages(user_id))
+
+    def prepare_patient_history(i: int):
+        user_id = rng.choice(user_ids)
+        mysql_db.prepare_patient_history(user_id, disease_id=user_diseases[user_id])
+
+    def write_prescription(i: int):
+        user_id = rng.choice(user_ids)
+        mysql_db.write_prescription(user_id, user_diseases[user_id])
+
+    paths = {
+        "prepare_patient_history": prepare_patient_history,
+        "write_prescription": write_prescription,
+        "get_dialog_messages": lambda i: mysql_db.get_dialog_messages(
+            rng.choice(user_ids)
+        ),
+        "get_and_set_dialog_messages": set_dialog_messages,
+        "register_user_if_not_exists.existing": lambda i: register_user(
+            rng.choice(user_ids)
+        ),
+        "register_user_if_not_exists.new": lambda i: register_user(
+            FIRST_USER_ID + args.users + i
+        ),
+    }
+    selected = args.paths.split(",") if args.paths else list(paths)
+    results = {}
+    for name in selected:
+        results[name] = time_path(counter, paths[name], args.iterations, args.warmup)
+    loop.close()
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: dict, baseline: dict = None):
+    print(
+        f"{'path':<40}{'mean ms':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'stmts':>8}"
+        + (f"{'vs base':>10}" if baseline else "")
+    )
+    for name, stats in results.items():
+        line = (
+            f"{name:<40}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}"
+            f"{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+            f"{stats['statements_per_call']:>8.1f}"
+        )
+        if baseline and name in baseline:
+            line += f"{stats['mean_ms'] / baseline[name]['mean_ms']:>9.2f}x"
+        print(line)
+
+
+def main(args):
+    work_dir = Path(tempfile.mkdtemp(prefix="medicalgpt-bench-"))
+    database_uri = args.database_uri or f"sqlite:///{work_dir / 'bench.db'}"
+    write_config(work_dir, database_uri)
+    # the bot modules read their config at import time
+    os.environ["MEDICALGPT_CONFIG_DIR"] = str(work_dir)
+    sys.path.insert(0, str(BOT_DIR))
+    from mysql import MySQL
+
+    rng = random.Random(args.seed)
+    mysql_db = MySQL(database_uri)
+    mysql_db.create_tables_if_not_exists()
+    started = time.perf_counter()
+    user_diseases = seed(mysql_db, args, rng)
+    print(f"Seeded in {time.perf_counter() - started:.1f}s")
+    results = run_benchmarks(mysql_db, user_diseases, args, rng)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "meta": {
+                        "commit": git_commit(),
+                        "timestamp": datetime.utcnow().isoformat(),
+                        "dialect": mysql_db.engine.dialect.name,
+                        "sizes": {
+                            "diseases": args.diseases,
+                            "questions": args.questions,
+                            "medicines": args.medicines,
+                            "users": args.users,
+                            "history_items": args.history_items,
+                            "dialog_length": args.dialog_length,
+                        },
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--database-uri",
+        default=None,
+        help="sqlalchemy url of an empty database, defaults to a fresh sqlite file",
+    )
+    parser.add_argument("--diseases", type=int, default=20)
+    parser.add_argument("--questions", type=int, default=8, help="per disease")
+    parser.add_argument("--medicines", type=int, default=25, help="per disease")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument(
+        "--history-items",
+        type=int,
+        default=3,
+        help="allergies, conditions, medications and surgeries per user",
+    )
+    parser.add_argument("--dialog-length", type=int, default=20)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--paths", default=None, help="comma separated, default all")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write json results here")
+    parser.add_argument("--baseline", default=None, help="json results to compare")
+    main(parser.parse_args())
@@ -0,0 +1,282 @@
+"""
+Builds the derived training sets from the per-condition files in training_data/:
+
+    data.jsonl                          {"prompt": sentence, "completion": condition}
+    processed.jsonl                     yes/no questions for fine-tuning
+    processed_prepared_train.jsonl      the same, as prepared by `openai tools fine_tunes.prepare_data`
+    processed_prepared_valid.jsonl
+
+Prompts are lowercased, labels are normalized against the disease catalog,
+near-identical prompts are dropped and the train/valid split is stratified by
+condition and deterministic. Outputs whose inputs didn't change since the last build
+(see training_data/.build_manifest.json) are not rewritten.
+
+    python scripts/build_training_data.py
+    python scripts/build_training_data.py --include "training_data/labeled/*.jsonl"
+"""
+import argparse
+import difflib
+import glob
+import hashlib
+import json
+import os
+import sys
+from collections import Counter, defaultdict
+from pathlib import Path
+
+import sqlalchemy
+from classifiers import (
+    LABEL_ALIASES,
+    ROOT_DIR,
+    TRAINING_DATA_DIR,
+    condition_files,
+    normalize_label,
+    normalize_prompt,
+    tokenize,
+)
+from reddit import get_database_url
+from sqlalchemy import select
+
+sys.path.insert(0, str(ROOT_DIR / "bot"))
+from tables import Disease  # noqa: E402
+
+MANIFEST_NAME = ".build_manifest.json"
+# bumped when the output format changes, so every output is rebuilt
+BUILD_VERSION = 2
+
+
+def sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def sha256_text(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_catalog(database_uri: str = None) -> list:
+    """
+    Disease names of the bot's database, None when it can't be reached
+    """
+    try:
+        engine = sqlalchemy.create_engine(database_uri or get_database_url())
+        with engine.connect() as conn:
+            rows = conn.execute(select(Disease.detail)).fetchall()
+        engine.dispose()
+    except Exception as e:
+        print(f"Disease catalog unavailable ({e!r}), labels are only de-aliased")
+        return None
+    return sorted({row.detail.strip() for row in rows if row.detail})
+
+
+class LabelNormalizer:
+    def __init__(self, catalog: list = None):
+        self.catalog = {name.lower(): name for name in catalog or []}
+        self.unknown = set()
+        self._cache = {}
+
+    def __call__(self, label: str) -> str:
+        if label not in self._cache:
+            self._cache[label] = self._normalize(label)
+        return self._cache[label]
+
+    def _normalize(self, label: str) -> str:
+        label = normalize_label(label)
+        if not self.catalog:
+            return label
+        if label.lower() in self.catalog:
+            return self.catalog[label.lower()]
+        close = difflib.get_close_matches(label.lower(), self.catalog, n=1, cutoff=0.85)
+        if close:
+            return self.catalog[close[0]]
+        self.unknown.add(label)
+        return label
+
+
+def prompt_key(prompt: str) -> str:
+    """
+    Same words in the same order, ignoring case, punctuation and whitespace
+    """
+    return hashlib.sha1(" ".join(tokenize(prompt)).encode("utf-8")).hexdigest()
+
+
+def iter_examples(paths: list):
+    for path in paths:
+        with open(path, "r") as f:
+            for line in f:
+                if line.strip():
+                    example = json.loads(line)
+                    yield example["prompt"], example["completion"]
+
+
+def collect(paths: list, normalize: LabelNormalizer) -> list:
+    """
+    :return: [(prompt, label, prompt_key)], the first of near-identical prompts
+    """
+    examples = []
+    seen = {}
+    n_duplicates = 0
+    conflicts = 0
+    for prompt, label in iter_examples(paths):
+        prompt = normalize_prompt(prompt)
+        label = normalize(label)
+        key = prompt_key(prompt)
+        if key in seen:
+            n_duplicates += 1
+            conflicts += seen[key] != label
+            continue
+        seen[key] = label
+        examples.append((prompt, label, key))
+    print(
+        f"{len(examples)} examples, {n_duplicates} near-duplicates dropped "
+        f"({conflicts} with a different label)"
+    )
+    return examples
+
+
+def split(examples: list, valid_fraction: float, seed: int) -> tuple:
+    """
+    Per condition, the examples with the lowest seeded hash go to valid. An example
+    keeps its side as long as its condition's size doesn't change much.
+    """
+    by_label = defaultdict(list)
+    for example in examples:
+        by_label[example[1]].append(example)
+
+    def order(example):
+        return sha256_text(seed, example[2])
+
+    train, valid = [], []
+    for label in sorted(by_label):
+        ranked = sorted(by_label[label], key=order)
+        n_valid = round(len(ranked) * valid_fraction)
+        valid.extend(ranked[:n_valid])
+        train.extend(ranked[n_valid:])
+    return sorted(train, key=order), sorted(valid, key=order)
+
+
+def processed_line(prompt: str, label: str) -> str:
+    return json.dumps(
+        {
+            "prompt": f"question: is following sentence indicating {label.lower()}?\n"
+            f"sentence: {prompt}\nanswer:yes/no",
+            "completion": "yes",
+        }
+    )
+
+
+def prepared_line(prompt: str, label: str) -> str:
+    # the compact, slash-escaped json written by pandas in prepare_data
+    line = json.dumps(
+        {
+            "prompt": f"{label.lower()}?\nsentence: {prompt}\nanswer:yes/no",
+            "completion": " yes",
+        },
+        separators=(",", ":"),
+    )
+    return line.replace("/", "\\/")
+
+
+def write_lines(path: Path, lines) -> str:
+    """
+    Atomically replaces path
+    :return: sha256 of the written file
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        for line in lines:
+            f.write(line + "\n")
+    os.replace(tmp_path, path)
+    return sha256_file(path)
+
+
+def main(args):
+    training_dir = Path(args.training_dir)
+    manifest_path = training_dir / MANIFEST_NAME
+    manifest = {}
+    if manifest_path.exists() and not args.force:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    paths = condition_files(training_dir)
+    for pattern in args.include:
+        paths.extend(sorted(Path(path) for path in glob.glob(pattern)))
+    catalog = None if args.no_catalog else load_catalog(args.database_uri)
+    inputs = {os.path.relpath(path, training_dir): sha256_file(path) for path in paths}
+    data_key = sha256_text(BUILD_VERSION, inputs, catalog, LABEL_ALIASES)
+    split_key = sha256_text(data_key, args.valid_fraction, args.seed)
+    output_keys = {
+        "data.jsonl": data_key,
+        "processed.jsonl": data_key,
+        "processed_prepared_train.jsonl": split_key,
+        "processed_prepared_valid.jsonl": split_key,
+    }
+    built = manifest.get("outputs", {})
+
+    def up_to_date(name: str) -> bool:
+        path = training_dir / name
+        return (
+            name in built
+            and built[name]["key"] == output_keys[name]
+            and path.exists()
+            and sha256_file(path) == built[name]["sha256"]
+        )
+
+    stale = [name for name in output_keys if not up_to_date(name)]
+    if not stale:
+        print("Training data is up to date.")
+        return
+    normalize = LabelNormalizer(catalog)
+    examples = collect(paths, normalize)
+    if normalize.unknown:
+        print(f"Labels not in the disease catalog: {sorted(normalize.unknown)}")
+    train, valid = split(examples, args.valid_fraction, args.seed)
+    writers = {
+        "data.jsonl": lambda: (
+            json.dumps({"prompt": prompt, "completion": label})
+            for prompt, label, _ in examples
+        ),
+        "processed.jsonl": lambda: (
+            processed_line(prompt, label) for prompt, label, _ in examples
+        ),
+        "processed_prepared_train.jsonl": lambda: (
+            prepared_line(prompt, label) for prompt, label, _ in train
+        ),
+        "processed_prepared_valid.jsonl": lambda: (
+            prepared_line(prompt, label) for prompt, label, _ in valid
+        ),
+    }
+    for name in stale:
+        sha256 = write_lines(training_dir / name, writers[name]())
+        built[name] = {"key": output_keys[name], "sha256": sha256}
+        print(f"Wrote {name}")
+    manifest = {
+        "inputs": inputs,
+        "labels": dict(Counter(label for _, label, _ in examples).most_common()),
+        "split": {"train": len(train), "valid": len(valid)},
+        "outputs": built,
+    }
+    write_lines(manifest_path, [json.dumps(manifest, indent=2)])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the derived training sets")
+    parser.add_argument("--training-dir", default=str(TRAINING_DATA_DIR))
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=[],
+        help="extra {prompt, completion} jsonl files (glob), e.g. auto-labeled shards",
+    )
+    parser.add_argument("--valid-fraction", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--database-uri", default=None, help="defaults to the bot's database"
+    )
+    parser.add_argument(
+        "--no-catalog", action="store_true", help="don't read the disease catalog"
+    )
+    parser.add_argument("--force", action="store_true", help="rebuild every output")
+    main(parser.parse_args())
@@ -0,0 +1,240 @@
+"""
+Medical condition classifiers shared by the training data scripts: a naive Bayes model
+trained on training_data/, and batched openai requests.
+"""
+import asyncio
+import json
+import math
+import re
+import sys
+from collections import Counter, defaultdict
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+TRAINING_DATA_DIR = ROOT_DIR / "training_data"
+# generated from the per-condition files, not training input
+DERIVED_FILES = {
+    "data.jsonl",
+    "processed.jsonl",
+    "processed_prepared_train.jsonl",
+    "processed_prepared_valid.jsonl",
+}
+NO_CONDITION = "none"
+# misspelled labels which are too short for fuzzy matching to be safe
+LABEL_ALIASES = {"diarhea": "diarrhea"}
+
+_TOKEN = re.compile(r"[a-z0-9']+")
+
+
+def tokenize(text: str) -> list:
+    return _TOKEN.findall(text.lower())
+
+
+def normalize_label(label: str) -> str:
+    """
+    Collapses whitespace and known misspellings, e.g. diarhea.jsonl's labels
+    """
+    label = " ".join(label.split())
+    return LABEL_ALIASES.get(label.lower(), label)
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Lowercase with collapsed whitespace, like training_data/data.jsonl
+    """
+    return " ".join(prompt.lower().split())
+
+
+def condition_files(training_dir: Path = TRAINING_DATA_DIR) -> list:
+    return sorted(
+        path for path in training_dir.glob("*.jsonl") if path.name not in DERIVED_FILES
+    )
+
+
+def load_examples(training_dir: Path = TRAINING_DATA_DIR):
+    """
+    Streams (prompt, label) of the per-condition files, labels normalized
+    """
+    for path in condition_files(training_dir):
+        with open(path, "r") as f:
+            for line in f:
+                if line.strip():
+                    example = json.loads(line)
+                    yield example["prompt"], normalize_label(example["completion"])
+
+
+class NaiveBayesClassifier:
+    """
+    Multinomial naive Bayes over word counts, with Laplace smoothing. Small enough to
+    ship to worker processes as a dict.
+    """
+
+    def __init__(self, alpha: float = 1.0):
+        self.alpha = alpha
+        self.label_counts = Counter()
+        self.token_counts = defaultdict(Counter)
+        self.vocabulary = set()
+
+    def fit(self, examples) -> "NaiveBayesClassifier":
+        for prompt, label in examples:
+            self.label_counts[label] += 1
+            tokens = tokenize(prompt)
+            self.token_counts[label].update(tokens)
+            self.vocabulary.update(tokens)
+        self._prepare()
+        return self
+
+    def _prepare(self):
+        n_examples = sum(self.label_counts.values())
+        self._log_priors = {
+            label: math.log(count / n_examples)
+            for label, count in self.label_counts.items()
+        }
+        self._totals = {
+            label: sum(counts.values()) + self.alpha * len(self.vocabulary)
+            for label, counts in self.token_counts.items()
+        }
+
+    @property
+    def labels(self) -> list:
+        return sorted(self.label_counts)
+
+    def predict_proba(self, text: str) -> dict:
+        tokens = [token for token in tokenize(text) if token in self.vocabulary]
+        scores = {}
+        for label, log_prior in self._log_priors.items():
+            counts = self.token_counts[label]
+            total = self._totals[label]
+            scores[label] = log_prior + sum(
+                math.log((counts[token] + self.alpha) / total) for token in tokens
+            )
+        best = max(scores.values())
+        exp_scores = {label: math.exp(score - best) for label, score in scores.items()}
+        norm = sum(exp_scores.values())
+        return {label: score / norm for label, score in exp_scores.items()}
+
+    def predict(self, text: str, min_confidence: float = 0.0) -> tuple:
+        """
+        :return: (label, confidence), the label is NO_CONDITION below min_confidence
+        or when the text shares no word with the training data
+        """
+        if not any(token in self.vocabulary for token in tokenize(text)):
+            return NO_CONDITION, 0.0
+        probabilities = self.predict_proba(text)
+        label = max(probabilities, key=probabilities.get)
+        if probabilities[label] < min_confidence:
+            return NO_CONDITION, probabilities[label]
+        return label, probabilities[label]
+
+    def to_dict(self) -> dict:
+        return {
+            "alpha": self.alpha,
+            "label_counts": dict(self.label_counts),
+            "token_counts": {
+                label: dict(counts) for label, counts in self.token_counts.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "NaiveBayesClassifier":
+        classifier = cls(data["alpha"])
+        classifier.label_counts = Counter(data["label_counts"])
+        for label, counts in data["token_counts"].items():
+            classifier.token_counts[label] = Counter(counts)
+            classifier.vocabulary.update(counts)
+        classifier._prepare()
+        return classifier
+
+
+_LABEL_LINE = re.compile(r"^\s*(\d+)\s*[:.)-]\s*(.+?)\s*$")
+
+
+class LLMClassifier:
+    """
+    Labels many sentences per openai request, through the bot's resilient openai
+    client (retries, backoff, circuit breaker), with at most `concurrency` requests
+    in flight. Needs the bot's config/config.yml, unless another client is given.
+    """
+
+    def __init__(
+        self,
+        labels: list,
+        model: str = "gpt-3.5-turbo",
+        batch_size: int = 20,
+        concurrency: int = 4,
+        client=None,
+    ):
+        if client is None:
+            sys.path.insert(0, str(ROOT_DIR / "bot"))
+            from resilience import ResilientOpenAI
+
+            import config
+
+            client = ResilientOpenAI(**config.openai_resilience)
+        self.client = client
+        self.labels = sorted(labels)
+        self.model = model
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.n_input_tokens = 0
+        self.n_output_tokens = 0
+
+    def _messages(self, sentences: list) -> list:
+        numbered = "\n".join(
+            f"{i + 1}. {' '.join(sentence.split())}"
+            for i, sentence in enumerate(sentences)
+        )
+        return [
+            {
+                "role": "system",
+                "content": "You label patient messages with the medical condition they describe.",
+            },
+            {
+                "role": "user",
+                "content": f"Conditions: {', '.join(self.labels)}.\n"
+                f"For every numbered message, answer with its number and exactly one "
+                f"condition from the list, or '{NO_CONDITION}' if none fits or you're "
+                f"uncertain. One line per message, formatted as `<number>: <condition>`.\n\n"
+                f"{numbered}",
+            },
+        ]
+
+    def _parse(self, answer: str, n_sentences: int) -> list:
+        known = {label.lower(): label for label in self.labels}
+        labels = [NO_CONDITION] * n_sentences
+        for line in answer.splitlines():
+            match = _LABEL_LINE.match(line)
+            if match is None:
+                continue
+            index = int(match.group(1)) - 1
+            if 0 <= index < n_sentences:
+                labels[index] = known.get(
+                    match.group(2).strip("`'\". ").lower(), NO_CONDITION
+                )
+        return labels
+
+    async def classify_batch(self, sentences: list) -> list:
+        response = await self.client.acreate(
+            call_type="labeling",
+            model=self.model,
+            messages=self._messages(sentences),
+            temperature=0,
+            max_tokens=12 * len(sentences),
+        )
+        self.n_input_tokens += response.usage.prompt_tokens
+        self.n_output_tokens += response.usage.completion_tokens
+        return self._parse(response.choices[0].message.content, len(sentences))
+
+    async def classify(self, sentences: list) -> list:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def limited(batch):
+            async with semaphore:
+                return await self.classify_batch(batch)
+
+        batches = [
+            sentences[i : i + self.batch_size]
+            for i in range(0, len(sentences), self.batch_size)
+        ]
+        results = await asyncio.gather(*(limited(batch) for batch in batches))
+        return [label for batch_labels in results for label in batch_labels]
@@ -0,0 +1,437 @@
+"""
+Evaluates a medical condition classifier on training_data/processed_prepared_valid.jsonl:
+per-condition precision/recall, the most common confusions, request latency and tokens.
+The validation set only has positives, so the messages without a condition of
+scripts/fixtures/negatives.jsonl (`--negatives`) are added to measure false positives.
+
+Backends:
+    local   naive Bayes trained on the per-condition files, minus the validation prompts
+    llm     batched openai requests (scripts/classifiers.py)
+    filter  the bot's Filter.medical_condition_message_filter, one yes/no request per
+            candidate condition, the first yes wins like the registered filters do.
+            Runs without the bot's token budget, `--concurrency` bounds the calls.
+            Calls shed anyway are counted and left out of the scores.
+
+--mock replaces openai for the llm and filter backends with a simulated model, which is
+right `--mock-accuracy` of the time after a simulated latency, so strategies can be
+compared offline.
+
+    python scripts/evaluate_classifier.py --backend local
+    python scripts/evaluate_classifier.py --backend llm --mock --concurrency 8
+    python scripts/evaluate_classifier.py --backend filter --candidates 5 --limit 100
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from types import SimpleNamespace
+
+from build_training_data import LabelNormalizer, prompt_key
+from classifiers import (
+    NO_CONDITION,
+    ROOT_DIR,
+    TRAINING_DATA_DIR,
+    LLMClassifier,
+    NaiveBayesClassifier,
+    load_examples,
+    normalize_prompt,
+)
+
+_PREPARED_PROMPT = re.compile(r"^(.*)\?\nsentence: (.*)\nanswer:yes/no$", re.DOTALL)
+_FILTER_PROMPT = re.compile(
+    r"indicating (.*)\?\nSentence: (.*)\.\nIf you're", re.DOTALL
+)
+_NUMBERED_LINE = re.compile(r"^(\d+)\. (.*)$")
+# the prediction of a filter call shed by admission control, not scored
+SHED = "shed"
+
+
+def load_validation(path: Path, limit: int = None) -> list:
+    """
+    :return: [(sentence, condition)]
+    """
+    normalize = LabelNormalizer()
+    examples = []
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            match = _PREPARED_PROMPT.match(json.loads(line)["prompt"])
+            examples.append((match.group(2), normalize(match.group(1)).lower()))
+            if limit and len(examples) >= limit:
+                break
+    return examples
+
+
+def load_negatives(path: Path) -> list:
+    """
+    :return: [(sentence, NO_CONDITION)]
+    """
+    with open(path, "r") as f:
+        return [
+            (normalize_prompt(json.loads(line)["prompt"]), NO_CONDITION)
+            for line in f
+            if line.strip()
+        ]
+
+
+def seeded_random(*parts) -> random.Random:
+    # the same answer for the same sentence, whatever order requests complete in
+    digest = hashlib.sha256(repr(parts).encode("utf-8")).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+
+class MockOpenAI:
+    """
+    Stands in for the bot's ResilientOpenAI. Answers the prompts of LLMClassifier and
+    of the bot's Filter from the known labels, with ~4 characters per token.
+    """
+
+    def __init__(
+        self,
+        truth: dict,
+        labels: list,
+        accuracy: float = 0.9,
+        latency_ms: float = 400,
+        seed: int = 0,
+    ):
+        self.truth = truth
+        self.labels = labels
+        self.accuracy = accuracy
+        self.latency_ms = latency_ms
+        self.seed = seed
+
+    def _label(self, sentence: str) -> str:
+        rng = seeded_random(self.seed, sentence)
+        if rng.random() < self.accuracy:
+            return self.truth.get(sentence, NO_CONDITION)
+        return rng.choice(self.labels + [NO_CONDITION])
+
+    def _answer(self, prompt: str) -> str:
+        match = _FILTER_PROMPT.search(prompt)
+        if match is not None:
+            condition, sentence = match.groups()
+            return "Yes" if self._label(sentence) == condition.lower() else "No"
+        lines = [_NUMBERED_LINE.match(line) for line in prompt.splitlines()]
+        return "\n".join(
+            f"{match.group(1)}: {self._label(match.group(2))}"
+            for match in lines
+            if match is not None
+        )
+
+    def _response(self, messages: list) -> tuple:
+        prompt = "\n".join(message["content"] for message in messages)
+        answer = self._answer(prompt)
+        # lognormal around the median latency, like real request latencies
+        latency = self.latency_ms * math.exp(seeded_random(prompt).gauss(0, 0.5))
+        response = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=answer))],
+            usage=SimpleNamespace(
+                prompt_tokens=len(prompt) // 4, completion_tokens=len(answer) // 4 + 1
+            ),
+        )
+        return response, latency / 1000
+
+    async def acreate(self, messages: list, **kwargs):
+        response, latency = self._response(messages)
+        await asyncio.sleep(latency)
+        return response
+
+    def create(self, messages: list, **kwargs):
+        response, latency = self._response(messages)
+        time.sleep(latency)
+        return response
+
+
+class LocalBackend:
+    batch_size = 1
+
+    def __init__(self, validation: list, min_confidence: float):
+        held_out = {prompt_key(sentence) for sentence, _ in validation}
+        self.classifier = NaiveBayesClassifier().fit(
+            (prompt, label)
+            for prompt, label in load_examples()
+            if prompt_key(prompt) not in held_out
+        )
+        self.min_confidence = min_confidence
+        self.n_input_tokens = 0
+        self.n_output_tokens = 0
+
+    async def classify(self, sentences: list) -> list:
+        return [
+            self.classifier.predict(sentence, self.min_confidence)[0]
+            for sentence in sentences
+        ]
+
+
+class LLMBackend:
+    def __init__(self, labels: list, model: str, batch_size: int, client=None):
+        self.batch_size = batch_size
+        self.classifier = LLMClassifier(labels, model=model, client=client)
+
+    @property
+    def n_input_tokens(self):
+        return self.classifier.n_input_tokens
+
+    @property
+    def n_output_tokens(self):
+        return self.classifier.n_output_tokens
+
+    async def classify(self, sentences: list) -> list:
+        return await self.classifier.classify_batch(sentences)
+
+
+class FilterBackend:
+    """
+    Asks about every condition in order, like the bot's registered filters, or about
+    `candidates` of them drawn per sentence. The draw never looks at the true
+    condition, so the metrics compare with the other backends.
+    """
+
+    batch_size = 1
+
+    def __init__(
+        self, labels: list, candidates: int = 0, client=None, concurrency: int = 4
+    ):
+        sys.path.insert(0, str(ROOT_DIR / "bot"))
+        import handlers  # noqa: F401, resolves the bot's circular imports
+        import medicalgpt
+
+        if client is not None:
+            medicalgpt.openai_client = client
+        medicalgpt.admission_controller = self._admission_controller(
+            medicalgpt.AdmissionController, concurrency
+        )
+        self.medicalgpt = medicalgpt
+        self.filter = medicalgpt.Filter()
+        self.labels = labels
+        self.candidates = candidates
+        self.n_input_tokens = 0
+        self.n_output_tokens = 0
+        self.n_shed = 0
+        self._create = medicalgpt.openai_client.create
+        medicalgpt.openai_client.create = self._counting_create
+
+    @staticmethod
+    def _admission_controller(base: type, concurrency: int):
+        """
+        The bot's controller without its token budget, and locked: the filter is
+        called from threads here, from the event loop in the bot
+        """
+
+        class LockedAdmissionController(base):
+            def __init__(self):
+                super().__init__(max_concurrency=concurrency, tokens_per_minute=2**62)
+                self._lock = threading.Lock()
+
+            def try_admit(self, *args, **kwargs) -> bool:
+                with self._lock:
+                    return super().try_admit(*args, **kwargs)
+
+            def release(self):
+                with self._lock:
+                    super().release()
+
+        return LockedAdmissionController()
+
+    def _counting_create(self, *args, **kwargs):
+        response = self._create(*args, **kwargs)
+        self.n_input_tokens += response.usage.prompt_tokens
+        self.n_output_tokens += response.usage.completion_tokens
+        return response
+
+    def _classify(self, sentence: str) -> str:
+        candidates = self.labels
+        if 0 < self.candidates < len(self.labels):
+            rng = seeded_random("candidates", sentence)
+            candidates = rng.sample(self.labels, self.candidates)
+        for candidate in candidates:
+            result = self.filter.medical_condition_message_filter(sentence, candidate)
+            if result is None:
+                self.n_shed += 1
+                return SHED
+            if result:
+                return candidate
+        return NO_CONDITION
+
+    async def classify(self, sentences: list) -> list:
+        # the filter is synchronous, like in the bot
+        return [await asyncio.to_thread(self._classify, s) for s in sentences]
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def evaluate(backend, validation: list, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def run(batch: list) -> list:
+        async with semaphore:
+            started = time.perf_counter()
+            labels = await backend.classify([sentence for sentence, _ in batch])
+            latencies.append((time.perf_counter() - started) * 1000)
+            return labels
+
+    batches = [
+        validation[i : i + backend.batch_size]
+        for i in range(0, len(validation), backend.batch_size)
+    ]
+    started = time.perf_counter()
+    results = await asyncio.gather(*(run(batch) for batch in batches))
+    wall_seconds = time.perf_counter() - started
+    normalize = LabelNormalizer()
+    predictions = [normalize(label).lower() for labels in results for label in labels]
+    return {
+        "predictions": predictions,
+        "latencies_ms": latencies,
+        "wall_seconds": wall_seconds,
+    }
+
+
+def report(validation: list, result: dict, backend, price_per_1000_tokens: float):
+    scored = [
+        (label, predicted)
+        for (_, label), predicted in zip(validation, result["predictions"])
+        if predicted != SHED
+    ]
+    truth = [label for label, _ in scored]
+    predictions = [predicted for _, predicted in scored]
+    n_negatives = truth.count(NO_CONDITION)
+    confusion = Counter(zip(truth, predictions))
+    labels = sorted(set(truth) | set(predictions))
+    per_label = {}
+    for label in labels:
+        tp = confusion[(label, label)]
+        fp = sum(confusion[(t, label)] for t in labels if t != label)
+        fn = sum(confusion[(label, p)] for p in labels if p != label)
+        per_label[label] = {
+            "precision": tp / (tp + fp) if tp + fp else 0.0,
+            "recall": tp / (tp + fn) if tp + fn else 0.0,
+            "support": tp + fn,
+        }
+    accuracy = sum(confusion[(label, label)] for label in labels) / len(truth)
+    n_tokens = backend.n_input_tokens + backend.n_output_tokens
+    summary = {
+        "examples": len(truth),
+        "with_condition": len(truth) - n_negatives,
+        "without_condition": n_negatives,
+        "shed": len(validation) - len(truth),
+        "accuracy": accuracy,
+        # negatives classified as some condition
+        "false_positive_rate": sum(
+            confusion[(NO_CONDITION, p)] for p in labels if p != NO_CONDITION
+        )
+        / n_negatives
+        if n_negatives
+        else 0.0,
+        "requests": len(result["latencies_ms"]),
+        "latency_p50_ms": percentile(result["latencies_ms"], 0.5),
+        "latency_p99_ms": percentile(result["latencies_ms"], 0.99),
+        "examples_per_second": len(truth) / result["wall_seconds"],
+        "input_tokens": backend.n_input_tokens,
+        "output_tokens": backend.n_output_tokens,
+        "cost_usd": n_tokens / 1000 * price_per_1000_tokens,
+    }
+    print(f"{'condition':<32} {'precision':>9} {'recall':>7} {'support':>7}")
+    for label, scores in per_label.items():
+        if scores["support"] or label != NO_CONDITION:
+            print(
+                f"{label[:32]:<32} {scores['precision']:>9.2f} "
+                f"{scores['recall']:>7.2f} {scores['support']:>7}"
+            )
+    print("\nMost common confusions (true -> predicted):")
+    mistakes = [(pair, n) for pair, n in confusion.items() if pair[0] != pair[1]]
+    for (true_label, predicted), n in sorted(mistakes, key=lambda item: -item[1])[:15]:
+        print(f"  {true_label} -> {predicted}: {n}")
+    print()
+    for key, value in summary.items():
+        print(f"{key}: {value:.4g}" if isinstance(value, float) else f"{key}: {value}")
+    return {
+        "summary": summary,
+        "per_condition": per_label,
+        "confusion": [
+            {"true": t, "predicted": p, "count": n} for (t, p), n in confusion.items()
+        ],
+    }
+
+
+def main(args):
+    validation = load_validation(Path(args.valid_file), args.limit)
+    labels = sorted({label for _, label in validation})
+    if args.negatives:
+        validation += load_negatives(Path(args.negatives))
+    truth = dict(validation)
+    client = None
+    if args.mock:
+        client = MockOpenAI(
+            truth, labels, args.mock_accuracy, args.mock_latency_ms, args.seed
+        )
+    if args.backend == "local":
+        backend = LocalBackend(validation, args.min_confidence)
+    elif args.backend == "llm":
+        backend = LLMBackend(labels, args.model, args.batch_size, client)
+    else:
+        backend = FilterBackend(labels, args.candidates, client, args.concurrency)
+    n_negatives = sum(label == NO_CONDITION for _, label in validation)
+    print(
+        f"Evaluating {args.backend}{' (mock)' if args.mock else ''} on "
+        f"{len(validation)} examples ({len(validation) - n_negatives} with one of "
+        f"{len(labels)} conditions, {n_negatives} without)\n"
+    )
+    result = asyncio.run(evaluate(backend, validation, args.concurrency))
+    evaluation = report(validation, result, backend, args.price_per_1000_tokens)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(evaluation, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate a condition classifier")
+    parser.add_argument(
+        "--backend", choices=["local", "llm", "filter"], default="local"
+    )
+    parser.add_argument(
+        "--valid-file",
+        default=str(TRAINING_DATA_DIR / "processed_prepared_valid.jsonl"),
+    )
+    parser.add_argument("--limit", type=int, default=None, help="first n examples")
+    parser.add_argument(
+        "--negatives",
+        default=str(ROOT_DIR / "scripts" / "fixtures" / "negatives.jsonl"),
+        help="messages without a condition, empty for none",
+    )
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight")
+    parser.add_argument("--batch-size", type=int, default=20, help="llm: per request")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument(
+        "--candidates",
+        type=int,
+        default=0,
+        help="filter: conditions asked about per sentence, drawn at random, 0 for all",
+    )
+    parser.add_argument("--min-confidence", type=float, default=0.0, help="local")
+    parser.add_argument("--mock", action="store_true", help="simulate openai")
+    parser.add_argument("--mock-accuracy", type=float, default=0.9)
+    parser.add_argument("--mock-latency-ms", type=float, default=400)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--price-per-1000-tokens",
+        type=float,
+        default=0.002,
+        help="like chatgpt_price_per_1000_tokens in config.yml",
+    )
+    parser.add_argument("--output", default=None, help="also write the report as json")
+    main(parser.parse_args())
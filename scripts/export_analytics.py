@@ -0,0 +1,438 @@
+"""
+Incremental export of dialogs, dispositions, disease answers and token usage for
+analytics. Tables are streamed with server-side cursors (bounded memory, no table is
+loaded whole) into compressed files partitioned by day:
+
+    <output-dir>/<table>/date=YYYY-MM-DD/part-<run>-00000.jsonl.gz   (or .parquet)
+
+Watermarks are kept in <output-dir>/_state.json, each run exports only the rows added
+since the previous one. Dialogs are exported once they're final, i.e. no longer the
+current dialog of their user. disease_answer and token usage (user.n_used_tokens, one
+row per user and model) are daily snapshots: answers are replaced when a question is
+answered again, so consumers read the latest snapshot, or keep the latest row per
+(user_id, disease_id, question_id) across snapshots. Files are written under
+temporary names and renamed when the run finishes, then the watermarks are saved.
+
+Point --database-uri (or ANALYTICS_DATABASE_URI) at a read replica to keep the load
+off the bot's database.
+
+    python scripts/export_analytics.py --output-dir exports
+    python scripts/export_analytics.py --format parquet --tables dialog usage
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+import sqlalchemy
+from reddit import get_database_url
+from sqlalchemy import select
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR / "bot"))
+from tables import Dialog, DiseaseAnswer, Disposition, User  # noqa: E402
+
+TABLES = ["dialog", "disposition", "disease_answer", "usage"]
+EXTENSIONS = {"jsonl": "jsonl.gz", "parquet": "parquet"}
+# the columns of every export, "str" columns hold anything else as json
+DIALOG_COLUMNS = [
+    ("id", "int"),
+    ("uid", "str"),
+    ("user_id", "str"),
+    ("chat_mode", "str"),
+    ("model", "str"),
+    ("start_time", "timestamp"),
+    ("n_turns", "int"),
+    ("messages", "str"),
+    ("summary", "str"),
+]
+USAGE_COLUMNS = [
+    ("date", "str"),
+    ("user_id", "str"),
+    ("model", "str"),
+    ("n_input_tokens", "int"),
+    ("n_output_tokens", "int"),
+]
+
+
+def table_columns(table) -> list:
+    """
+    The export columns of a table, from its declared column types
+    """
+    columns = []
+    for column in table.columns:
+        if isinstance(column.type, sqlalchemy.Integer):
+            kind = "int"
+        elif isinstance(column.type, sqlalchemy.Float):
+            kind = "float"
+        elif isinstance(column.type, sqlalchemy.Boolean):
+            kind = "bool"
+        elif isinstance(column.type, sqlalchemy.DateTime):
+            kind = "timestamp"
+        else:
+            kind = "str"
+        columns.append((column.name, kind))
+    return columns
+
+
+def stream(engine, query, chunk_size: int):
+    """
+    Yields lists of rows, with a server-side cursor where the driver has one
+    """
+    with engine.connect() as conn:
+        result = conn.execution_options(
+            stream_results=True, yield_per=chunk_size
+        ).execute(query)
+        for partition in result.partitions():
+            yield partition
+
+
+def day(timestamp) -> str:
+    return timestamp.strftime("%Y-%m-%d") if timestamp else "unknown"
+
+
+class ExportState:
+    def __init__(self, path: Path):
+        self.path = path
+        # table -> last exported id, dialog_pending: ids skipped as current dialogs,
+        # table -> date of its last snapshot
+        self.state = {"last_id": {}, "dialog_pending": [], "snapshot_dates": {}}
+        if path.exists():
+            with open(path, "r") as f:
+                self.state.update(json.load(f))
+
+    def save(self):
+        # replaced atomically, a crash leaves the previous watermarks
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class JsonlPart:
+    def __init__(self, path: Path):
+        self.file = gzip.open(path, "wt", encoding="utf-8", compresslevel=6)
+
+    def write(self, rows: list):
+        for row in rows:
+            self.file.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetPart:
+    """
+    The schema comes from the table's columns, not from the rows, so a column which
+    is all null in the first rows (e.g. disposition.disease_id) keeps its type.
+    Values of "str" columns which aren't strings (json) are written as json.
+    """
+
+    def __init__(self, path: Path, columns: list):
+        import pyarrow  # optional, only needed for parquet
+        import pyarrow.parquet
+
+        types = {
+            "int": pyarrow.int64(),
+            "float": pyarrow.float64(),
+            "bool": pyarrow.bool_(),
+            "timestamp": pyarrow.timestamp("us"),
+            "str": pyarrow.string(),
+        }
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([(name, types[kind]) for name, kind in columns])
+        self.json_columns = [name for name, kind in columns if kind == "str"]
+        self.writer = pyarrow.parquet.ParquetWriter(
+            path, self.schema, compression="zstd"
+        )
+
+    def write(self, rows: list):
+        for row in rows:
+            for name in self.json_columns:
+                value = row.get(name)
+                if value is not None and not isinstance(value, str):
+                    row[name] = json.dumps(value, ensure_ascii=False, default=str)
+        self.writer.write_table(
+            self.pyarrow.Table.from_pylist(rows, schema=self.schema)
+        )
+
+    def close(self):
+        self.writer.close()
+
+
+class PartitionedWriter:
+    """
+    Writes the rows of one table into day partitions, at most `rows_per_file` rows a
+    file and `max_open` files open at once. Files get their final name in `commit`.
+    """
+
+    def __init__(
+        self,
+        table_dir: Path,
+        file_format: str,
+        run_id: str,
+        rows_per_file: int,
+        columns: list,
+        max_open: int = 32,
+    ):
+        self.table_dir = table_dir
+        self.file_format = file_format
+        self.columns = columns
+        self.run_id = run_id
+        self.rows_per_file = rows_per_file
+        self.max_open = max_open
+        # partition -> (part, rows written to it)
+        self._open = OrderedDict()
+        self._n_parts = {}
+        self._written = []
+        self.n_rows = 0
+
+    def write(self, partition: str, rows: list):
+        if not rows:
+            return
+        entry = self._open.pop(partition, None)
+        if entry is not None and entry[1] + len(rows) > self.rows_per_file:
+            entry[0].close()
+            entry = None
+        if entry is None:
+            entry = (self._new_part(partition), 0)
+        part, n_rows = entry
+        part.write(rows)
+        self._open[partition] = (part, n_rows + len(rows))
+        self.n_rows += len(rows)
+        while len(self._open) > self.max_open:
+            _, (part, _) = self._open.popitem(last=False)
+            part.close()
+
+    def _new_part(self, partition: str):
+        number = self._n_parts.get(partition, 0)
+        self._n_parts[partition] = number + 1
+        directory = self.table_dir / f"date={partition}"
+        directory.mkdir(parents=True, exist_ok=True)
+        path = (
+            directory
+            / f"part-{self.run_id}-{number:05d}.{EXTENSIONS[self.file_format]}"
+        )
+        tmp_path = path.with_name(path.name + ".tmp")
+        self._written.append((tmp_path, path))
+        if self.file_format == "parquet":
+            return ParquetPart(tmp_path, self.columns)
+        return JsonlPart(tmp_path)
+
+    def close(self):
+        for part, _ in self._open.values():
+            part.close()
+        self._open.clear()
+
+    def commit(self):
+        self.close()
+        for tmp_path, path in self._written:
+            os.replace(tmp_path, path)
+
+
+def write_by_day(writer: PartitionedWriter, rows: list, timestamp_key: str):
+    by_day = {}
+    for row in rows:
+        by_day.setdefault(day(row[timestamp_key]), []).append(row)
+    for partition, partition_rows in by_day.items():
+        writer.write(partition, partition_rows)
+
+
+def dialog_row(row) -> dict:
+    messages = row.messages or []
+    return {
+        "id": row.id,
+        "uid": row.uid,
+        "user_id": row.user_id,
+        "chat_mode": row.chat_mode,
+        "model": row.model,
+        "start_time": row.start_time,
+        "n_turns": len(messages),
+        "messages": json.dumps(messages, ensure_ascii=False),
+        "summary": row.summary or "",
+    }
+
+
+def export_dialogs(engine, writer: PartitionedWriter, state: dict, args):
+    """
+    The current dialog of a user still changes, it's skipped and its id kept in
+    dialog_pending (at most one per user) until the user starts another one
+    """
+    table = Dialog.__table__
+    current = select(User.__table__.c.current_dialog_id).where(
+        User.__table__.c.user_id == table.c.user_id
+    )
+    columns = [
+        table.c[name]
+        for name in (
+            "id",
+            "uid",
+            "user_id",
+            "chat_mode",
+            "model",
+            "start_time",
+            "messages",
+            "summary",
+        )
+    ]
+    is_current = (
+        sqlalchemy.func.coalesce(current.scalar_subquery(), "") == table.c.uid
+    ).label("is_current")
+    last_id = state["last_id"].get("dialog", 0)
+    pending = state["dialog_pending"]
+    still_pending = []
+    # only ids first, the pending dialogs which became final are read whole
+    finished = []
+    for i in range(0, len(pending), args.chunk_size):
+        query = select(table.c.id, is_current).where(
+            table.c.id.in_(pending[i : i + args.chunk_size])
+        )
+        for rows in stream(engine, query, args.chunk_size):
+            for row in rows:
+                (still_pending if row.is_current else finished).append(row.id)
+    # pending dialogs which are gone were archived or deleted, they aren't exported
+    queries = [
+        select(*columns).where(table.c.id.in_(finished[i : i + args.chunk_size]))
+        for i in range(0, len(finished), args.chunk_size)
+    ]
+    for query in queries:
+        for rows in stream(engine, query, args.chunk_size):
+            write_by_day(writer, [dialog_row(row) for row in rows], "start_time")
+    query = select(*columns, is_current).where(table.c.id > last_id)
+    for rows in stream(engine, query.order_by(table.c.id), args.chunk_size):
+        final = []
+        for row in rows:
+            if row.is_current:
+                still_pending.append(row.id)
+            else:
+                final.append(dialog_row(row))
+            last_id = row.id
+        write_by_day(writer, final, "start_time")
+    state["dialog_pending"] = sorted(still_pending)
+    state["last_id"]["dialog"] = last_id
+
+
+def export_appended(engine, writer: PartitionedWriter, state: dict, model, args):
+    """
+    Append-only tables, by id past the watermark
+    """
+    table = model.__table__
+    name = table.name
+    last_id = state["last_id"].get(name, 0)
+    query = select(table).where(table.c.id > last_id).order_by(table.c.id)
+    for rows in stream(engine, query, args.chunk_size):
+        rows = [dict(row._mapping) for row in rows]
+        write_by_day(writer, rows, "timestamp")
+        last_id = rows[-1]["id"]
+    state["last_id"][name] = last_id
+
+
+def export_disease_answers(engine, writer: PartitionedWriter, state: dict, args):
+    """
+    Snapshot of disease_answer, once a day. Answering a question again replaces the
+    answer's row, so its ids aren't a watermark: a snapshot holds the current answer
+    of every (user_id, disease_id, question_id), older snapshots the replaced ones.
+    """
+    today = datetime.utcnow().strftime("%Y-%m-%d")
+    if state["snapshot_dates"].get("disease_answer") == today:
+        return
+    table = DiseaseAnswer.__table__
+    query = select(table).order_by(table.c.id)
+    for rows in stream(engine, query, args.chunk_size):
+        writer.write(today, [{"date": today, **row._mapping} for row in rows])
+    state["snapshot_dates"]["disease_answer"] = today
+
+
+def export_usage(engine, writer: PartitionedWriter, state: dict, args):
+    """
+    Snapshot of n_used_tokens, once a day
+    """
+    today = datetime.utcnow().strftime("%Y-%m-%d")
+    if state["snapshot_dates"].get("usage") == today:
+        return
+    table = User.__table__
+    query = select(table.c.user_id, table.c.n_used_tokens).order_by(table.c.id)
+    for rows in stream(engine, query, args.chunk_size):
+        usage_rows = []
+        for row in rows:
+            n_used_tokens = row.n_used_tokens
+            if not isinstance(n_used_tokens, dict):
+                # users who haven't written since before tokens were counted per model
+                n_used_tokens = {"gpt-4": {"n_output_tokens": n_used_tokens or 0}}
+            for model, usage in n_used_tokens.items():
+                usage_rows.append(
+                    {
+                        "date": today,
+                        "user_id": row.user_id,
+                        "model": model,
+                        "n_input_tokens": usage.get("n_input_tokens", 0),
+                        "n_output_tokens": usage.get("n_output_tokens", 0),
+                    }
+                )
+        writer.write(today, usage_rows)
+    state["snapshot_dates"]["usage"] = today
+
+
+def main(args):
+    engine = sqlalchemy.create_engine(
+        args.database_uri
+        or os.environ.get("ANALYTICS_DATABASE_URI")
+        or get_database_url()
+    )
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # files of an interrupted run, its watermarks weren't saved
+    for tmp_path in output_dir.glob("*/date=*/*.tmp"):
+        tmp_path.unlink()
+    state = ExportState(output_dir / "_state.json")
+    run_id = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    columns = {
+        "dialog": DIALOG_COLUMNS,
+        "disposition": table_columns(Disposition.__table__),
+        "disease_answer": [("date", "str")] + table_columns(DiseaseAnswer.__table__),
+        "usage": USAGE_COLUMNS,
+    }
+    writers = []
+    for name in args.tables:
+        started = time.perf_counter()
+        writer = PartitionedWriter(
+            output_dir / name, args.format, run_id, args.rows_per_file, columns[name]
+        )
+        writers.append(writer)
+        try:
+            if name == "dialog":
+                export_dialogs(engine, writer, state.state, args)
+            elif name == "disposition":
+                export_appended(engine, writer, state.state, Disposition, args)
+            elif name == "disease_answer":
+                export_disease_answers(engine, writer, state.state, args)
+            else:
+                export_usage(engine, writer, state.state, args)
+        finally:
+            writer.close()
+        print(f"{name}: {writer.n_rows} rows in {time.perf_counter() - started:.1f}s")
+    for writer in writers:
+        writer.commit()
+    state.save()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export tables for analytics")
+    parser.add_argument("--output-dir", default="exports")
+    parser.add_argument(
+        "--tables", nargs="+", choices=TABLES, default=TABLES, help="default: all"
+    )
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    parser.add_argument(
+        "--database-uri",
+        default=None,
+        help="a read replica, defaults to ANALYTICS_DATABASE_URI or the bot's database",
+    )
+    parser.add_argument("--chunk-size", type=int, default=5000, help="rows per fetch")
+    parser.add_argument("--rows-per-file", type=int, default=1_000_000)
+    main(parser.parse_args())
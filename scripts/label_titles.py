@@ -0,0 +1,241 @@
+"""
+Batch auto-labeling of the scraped reddit_ask_docs titles into training data.
+Titles are streamed from the database in id order and labeled by the local naive Bayes
+classifier in a process pool, by batched openai requests, or by both (hybrid: titles
+the local classifier is unsure about go to openai). Labeled titles are written to jsonl
+shards in the {"prompt", "completion"} format of training_data/data.jsonl (lowercase
+prompts, labels without the per-condition files' misspellings), and progress
+is checkpointed after every chunk, so an interrupted run continues where it stopped.
+
+    python scripts/label_titles.py --backend local --output-dir training_data/labeled
+    python scripts/label_titles.py --backend hybrid --min-confidence 0.9 --workers 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import sqlalchemy
+from classifiers import (
+    NO_CONDITION,
+    LLMClassifier,
+    NaiveBayesClassifier,
+    load_examples,
+    normalize_label,
+    normalize_prompt,
+)
+from reddit import RedditAskDocs, get_database_url
+from sqlalchemy import select
+
+_worker_classifier = None
+
+
+def _init_worker(classifier_dict: dict):
+    global _worker_classifier
+    _worker_classifier = NaiveBayesClassifier.from_dict(classifier_dict)
+
+
+def label_chunk(chunk: list, min_confidence: float) -> list:
+    """
+    Runs in a worker process
+    :return: (id, title, label, confidence) of every (id, title)
+    """
+    return [
+        (post_id, title, *_worker_classifier.predict(title, min_confidence))
+        for post_id, title in chunk
+    ]
+
+
+def stream_titles(engine, after_id: int, chunk_size: int, limit: int = None):
+    """
+    Yields lists of (id, title), with a server-side cursor where the driver has one
+    """
+    table = RedditAskDocs.__table__
+    query = select(table.c.id, table.c.title).where(table.c.id > after_id)
+    query = query.order_by(table.c.id)
+    if limit:
+        query = query.limit(limit)
+    with engine.connect() as conn:
+        result = conn.execution_options(
+            stream_results=True, yield_per=chunk_size
+        ).execute(query)
+        for partition in result.partitions():
+            yield [(row.id, row.title) for row in partition]
+
+
+class Checkpoint:
+    def __init__(self, path: Path):
+        self.path = path
+        self.state = {
+            "last_id": 0,
+            "shard": 0,
+            "shard_lines": 0,
+            "shard_bytes": 0,
+            "labels": {},
+        }
+        if path.exists():
+            with open(path, "r") as f:
+                self.state.update(json.load(f))
+
+    def save(self):
+        # replaced atomically, a crash leaves the previous checkpoint
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class ShardWriter:
+    """
+    Appends to numbered jsonl shards of at most `shard_size` lines. Resuming truncates
+    the current shard to the checkpoint, dropping lines written after it.
+    """
+
+    def __init__(self, output_dir: Path, shard_size: int, checkpoint: Checkpoint):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.checkpoint = checkpoint
+        self._file = None
+        self._open()
+
+    def _path(self) -> Path:
+        return self.output_dir / f"labels-{self.checkpoint.state['shard']:05d}.jsonl"
+
+    def _open(self):
+        path = self._path()
+        self._file = open(path, "a+b")
+        self._file.truncate(self.checkpoint.state["shard_bytes"])
+        self._file.seek(0, os.SEEK_END)
+
+    def write(self, prompt: str, completion: str):
+        state = self.checkpoint.state
+        if state["shard_lines"] >= self.shard_size:
+            self._file.close()
+            state.update(shard=state["shard"] + 1, shard_lines=0, shard_bytes=0)
+            self._open()
+        line = json.dumps({"prompt": prompt, "completion": completion})
+        self._file.write(line.encode("utf-8") + b"\n")
+        state["shard_lines"] += 1
+
+    def commit(self, last_id: int):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.checkpoint.state["shard_bytes"] = self._file.tell()
+        self.checkpoint.state["last_id"] = last_id
+        self.checkpoint.save()
+
+    def close(self):
+        self._file.close()
+
+
+def main(args):
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    checkpoint = Checkpoint(Path(args.checkpoint or output_dir / "checkpoint.json"))
+    if checkpoint.state["last_id"]:
+        print(f"Resuming after id {checkpoint.state['last_id']}")
+    writer = ShardWriter(output_dir, args.shard_size, checkpoint)
+    label_counts = Counter(checkpoint.state["labels"])
+    classifier = NaiveBayesClassifier().fit(load_examples())
+    llm = None
+    if args.backend in ("llm", "hybrid"):
+        llm = LLMClassifier(
+            classifier.labels,
+            model=args.model,
+            batch_size=args.llm_batch_size,
+            concurrency=args.llm_concurrency,
+        )
+    engine = sqlalchemy.create_engine(args.database_uri or get_database_url())
+    started = time.monotonic()
+    n_titles = 0
+
+    def handle(labeled: list):
+        nonlocal n_titles
+        if llm is not None:
+            # llm only: nothing was labeled locally, hybrid: the unsure titles
+            unsure = [
+                i
+                for i, (_, _, label, _) in enumerate(labeled)
+                if args.backend == "llm" or label == NO_CONDITION
+            ]
+            llm_labels = asyncio.run(llm.classify([labeled[i][1] for i in unsure]))
+            for i, label in zip(unsure, llm_labels):
+                labeled[i] = (labeled[i][0], labeled[i][1], label, None)
+        for _, title, label, _ in labeled:
+            label_counts[label] += 1
+            if label != NO_CONDITION or args.include_none:
+                writer.write(normalize_prompt(title), normalize_label(label))
+        checkpoint.state["labels"] = dict(label_counts)
+        writer.commit(labeled[-1][0])
+        n_titles += len(labeled)
+        print(
+            f"{n_titles} titles in {time.monotonic() - started:.0f}s, "
+            f"up to id {labeled[-1][0]}"
+        )
+
+    min_confidence = args.min_confidence
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        initializer=_init_worker,
+        initargs=(classifier.to_dict(),),
+    ) as executor:
+        # in order, and at most two chunks per worker in flight to bound memory
+        pending = deque()
+        for chunk in stream_titles(
+            engine, checkpoint.state["last_id"], args.chunk_size, args.limit
+        ):
+            if args.backend == "llm":
+                handle(
+                    [(post_id, title, NO_CONDITION, None) for post_id, title in chunk]
+                )
+                continue
+            pending.append(executor.submit(label_chunk, chunk, min_confidence))
+            if len(pending) >= 2 * args.workers:
+                handle(pending.popleft().result())
+        while pending:
+            handle(pending.popleft().result())
+    writer.close()
+    print(f"Labels: {dict(label_counts.most_common())}")
+    if llm is not None:
+        print(
+            f"openai tokens: {llm.n_input_tokens} input, {llm.n_output_tokens} output"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--backend", choices=["local", "llm", "hybrid"], default="local"
+    )
+    parser.add_argument(
+        "--min-confidence",
+        type=float,
+        default=0.8,
+        help="local labels below this are 'none' (hybrid: sent to openai)",
+    )
+    parser.add_argument(
+        "--include-none", action="store_true", help="also write 'none' labels"
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--chunk-size", type=int, default=2000, help="titles per task and checkpoint"
+    )
+    parser.add_argument("--shard-size", type=int, default=10000, help="lines per shard")
+    parser.add_argument("--output-dir", default="training_data/labeled")
+    parser.add_argument(
+        "--checkpoint", default=None, help="default <output-dir>/checkpoint.json"
+    )
+    parser.add_argument("--limit", type=int, default=None, help="titles in this run")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument(
+        "--llm-batch-size", type=int, default=20, help="titles per request"
+    )
+    parser.add_argument("--llm-concurrency", type=int, default=4)
+    parser.add_argument(
+        "--database-uri", default=None, help="defaults to the bot's database"
+    )
+    main(parser.parse_args())
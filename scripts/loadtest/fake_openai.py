@@ -0,0 +1,121 @@
+import asyncio
+import json
+import re
+import threading
+import time
+import uuid
+
+from aiohttp import web
+
+# every streamed answer ends with this, so the harness can tell when a reply is complete
+END_MARKER = "[done]"
+
+
+class FakeOpenAI:
+    """
+    Stand-in for the openai chat completions api.
+    Streams `answer_tokens` words at `token_rate` tokens/second after `latency` seconds.
+    Classification prompts are answered "yes" when the sentence mentions the condition.
+    It runs on its own thread and event loop, because the bot's classifier filters call
+    openai synchronously from the bot's event loop.
+    """
+
+    def __init__(
+        self,
+        token_rate: float = 50.0,
+        latency: float = 0.3,
+        answer_tokens: int = 60,
+        host: str = "127.0.0.1",
+    ):
+        self.token_rate = token_rate
+        self.latency = latency
+        self.answer_tokens = answer_tokens
+        self.host = host
+        self.port = None
+        self.n_requests = {"stream": 0, "classification": 0}
+        self._loop = None
+        self._runner = None
+        self._started = threading.Event()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    def _classify(self, messages: list) -> str:
+        prompt = messages[-1]["content"]
+        match = re.search(r"indicating (.+?)\?\nSentence: (.*)", prompt, re.S)
+        if match and match.group(1).lower() in match.group(2).lower():
+            return "yes"
+        return "no"
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        model = body.get("model", "gpt-4")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        await asyncio.sleep(self.latency)
+        if not body.get("stream"):
+            self.n_requests["classification"] += 1
+            return web.json_response(
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": self._classify(body["messages"]),
+                            },
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {},
+                }
+            )
+        self.n_requests["stream"] += 1
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        tokens = [f"word{i} " for i in range(self.answer_tokens)] + [END_MARKER]
+        for token in tokens:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {"index": 0, "delta": {"content": token}, "finish_reason": None}
+                ],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(1 / self.token_rate)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, 0)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self._start())
+        self._started.set()
+        self._loop.run_forever()
+
+    def start(self):
+        threading.Thread(target=self._run, name="fake-openai", daemon=True).start()
+        self._started.wait()
+
+    def stop(self):
+        if self._loop is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop)
+        future.result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+BOT_USER = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "Maya",
+    "username": "loadtest_bot",
+}
+
+
+def _decode(value: str):
+    # python-telegram-bot sends form fields, objects and lists are json encoded
+    if value[:1] in ("{", "["):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+
+class FakeTelegram:
+    """
+    Stand-in for the Telegram Bot API, runs on the caller's event loop.
+    Updates are queued with `push_update` and handed out through getUpdates, every bot
+    call that sends or edits a message is reported to `listener(method, chat_id, text)`.
+    """
+
+    def __init__(self, token: str, host: str = "127.0.0.1"):
+        self.token = token
+        self.host = host
+        self.port = None
+        self.listener = None
+        self.n_calls = defaultdict(int)
+        self._updates = []
+        self._next_update_id = 1
+        self._next_message_id = defaultdict(lambda: 1)
+        self._new_updates = asyncio.Condition()
+        self._runner = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+
+    def _message(self, chat_id: int, text: str, from_user: dict) -> dict:
+        message_id = self._next_message_id[chat_id]
+        self._next_message_id[chat_id] += 1
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": from_user,
+            "text": text,
+        }
+
+    async def push_update(self, user_id: int, username: str, text: str) -> int:
+        from_user = {
+            "id": user_id,
+            "is_bot": False,
+            "first_name": username,
+            "username": username,
+        }
+        message = self._message(user_id, text, from_user)
+        if text.startswith("/"):
+            message["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}
+            ]
+        update_id = self._next_update_id
+        self._next_update_id += 1
+        async with self._new_updates:
+            self._updates.append({"update_id": update_id, "message": message})
+            self._new_updates.notify_all()
+        return update_id
+
+    async def get_updates(self, params: dict):
+        offset = int(params.get("offset", 0) or 0)
+        timeout = float(params.get("timeout", 0) or 0)
+        # updates before offset were confirmed by the bot
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout > 0:
+            async with self._new_updates:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        return list(self._updates)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.n_calls[method] += 1
+        params = {key: _decode(value) for key, value in (await request.post()).items()}
+        if method == "getUpdates":
+            result = await self.get_updates(params)
+        elif method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            result = self._message(chat_id, params.get("text", ""), BOT_USER)
+            if method == "editMessageText":
+                result["message_id"] = int(params["message_id"])
+            if self.listener is not None:
+                self.listener(method, chat_id, params.get("text", ""))
+        else:
+            # sendChatAction, setMyCommands, deleteWebhook, answerCallbackQuery, ...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(f"/bot{self.token}/{{method}}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, 0)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
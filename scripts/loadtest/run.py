@@ -0,0 +1,349 @@
+"""
+End-to-end load test: runs the bot in-process against a fake Telegram Bot API and a fake
+openai streaming server, replays scripted user sessions (see sessions.py) and reports
+time-to-first-edit, total reply time and db queries per update.
+
+    python scripts/loadtest/run.py --users 100 --concurrency 20 --sessions chat,disease
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import yaml
+from fake_openai import END_MARKER, FakeOpenAI
+from fake_telegram import FakeTelegram
+from sessions import SESSIONS
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from telegram.ext import ApplicationBuilder
+
+ROOT_DIR = Path(__file__).resolve().parent.parent.parent
+BOT_DIR = ROOT_DIR / "bot"
+TELEGRAM_TOKEN = "123456:loadtest"
+FIRST_USER_ID = 10000
+
+current_update_id = contextvars.ContextVar("current_update_id", default=None)
+queries_per_update = defaultdict(int)
+
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    update_id = current_update_id.get()
+    if update_id is not None:
+        queries_per_update[update_id] += 1
+
+
+def counting_application_class():
+    # tracing reads the config, so it can only be imported once the config is written
+    from tracing import TracingApplication
+
+    class CountingApplication(TracingApplication):
+        """
+        Tags every sql statement issued while processing an update with its update_id
+        """
+
+        async def process_update(self, update: object) -> None:
+            token = current_update_id.set(getattr(update, "update_id", None))
+            try:
+                await super().process_update(update)
+            finally:
+                current_update_id.reset(token)
+
+    return CountingApplication
+
+
+class StepWaiter:
+    def __init__(self, step):
+        self.step = step
+        self.started = time.monotonic()
+        self.first_reply = None
+        self.first_edit = None
+        self.finished = None
+        self.n_replies = 0
+        self.done = asyncio.Event()
+
+    def record(self, method: str, text: str):
+        now = time.monotonic()
+        if self.first_reply is None:
+            self.first_reply = now
+        if method == "editMessageText":
+            if self.first_edit is None:
+                self.first_edit = now
+            if self.step.kind == "stream" and END_MARKER in text:
+                self.finish(now)
+        else:
+            self.n_replies += 1
+            if self.step.kind == "reply" and self.n_replies >= self.step.n_replies:
+                self.finish(now)
+
+    def finish(self, now: float):
+        if self.finished is None:
+            self.finished = now
+            self.done.set()
+
+    def elapsed(self, timestamp):
+        return None if timestamp is None else timestamp - self.started
+
+
+class Harness:
+    def __init__(self, telegram: FakeTelegram, step_timeout: float, think_time: float):
+        self.telegram = telegram
+        self.step_timeout = step_timeout
+        self.think_time = think_time
+        self.waiters = {}
+        self.results = []
+        telegram.listener = self.on_bot_call
+
+    def on_bot_call(self, method: str, chat_id: int, text: str):
+        waiter = self.waiters.get(chat_id)
+        if waiter is not None:
+            waiter.record(method, text)
+
+    async def run_user(self, user_index: int, session_name: str):
+        user_id = FIRST_USER_ID + user_index
+        username = f"loaduser{user_index}"
+        for step in SESSIONS[session_name]:
+            waiter = StepWaiter(step)
+            self.waiters[user_id] = waiter
+            update_id = await self.telegram.push_update(user_id, username, step.text)
+            try:
+                await asyncio.wait_for(waiter.done.wait(), self.step_timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.results.append(
+                {
+                    "session": session_name,
+                    "step": step.name,
+                    "update_id": update_id,
+                    "timed_out": waiter.finished is None,
+                    "first_reply": waiter.elapsed(waiter.first_reply),
+                    "first_edit": waiter.elapsed(waiter.first_edit),
+                    "total": waiter.elapsed(waiter.finished),
+                }
+            )
+            if waiter.finished is None:
+                # the bot is stuck on this user, the rest of the script would be noise
+                break
+            await asyncio.sleep(self.think_time)
+        self.waiters.pop(user_id, None)
+
+    async def run(self, n_users: int, concurrency: int, session_names: list):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(user_index):
+            async with semaphore:
+                await self.run_user(
+                    user_index, session_names[user_index % len(session_names)]
+                )
+
+        await asyncio.gather(*(limited(i) for i in range(n_users)))
+
+
+def write_config(
+    config_dir: Path,
+    database_uri: str,
+    telegram: FakeTelegram,
+    openai: FakeOpenAI,
+    trace_file: str = None,
+):
+    with open(ROOT_DIR / "config" / "config.example.yml", "r") as f:
+        config_yaml = yaml.safe_load(f)
+    config_yaml.update(
+        {
+            "telegram_token": TELEGRAM_TOKEN,
+            "openai_api_key": "sk-loadtest",
+            "allowed_telegram_usernames": [],
+            "developer_telegram_chatid": 1,
+            "admin_telegram_username": "loadtest_admin",
+            "telegram_api_base_url": telegram.base_url,
+            "openai_api_base": openai.base_url,
+        }
+    )
+    if trace_file:
+        config_yaml["tracing"] = {
+            "enabled": True,
+            "sample_ratio": 1.0,
+            "exporter": "file",
+            "file_path": trace_file,
+        }
+    with open(config_dir / "config.yml", "w") as f:
+        yaml.safe_dump(config_yaml, f)
+    with open(config_dir / "config.env", "w") as f:
+        f.write(f"DATABASE_URI={database_uri}\n")
+    with open(ROOT_DIR / "config" / "chat_modes.yml", "r") as src, open(
+        config_dir / "chat_modes.yml", "w"
+    ) as dst:
+        dst.write(src.read())
+
+
+def seed_catalog(disease_names: list, n_questions: int):
+    from mysql import MySQL
+    from tables import Disease, DiseaseQuestion, Medicine
+
+    mysql_db = MySQL()
+    mysql_db.create_tables_if_not_exists()
+    session = mysql_db.Session()
+    try:
+        if session.query(Disease).count() > 0:
+            return
+        for disease_name in disease_names:
+            disease = Disease(detail=disease_name)
+            session.add(disease)
+            session.flush()
+            for i in range(n_questions):
+                session.add(
+                    DiseaseQuestion(
+                        detail=f"Question {i + 1} about your {disease_name}?",
+                        disease_id=disease.id,
+                        value=None,
+                    )
+                )
+            for medicine_type in ("painkiller", "ointment"):
+                session.add(
+                    Medicine(
+                        detail=f"{medicine_type} for {disease_name}",
+                        type=medicine_type,
+                        disease_id=disease.id,
+                    )
+                )
+        session.commit()
+    finally:
+        session.close()
+
+
+def percentiles(values: list) -> dict:
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    return {
+        f"p{p}": values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+        for p in (50, 95, 99)
+    }
+
+
+def build_report(results: list, elapsed: float, openai: FakeOpenAI) -> dict:
+    steps = defaultdict(list)
+    for result in results:
+        result["db_queries"] = queries_per_update.get(result["update_id"], 0)
+        steps[result["step"]].append(result)
+    report = {
+        "elapsed": elapsed,
+        "updates": len(results),
+        "updates_per_second": len(results) / elapsed if elapsed else None,
+        "openai_requests": dict(openai.n_requests),
+        "steps": {},
+    }
+    for step_name, step_results in steps.items():
+        report["steps"][step_name] = {
+            "n": len(step_results),
+            "timeouts": sum(result["timed_out"] for result in step_results),
+            "first_reply": percentiles([r["first_reply"] for r in step_results]),
+            "first_edit": percentiles([r["first_edit"] for r in step_results]),
+            "total": percentiles([r["total"] for r in step_results]),
+            "db_queries_per_update": sum(r["db_queries"] for r in step_results)
+            / len(step_results),
+        }
+    return report
+
+
+def print_report(report: dict):
+    def fmt(stats):
+        return "/".join("-" if v is None else f"{v * 1000:.0f}" for v in stats.values())
+
+    print(
+        f"{report['updates']} updates in {report['elapsed']:.1f}s "
+        f"({report['updates_per_second']:.1f} updates/s), "
+        f"openai requests: {report['openai_requests']}"
+    )
+    print(
+        f"{'step':<16}{'n':>6}{'timeouts':>10}  {'first reply ms':<18}"
+        f"{'first edit ms':<18}{'total ms':<18}{'queries/update':>14}"
+    )
+    print("  (p50/p95/p99)")
+    for step_name, stats in report["steps"].items():
+        print(
+            f"{step_name:<16}{stats['n']:>6}{stats['timeouts']:>10}  "
+            f"{fmt(stats['first_reply']):<18}{fmt(stats['first_edit']):<18}"
+            f"{fmt(stats['total']):<18}{stats['db_queries_per_update']:>14.1f}"
+        )
+
+
+async def main(args):
+    work_dir = Path(tempfile.mkdtemp(prefix="medicalgpt-loadtest-"))
+    openai = FakeOpenAI(
+        token_rate=args.token_rate,
+        latency=args.openai_latency,
+        answer_tokens=args.answer_tokens,
+    )
+    openai.start()
+    telegram = FakeTelegram(TELEGRAM_TOKEN)
+    await telegram.start()
+    write_config(
+        work_dir,
+        args.database_uri or f"sqlite:///{work_dir / 'loadtest.db'}",
+        telegram,
+        openai,
+        args.trace_file,
+    )
+    # the bot modules read their config at import time
+    os.environ["MEDICALGPT_CONFIG_DIR"] = str(work_dir)
+    sys.path.insert(0, str(BOT_DIR))
+    event.listen(Engine, "before_cursor_execute", count_query)
+    seed_catalog(args.diseases.split(","), args.questions)
+    import handlers  # noqa: F401, must be imported before bot (circular import)
+
+    import bot
+
+    application = bot.build_application(
+        ApplicationBuilder().application_class(counting_application_class())
+    )
+    harness = Harness(telegram, args.step_timeout, args.think_time)
+    async with application:
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+        await application.start()
+        started = time.monotonic()
+        await harness.run(args.users, args.concurrency, args.sessions.split(","))
+        elapsed = time.monotonic() - started
+        await application.updater.stop()
+        await application.stop()
+    await telegram.stop()
+    openai.stop()
+    report = build_report(harness.results, elapsed, openai)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"report": report, "results": harness.results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--sessions",
+        default="chat,registration,disease",
+        help=f"comma separated, from: {', '.join(SESSIONS)}",
+    )
+    parser.add_argument(
+        "--database-uri",
+        default=None,
+        help="sqlalchemy url, defaults to a fresh sqlite file",
+    )
+    parser.add_argument("--diseases", default="headache,back pain,rash")
+    parser.add_argument("--questions", type=int, default=3)
+    parser.add_argument("--token-rate", type=float, default=50.0)
+    parser.add_argument("--openai-latency", type=float, default=0.3)
+    parser.add_argument("--answer-tokens", type=int, default=60)
+    parser.add_argument("--think-time", type=float, default=0.2)
+    parser.add_argument("--step-timeout", type=float, default=30.0)
+    parser.add_argument(
+        "--trace-file", default=None, help="trace every update into this jsonl file"
+    )
+    parser.add_argument("--output", default=None, help="write a json report here")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,44 @@
+from collections import namedtuple
+
+# kind "reply": done after `n_replies` sent messages
+# kind "stream": done once an edited message contains the fake openai END_MARKER
+Step = namedtuple("Step", ["name", "text", "kind", "n_replies"])
+
+
+def reply(name: str, text: str, n_replies: int = 1) -> Step:
+    return Step(name, text, "reply", n_replies)
+
+
+def stream(name: str, text: str) -> Step:
+    return Step(name, text, "stream", 0)
+
+
+# scripted synthetic user sessions, every virtual user starts as a new user
+SESSIONS = {
+    "registration": [
+        reply("start", "/start"),
+        reply("register", "/register"),
+        reply("registration", "34"),
+        reply("registration", "Male"),
+        reply("registration", "Penicillin"),
+        reply("registration", "Asthma"),
+        reply("registration", "/skip"),
+        reply("registration", "/skip"),
+    ],
+    "chat": [
+        reply("start", "/start"),
+        reply("new", "/new", n_replies=2),
+        stream("message", "I have had a mild fever and a sore throat since yesterday"),
+        stream("message", "It gets worse in the evening, what should I take?"),
+        stream("retry", "/retry"),
+    ],
+    # the fake openai classifies a sentence as a condition when it names the condition
+    "disease": [
+        reply("start", "/start"),
+        reply("disease_start", "I have a terrible headache"),
+        reply("diagnose", "/diagnose"),
+        reply("diagnosis", "2 days"),
+        reply("diagnosis", "no"),
+        reply("diagnosis", "5"),
+    ],
+}
@@ -1,67 +1,337 @@
+"""
+Incremental ingester of r/AskDocs post titles into reddit_ask_docs.
+Posts are streamed from the `new` listing and upserted in batches, each batch commits
+the cursor too, so an interrupted run resumes where it stopped and a finished run
+makes the next one stop at the newest post it stored.
+
+    python scripts/reddit.py                        # live, needs REDDIT_* in config.env
+    python scripts/reddit.py --listing top          # one-off backfill of the top posts
+    python scripts/reddit.py --record posts.jsonl   # also record the posts as a fixture
+    python scripts/reddit.py --fixture scripts/fixtures/reddit_askdocs.jsonl  # offline
+"""
+import argparse
+import hashlib
+import json
 import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
 
 import dotenv
-import praw
 import sqlalchemy
+from sqlalchemy import insert, inspect, select, text, update
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR / "bot"))
+from tables import RedditAskDocs, RedditIngestCursor  # noqa: E402
 
 dotenv.load_dotenv(
     "config/config.env",
 )
 
+SUBREDDIT = "AskDocs"
+# columns added to reddit_ask_docs tables created before the ingester kept a cursor
+MIGRATED_COLUMNS = {
+    "post_id": "VARCHAR(16)",
+    "title_hash": "VARCHAR(64)",
+    "created_utc": "FLOAT",
+    "timestamp": "DATETIME",
+}
 
-REDDIT_THREAD = os.environ["REDDIT_THREAD"]
-REDDIT_SECRET_ID = os.environ["REDDIT_SECRET_ID"]
-REDDIT_CLIENT_ID = os.environ["REDDIT_CLIENT_ID"]
-MYSQL_USER = os.environ["MYSQL_USER"]
-MYSQL_PASSWORD = os.environ["MYSQL_PASSWORD"]
-MYSQL_PORT = os.environ["MYSQL_PORT"]
-MYSQL_DATABASE = os.environ["MYSQL_DATABASE"]
-MYSQL_HOST = os.environ["MYSQL_HOST"]
 
+def get_database_url():
+    """
+    DATABASE_URI takes any sqlalchemy url, otherwise mysql is built from MYSQL_*
+    """
+    if os.environ.get("DATABASE_URI"):
+        return os.environ["DATABASE_URI"]
+    return sqlalchemy.engine.url.URL(
+        drivername="mysql+pymysql",
+        username=os.environ["MYSQL_USER"],
+        password=os.environ["MYSQL_PASSWORD"],
+        host=os.environ["MYSQL_HOST"],
+        port=int(os.environ["MYSQL_PORT"]),
+        database=os.environ["MYSQL_DATABASE"],
+        query={"charset": "utf8mb4"},
+    )
 
-def scrape_titles():
-    try:
-        reddit = praw.Reddit(
-            client_id=REDDIT_CLIENT_ID,
-            client_secret=REDDIT_SECRET_ID,
-            user_agent="MedicalGPT",
-        )
-        engine = sqlalchemy.create_engine(
-            sqlalchemy.engine.url.URL(
-                drivername="mysql+pymysql",
-                username=MYSQL_USER,
-                password=MYSQL_PASSWORD,
-                host=MYSQL_HOST,
-                port=int(MYSQL_PORT),
-                database=MYSQL_DATABASE,
-                query={"charset": "utf8mb4"},
-            ),
+
+def title_hash(title: str) -> str:
+    normalized = " ".join(title.lower().split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def has_unique_index(inspector, column: str) -> bool:
+    unique_columns = [
+        index["column_names"]
+        for index in inspector.get_indexes("reddit_ask_docs")
+        if index.get("unique")
+    ] + [
+        constraint["column_names"]
+        for constraint in inspector.get_unique_constraints("reddit_ask_docs")
+    ]
+    return [column] in unique_columns
+
+
+def migrate(engine, batch_size: int = 1000):
+    """
+    Creates the tables, or brings an existing reddit_ask_docs (id, title) up to date:
+    adds the new columns, hashes the stored titles, removes duplicate titles and
+    adds the unique indexes
+    """
+    inspector = inspect(engine)
+    if not inspector.has_table(RedditAskDocs.__tablename__):
+        RedditAskDocs.metadata.create_all(
+            engine, tables=[RedditAskDocs.__table__, RedditIngestCursor.__table__]
         )
-        with engine.connect() as conn:
-            all_posts = reddit.subreddit("AskDocs").top(time_filter="all", limit=None)
-            existing_titles = conn.execute(
-                sqlalchemy.text("SELECT title FROM reddit_ask_docs")
+        return
+    RedditIngestCursor.__table__.create(engine, checkfirst=True)
+    columns = {column["name"] for column in inspector.get_columns("reddit_ask_docs")}
+    with engine.begin() as conn:
+        for column, column_type in MIGRATED_COLUMNS.items():
+            if column not in columns:
+                print(f"Adding reddit_ask_docs.{column}")
+                conn.execute(
+                    text(
+                        f"ALTER TABLE reddit_ask_docs ADD COLUMN {column} {column_type}"
+                    )
+                )
+    table = RedditAskDocs.__table__
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select(table.c.id, table.c.title)
+                .where(table.c.id > last_id, table.c.title_hash.is_(None))
+                .order_by(table.c.id)
+                .limit(batch_size)
             ).fetchall()
-            existing_titles = [title[0] for title in existing_titles]
-            titles_to_insert = []
-            for post in all_posts:
-                if post.title not in existing_titles:
-                    titles_to_insert.append(post.title)
-            print(f"Found {len(titles_to_insert)} new titles to insert.")
-            if titles_to_insert:
+            if not rows:
+                break
+            for row in rows:
                 conn.execute(
-                    sqlalchemy.text(
-                        "INSERT INTO reddit_ask_docs (title) VALUES (:title)"
-                    ),
-                    [{"title": title} for title in titles_to_insert],
+                    update(table)
+                    .where(table.c.id == row.id)
+                    .values(title_hash=title_hash(row.title))
                 )
-                conn.commit()
-            print("Finished inserting titles.")
-    except:
-        import traceback
+        last_id = rows[-1].id
+        print(f"Hashed titles up to id {last_id}")
+    with engine.begin() as conn:
+        if not has_unique_index(inspector, "title_hash"):
+            # keep the first copy of every title, the unique index needs it
+            duplicates = conn.execute(
+                select(table.c.id).where(
+                    table.c.id.not_in(
+                        select(sqlalchemy.func.min(table.c.id))
+                        .group_by(table.c.title_hash)
+                        .scalar_subquery()
+                    )
+                )
+            ).fetchall()
+            duplicate_ids = [row.id for row in duplicates]
+            for i in range(0, len(duplicate_ids), batch_size):
+                conn.execute(
+                    table.delete().where(
+                        table.c.id.in_(duplicate_ids[i : i + batch_size])
+                    )
+                )
+            print(f"Removed {len(duplicate_ids)} duplicate titles")
+            conn.execute(
+                text(
+                    "CREATE UNIQUE INDEX ux_reddit_ask_docs_title_hash "
+                    "ON reddit_ask_docs (title_hash)"
+                )
+            )
+        if not has_unique_index(inspector, "post_id"):
+            conn.execute(
+                text(
+                    "CREATE UNIQUE INDEX ux_reddit_ask_docs_post_id "
+                    "ON reddit_ask_docs (post_id)"
+                )
+            )
+
+
+def insert_ignore(engine, table):
+    """
+    INSERT which skips rows violating a unique constraint
+    """
+    dialect = engine.dialect.name
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+        return sqlite_insert(table).on_conflict_do_nothing()
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+
+        return postgresql_insert(table).on_conflict_do_nothing()
+    return insert(table).prefix_with("IGNORE")
 
-        print(f"Error: {traceback.format_exc()}")
+
+class FixtureSubreddit:
+    """
+    Stand-in for praw's Subreddit, replays posts recorded with --record (newest first,
+    like reddit's listings) and honours the `after` param
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _listing(self, params: dict = None):
+        after = (params or {}).get("after")
+        with open(self.path, "r") as f:
+            for line in f:
+                post = SimpleNamespace(**json.loads(line))
+                if after is not None:
+                    if post.fullname == after:
+                        after = None
+                    continue
+                yield post
+
+    def new(self, limit=None, params: dict = None):
+        return self._listing(params)
+
+    def top(self, time_filter: str = "all", limit=None, params: dict = None):
+        return self._listing(params)
+
+
+def recorded(posts, path: str):
+    with open(path, "w") as f:
+        for post in posts:
+            record = {
+                "id": post.id,
+                "fullname": post.fullname,
+                "title": post.title,
+                "created_utc": post.created_utc,
+            }
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            yield post
+
+
+def get_subreddit(fixture: str = None):
+    if fixture:
+        return FixtureSubreddit(fixture)
+    import praw
+
+    reddit = praw.Reddit(
+        client_id=os.environ["REDDIT_CLIENT_ID"],
+        client_secret=os.environ["REDDIT_SECRET_ID"],
+        user_agent="MedicalGPT",
+    )
+    return reddit.subreddit(SUBREDDIT)
+
+
+def load_cursor(conn, listing: str) -> RedditIngestCursor:
+    row = conn.execute(
+        select(RedditIngestCursor.__table__).where(
+            RedditIngestCursor.listing == listing
+        )
+    ).fetchone()
+    if row is None:
+        conn.execute(insert(RedditIngestCursor.__table__).values(listing=listing))
+        return SimpleNamespace(
+            after=None, stop_at_utc=None, run_newest_utc=None, newest_utc=None
+        )
+    return row
+
+
+def ingest(engine, subreddit, listing: str = "new", batch_size: int = 500, record=None):
+    """
+    Streams the listing and stores it in batches, memory stays bounded by batch_size.
+    The `new` listing is ordered by creation time, so a run stops at the newest post
+    of the previous finished run. `top` has no order to stop at and is only deduped.
+    """
+    with engine.begin() as conn:
+        cursor = load_cursor(conn, listing)
+    if cursor.after is None:
+        stop_at_utc = cursor.newest_utc if listing == "new" else None
+        run_newest_utc = None
+    else:
+        stop_at_utc = cursor.stop_at_utc
+        run_newest_utc = cursor.run_newest_utc
+        print(f"Resuming after {cursor.after}")
+    params = {"after": cursor.after} if cursor.after else {}
+    if listing == "new":
+        posts = subreddit.new(limit=None, params=params)
+    else:
+        posts = subreddit.top(time_filter="all", limit=None, params=params)
+    if record:
+        posts = recorded(posts, record)
+    insert_posts = insert_ignore(engine, RedditAskDocs.__table__)
+    cursor_table = RedditIngestCursor.__table__
+    n_seen = 0
+    n_inserted = 0
+
+    def flush(batch: list, cursor_values: dict):
+        with engine.begin() as conn:
+            inserted = conn.execute(insert_posts, batch).rowcount if batch else 0
+            conn.execute(
+                update(cursor_table)
+                .where(cursor_table.c.listing == listing)
+                .values(**cursor_values)
+            )
+        return max(inserted, 0)
+
+    batch = []
+    for post in posts:
+        if stop_at_utc is not None and post.created_utc <= stop_at_utc:
+            break
+        n_seen += 1
+        run_newest_utc = max(run_newest_utc or 0, post.created_utc)
+        batch.append(
+            {
+                "post_id": post.id,
+                "title": post.title,
+                "title_hash": title_hash(post.title),
+                "created_utc": post.created_utc,
+            }
+        )
+        if len(batch) >= batch_size:
+            n_inserted += flush(
+                batch,
+                {
+                    "after": post.fullname,
+                    "stop_at_utc": stop_at_utc,
+                    "run_newest_utc": run_newest_utc,
+                },
+            )
+            batch = []
+            print(f"{n_seen} posts streamed, {n_inserted} new")
+    # the run is complete, the next one starts from the top of the listing
+    newest_utc = max(filter(None, [cursor.newest_utc, run_newest_utc]), default=None)
+    n_inserted += flush(
+        batch,
+        {
+            "after": None,
+            "stop_at_utc": None,
+            "run_newest_utc": None,
+            "newest_utc": newest_utc,
+        },
+    )
+    print(f"Finished: {n_seen} posts streamed, {n_inserted} new titles stored.")
+    return n_inserted
 
 
 if __name__ == "__main__":
-    scrape_titles()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--listing", choices=["new", "top"], default="new")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument(
+        "--fixture", default=None, help="replay posts from this jsonl, offline"
+    )
+    parser.add_argument(
+        "--record", default=None, help="also write the streamed posts to this jsonl"
+    )
+    parser.add_argument(
+        "--migrate-only", action="store_true", help="update the schema and exit"
+    )
+    args = parser.parse_args()
+    engine = sqlalchemy.create_engine(get_database_url())
+    migrate(engine)
+    if not args.migrate_only:
+        ingest(
+            engine,
+            get_subreddit(args.fixture),
+            args.listing,
+            args.batch_size,
+            args.record,
+        )
@@ -0,0 +1,36 @@
+"""
+The bot's modules read their config at import time, tests get a copy of the example
+config with a sqlite database
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import yaml
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR / "bot"))
+
+if "MEDICALGPT_CONFIG_DIR" not in os.environ:
+    config_dir = Path(tempfile.mkdtemp(prefix="medicalgpt-tests-"))
+    with open(ROOT_DIR / "config" / "config.example.yml", "r") as f:
+        config_yaml = yaml.safe_load(f)
+    config_yaml.update(
+        {
+            "telegram_token": "test",
+            "openai_api_key": "sk-test",
+            "allowed_telegram_usernames": [],
+            "developer_telegram_chatid": 1,
+            "admin_telegram_username": "test_admin",
+        }
+    )
+    with open(config_dir / "config.yml", "w") as f:
+        yaml.safe_dump(config_yaml, f)
+    with open(config_dir / "config.env", "w") as f:
+        f.write(f"DATABASE_URI=sqlite:///{config_dir / 'test.sqlite'}\n")
+    with open(ROOT_DIR / "config" / "chat_modes.yml", "r") as src, open(
+        config_dir / "chat_modes.yml", "w"
+    ) as dst:
+        dst.write(src.read())
+    os.environ["MEDICALGPT_CONFIG_DIR"] = str(config_dir)
@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+
+import pytest
+from archiver import DialogArchiver
+from mysql import MySQL
+from tables import Dialog, User
+
+
+@pytest.fixture
+def old_dialogs():
+    mysql_db = MySQL()
+    mysql_db.create_tables_if_not_exists()
+    user_id = 4901
+    if not mysql_db.check_if_object_exists(user_id):
+        mysql_db.add_instance(user_id, User, {"username": "archiver"})
+    dialog_ids = []
+    for i in range(3):
+        dialog_id = mysql_db.start_new_dialog(user_id)
+        mysql_db.set_dialog_messages(
+            user_id, [{"user": f"question {i}", "bot": "answer"}], dialog_id=dialog_id
+        )
+        dialog_ids.append(dialog_id)
+    # the last one stays the user's current dialog
+    session = mysql_db.Session()
+    session.query(Dialog).filter(Dialog.uid.in_(dialog_ids)).update(
+        {"start_time": datetime.utcnow() - timedelta(days=40)},
+        synchronize_session=False,
+    )
+    session.commit()
+    session.close()
+    yield mysql_db, user_id, dialog_ids
+    mysql_db.remove_instance(user_id, Dialog)
+
+
+def test_no_frame_is_written_when_every_dialog_changed(old_dialogs, tmp_path):
+    mysql_db, user_id, dialog_ids = old_dialogs
+    archiver = DialogArchiver(mysql_db, directory=str(tmp_path), pause_seconds=0)
+    rows = archiver._select_batch(0, datetime.utcnow() - timedelta(days=30))
+    assert {row.uid for row in rows} == set(dialog_ids[:2])
+    for dialog_id in dialog_ids[:2]:
+        # written to between the read and the archival
+        mysql_db.set_dialog_messages(
+            user_id, [{"user": "changed", "bot": "answer"}], dialog_id=dialog_id
+        )
+    assert archiver._archive_batch(rows) == 0
+    assert not list(tmp_path.glob("dialogs-*"))
+
+
+def test_failed_transaction_truncates_its_frame(old_dialogs, tmp_path, monkeypatch):
+    mysql_db, _, dialog_ids = old_dialogs
+    archiver = DialogArchiver(mysql_db, directory=str(tmp_path), pause_seconds=0)
+    rows = archiver._select_batch(0, datetime.utcnow() - timedelta(days=30))
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("commit failed")
+
+    monkeypatch.setattr(archiver, "_delete", fail)
+    with pytest.raises(RuntimeError):
+        archiver._archive_batch(rows)
+    (segment,) = tmp_path.glob("dialogs-*")
+    assert segment.stat().st_size == 0
+    monkeypatch.undo()
+    assert archiver.run_once() == 2
+    for dialog_id in dialog_ids[:2]:
+        assert archiver.load(dialog_id)["uid"] == dialog_id
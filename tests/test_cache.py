@@ -0,0 +1,32 @@
+import os
+import time
+
+from cache import ResponseCache
+
+
+def spilled_files(disk_dir) -> set:
+    return {path.stem for path in disk_dir.glob("*.json")}
+
+
+def test_spilled_answers_are_capped_and_deleted_once_loaded(tmp_path):
+    cache = ResponseCache(max_entries=1, disk_dir=str(tmp_path), disk_max_entries=2)
+    for key in ("a", "b", "c", "d"):
+        cache.set(key, f"answer {key}")
+    # "d" is in memory, "a" was the oldest spilled file
+    assert spilled_files(tmp_path) == {"b", "c"}
+    assert cache.get("a") is None
+    assert cache.get("b") == "answer b"
+    # "b" is back in memory and "d" spilled in its place
+    assert spilled_files(tmp_path) == {"c", "d"}
+
+
+def test_expired_answers_are_deleted_including_earlier_runs(tmp_path):
+    cache = ResponseCache(max_entries=1, disk_dir=str(tmp_path), disk_ttl_seconds=60)
+    cache.set("old", "old answer")
+    cache.set("new", "new answer")
+    assert spilled_files(tmp_path) == {"old"}
+    hour_ago = time.time() - 3600
+    os.utime(tmp_path / "old.json", (hour_ago, hour_ago))
+    # a restarted bot prunes what the previous run left behind
+    ResponseCache(max_entries=1, disk_dir=str(tmp_path), disk_ttl_seconds=60)
+    assert spilled_files(tmp_path) == set()
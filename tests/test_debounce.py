@@ -0,0 +1,48 @@
+import asyncio
+from types import SimpleNamespace
+
+import handlers  # noqa: F401, resolves the bot's circular imports
+from handlers import message
+
+from bot import user_semaphores
+
+
+def make_update(text: str):
+    return SimpleNamespace(
+        message=SimpleNamespace(text=text, from_user=SimpleNamespace(id=4701))
+    )
+
+
+def test_cancel_during_the_debounce_drops_the_stale_handler(monkeypatch):
+    answered = []
+
+    async def answer_message(update, context, text, *args):
+        answered.append((update, text))
+
+    async def register_user_if_not_exists(*args):
+        return False
+
+    monkeypatch.setattr(message, "answer_message", answer_message)
+    monkeypatch.setattr(
+        message, "register_user_if_not_exists", register_user_if_not_exists
+    )
+    monkeypatch.setattr(message.config, "message_debounce_seconds", 0.05)
+
+    async def run():
+        user_semaphores[4701] = asyncio.Semaphore(1)
+        first = make_update("first")
+        first_handler = asyncio.create_task(
+            message.debounced_message_handler(first, None)
+        )
+        await asyncio.sleep(0.01)
+        # /cancel
+        message.pending_messages.pop(4701, None)
+        second = make_update("second")
+        second_handler = asyncio.create_task(
+            message.debounced_message_handler(second, None)
+        )
+        await asyncio.gather(first_handler, second_handler)
+        return second
+
+    second = asyncio.run(run())
+    assert answered == [(second, "second")]
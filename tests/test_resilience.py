@@ -0,0 +1,98 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+import resilience
+from resilience import CircuitBreaker, CircuitOpenError, ResilientOpenAI
+
+
+class OpenAIError(Exception):
+    pass
+
+
+class FakeOpenAI:
+    """
+    ChatCompletion.acreate hangs while `hang` is set, otherwise answers (or streams
+    two chunks)
+    """
+
+    def __init__(self):
+        self.hang = True
+        errors = {
+            name: type(name, (OpenAIError,), {})
+            for name in (
+                "RateLimitError",
+                "Timeout",
+                "TryAgain",
+                "APIError",
+                "ServiceUnavailableError",
+                "APIConnectionError",
+            )
+        }
+        self.error = SimpleNamespace(OpenAIError=OpenAIError, **errors)
+        self.ChatCompletion = SimpleNamespace(acreate=self.acreate)
+
+    async def acreate(self, stream=False, **kwargs):
+        if self.hang:
+            await asyncio.sleep(3600)
+        if stream:
+            return self._chunks()
+        return {"choices": []}
+
+    async def _chunks(self):
+        for chunk in ("a", "b"):
+            yield chunk
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    fake = FakeOpenAI()
+    monkeypatch.setattr(resilience, "load_openai", lambda: fake)
+    resilience.retryable_errors.cache_clear()
+    yield fake
+    resilience.retryable_errors.cache_clear()
+
+
+def half_open_client() -> ResilientOpenAI:
+    client = ResilientOpenAI(
+        max_retries=0, circuit_failure_threshold=1, circuit_reset_timeout=0
+    )
+    client.breaker.record_failure()
+    assert client.breaker.state == CircuitBreaker.OPEN
+    return client
+
+
+def test_cancelled_trial_call_releases_the_breaker(fake_openai):
+    async def run():
+        client = half_open_client()
+        trial = asyncio.create_task(client.acreate(model="gpt-3.5-turbo"))
+        await asyncio.sleep(0.01)
+        assert client.breaker.state == CircuitBreaker.HALF_OPEN
+        with pytest.raises(CircuitOpenError):
+            await client.acreate(model="gpt-3.5-turbo")
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        fake_openai.hang = False
+        await client.acreate(model="gpt-3.5-turbo")
+        assert client.breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(run())
+
+
+def test_abandoned_trial_stream_releases_the_breaker(fake_openai):
+    async def run():
+        client = half_open_client()
+        fake_openai.hang = False
+        stream = client.stream(model="gpt-3.5-turbo")
+        assert await stream.__anext__() == "a"
+        # the consumer stops reading after the first chunk
+        await stream.aclose()
+        assert client.breaker.state == CircuitBreaker.HALF_OPEN
+        assert [chunk async for chunk in client.stream(model="gpt-3.5-turbo")] == [
+            "a",
+            "b",
+        ]
+        assert client.breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(run())
@@ -0,0 +1,17 @@
+import retrieval
+from retrieval import DialogRetriever
+
+
+class WordEncoding:
+    def encode(self, text: str) -> list:
+        return text.split()
+
+
+def test_dialog_no_longer_than_recent_turns_is_selected_once(monkeypatch):
+    monkeypatch.setattr(retrieval.router, "encoding_for", lambda model: WordEncoding())
+    retriever = DialogRetriever(enabled=True, min_turns=2, recent_turns=4)
+    dialog_messages = [
+        {"user": f"question {i} about headache", "bot": f"answer {i}"} for i in range(3)
+    ]
+    selected = retriever.select(1, dialog_messages, "headache", "gpt-4")
+    assert selected == dialog_messages
@@ -0,0 +1,18 @@
+import pytest
+from router import DEFAULT_MODELS, ModelRouter
+
+
+def test_short_reply_route_is_off_unless_configured():
+    router = ModelRouter(DEFAULT_MODELS, {"chat": "gpt-4"})
+    assert router.chat_model("gpt-4", "ok thanks", n_dialog_messages=3) == "gpt-4"
+    router = ModelRouter(DEFAULT_MODELS, {"short_reply": "gpt-3.5-turbo"})
+    assert (
+        router.chat_model("gpt-4", "ok thanks", n_dialog_messages=3) == "gpt-3.5-turbo"
+    )
+
+
+def test_route_to_an_unknown_model_fails_at_startup():
+    with pytest.raises(ValueError, match="model_routes.summary"):
+        ModelRouter(DEFAULT_MODELS, {"summary": "gpt-3.5-turbo-16k"})
+    with pytest.raises(ValueError, match="model_routes.chat"):
+        ModelRouter({"gpt-3.5-turbo": DEFAULT_MODELS["gpt-3.5-turbo"]})
@@ -0,0 +1,30 @@
+import summarizer
+from summarizer import DialogSummarizer
+
+
+class WordEncoding:
+    def encode(self, text: str) -> list:
+        return text.split()
+
+    def decode(self, tokens: list) -> str:
+        return " ".join(tokens)
+
+
+def test_turn_larger_than_the_budget_is_truncated(monkeypatch):
+    monkeypatch.setattr(summarizer.router, "encoding_for", lambda model: WordEncoding())
+    monkeypatch.setattr(summarizer.router, "context_limit", lambda model: 1000)
+    dialog_summarizer = DialogSummarizer(max_summary_tokens=100)
+    budget = 1000 - 3 * 100
+    turns = [
+        {"user": "short question", "bot": "short answer"},
+        {"user": "word " * 2000, "bot": "answer " * 50},
+        {"user": "another question", "bot": "another answer"},
+    ]
+    chunks = list(dialog_summarizer._chunks(turns))
+    for chunk in chunks:
+        assert dialog_summarizer.dialog_tokens(chunk, "gpt-3.5-turbo") <= budget
+    sent = [turn for chunk in chunks for turn in chunk]
+    assert len(sent) == 3
+    # the long side is cut, the short one is kept whole
+    assert sent[1]["bot"] == ("answer " * 50).strip()
+    assert len(sent[1]["user"].split()) == budget - 50